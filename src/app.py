@@ -8,7 +8,9 @@ import aws_cdk.aws_apigatewayv2_integrations as integrations
 import aws_cdk.aws_ecr_assets as ecr_assets
 import aws_cdk.aws_iam as iam
 import aws_cdk.aws_lambda as _lambda
+import aws_cdk.aws_lambda_event_sources as event_sources
 import aws_cdk.aws_s3 as s3
+import aws_cdk.aws_sqs as sqs
 from constructs import Construct
 from openai import OpenAI
 from utils.config import settings
@@ -33,6 +35,28 @@ class Stack(cdk.Stack):
             ),
         )
 
+        thread_runner_timeout = cdk.Duration.seconds(10 * 60)
+
+        # Queue of thread runs for the thread runner. Runs that fail
+        # repeatedly are moved to the dead letter queue. The thread runner
+        # retries failed runs after THREAD_RUN_RETRY_DELAY seconds, rather
+        # than after the visibility timeout
+        thread_run_dead_letter_queue = sqs.Queue(
+            self,
+            'thread-run-dead-letter-queue',
+            retention_period=cdk.Duration.days(14),
+        )
+        thread_run_queue = sqs.Queue(
+            self,
+            'thread-run-queue',
+            # AWS recommends at least 6 times the consumer's timeout
+            visibility_timeout=cdk.Duration.seconds(thread_runner_timeout.to_seconds() * 6),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3,
+                queue=thread_run_dead_letter_queue,
+            ),
+        )
+
         # Create a Lambda function
         thread_runner_lambda_function = _lambda.Function(
             self,
@@ -48,13 +72,32 @@ class Stack(cdk.Stack):
                 # TOOD: use secretsmanager
                 'OPENAI_API_KEY': settings.OPENAI_API_KEY,
                 'OPENAI_EMBEDDING_MODEL': settings.OPENAI_EMBEDDING_MODEL,
+                'OPENAI_EMBEDDING_DIMENSIONS': str(settings.OPENAI_EMBEDDING_DIMENSIONS),
                 'LANCEDB_DATA_PATH': settings.LANCEDB_DATA_PATH,
                 'BUCKET_NAME': bucket.bucket_name,
+                'SEARCH_BACKEND': settings.SEARCH_BACKEND,
+                'LOCAL_INDEX_PATH': settings.LOCAL_INDEX_PATH,
+                'LEXICAL_INDEX_PATH': settings.LEXICAL_INDEX_PATH,
+                'THREAD_RUN_BATCH_CONCURRENCY': str(settings.THREAD_RUN_BATCH_SIZE),
+                'THREAD_RUN_QUEUE_URL': thread_run_queue.queue_url,
+                'THREAD_RUN_RETRY_DELAY': str(settings.THREAD_RUN_RETRY_DELAY),
             },
-            timeout=cdk.Duration.seconds(10 * 60),
+            timeout=thread_runner_timeout,
             memory_size=1024,
         )
 
+        # Each invocation processes a batch of runs concurrently (most of
+        # a run is spent waiting on OpenAI), and only the failed runs of
+        # a batch are retried
+        thread_runner_lambda_function.add_event_source(
+            event_sources.SqsEventSource(
+                thread_run_queue,
+                batch_size=settings.THREAD_RUN_BATCH_SIZE,
+                max_batching_window=cdk.Duration.seconds(settings.THREAD_RUN_BATCH_WINDOW),
+                report_batch_item_failures=True,
+            ),
+        )
+
         client = OpenAI(api_key=settings.OPENAI_API_KEY)
 
         OPENAI_ASSISTANT_NAME = f'{settings.OPENAI_ASSISTANT_NAME}-{settings.STAGE}'
@@ -68,6 +111,30 @@ class Stack(cdk.Stack):
             raise Exception(f'Assistant {OPENAI_ASSISTANT_NAME} not found')
         assistant = assistants[0]
 
+        # API Gateway (HTTP API) closes connections after 30 seconds, so a
+        # longer timeout has no use. The streaming endpoint hands its run
+        # over to the thread runner a few seconds before
+        api_timeout = cdk.Duration.seconds(30)
+
+        api_environment = {
+            # TOOD: use secretsmanager
+            'OPENAI_API_KEY': settings.OPENAI_API_KEY,
+            'OPENAI_ASSISTANT_ID': assistant.id,
+            'THREAD_RUNNER_LAMBDA_ARN': thread_runner_lambda_function.function_arn,
+            'THREAD_RUN_DISPATCH': settings.THREAD_RUN_DISPATCH,
+            'THREAD_RUN_QUEUE_URL': thread_run_queue.queue_url,
+            'STAGE': settings.STAGE,
+            # The streaming endpoint runs tool calls itself, so it
+            # needs the same settings as the thread runner
+            'OPENAI_EMBEDDING_MODEL': settings.OPENAI_EMBEDDING_MODEL,
+            'OPENAI_EMBEDDING_DIMENSIONS': str(settings.OPENAI_EMBEDDING_DIMENSIONS),
+            'LANCEDB_DATA_PATH': settings.LANCEDB_DATA_PATH,
+            'BUCKET_NAME': bucket.bucket_name,
+            'SEARCH_BACKEND': settings.SEARCH_BACKEND,
+            'LOCAL_INDEX_PATH': settings.LOCAL_INDEX_PATH,
+            'LEXICAL_INDEX_PATH': settings.LEXICAL_INDEX_PATH,
+        }
+
         api_lambda_function = _lambda.Function(
             self,
             'api-lambda',
@@ -79,24 +146,54 @@ class Stack(cdk.Stack):
             handler=_lambda.Handler.FROM_IMAGE,
             runtime=_lambda.Runtime.FROM_IMAGE,
             environment={
-                # TOOD: use secretsmanager
-                'OPENAI_API_KEY': settings.OPENAI_API_KEY,
-                'OPENAI_ASSISTANT_ID': assistant.id,
-                'THREAD_RUNNER_LAMBDA_ARN': thread_runner_lambda_function.function_arn,
-                'STAGE': settings.STAGE,
+                **api_environment,
+                'STREAM_MAX_DURATION': str(api_timeout.to_seconds() - 5),
             },
-            timeout=cdk.Duration.seconds(60),
+            timeout=api_timeout,
             memory_size=1024,
         )
 
-        api_lambda_function.add_to_role_policy(
-            iam.PolicyStatement(
-                effect=iam.Effect.ALLOW,
-                actions=['lambda:InvokeFunction'],
-                resources=[thread_runner_lambda_function.function_arn],
+        # API Gateway buffers the responses of Lambda functions, so that the
+        # streaming endpoint's events would only reach clients at the end.
+        # The same app is also served by a function with response streaming
+        # (behind a function URL), with uvicorn run by the Lambda Web
+        # Adapter (see Dockerfile.stream), where a run can be streamed
+        # until it's done
+        api_stream_timeout = cdk.Duration.seconds(10 * 60)
+
+        api_stream_lambda_function = _lambda.Function(
+            self,
+            'api-stream-lambda',
+            code=_lambda.Code.from_asset_image(
+                directory='src/lambda',
+                file='Dockerfile.stream',
+                platform=ecr_assets.Platform.LINUX_AMD64,
             ),
+            handler=_lambda.Handler.FROM_IMAGE,
+            runtime=_lambda.Runtime.FROM_IMAGE,
+            environment={
+                **api_environment,
+                'STREAM_MAX_DURATION': str(api_stream_timeout.to_seconds() - 10),
+            },
+            timeout=api_stream_timeout,
+            memory_size=1024,
+        )
+        api_stream_url = api_stream_lambda_function.add_function_url(
+            auth_type=_lambda.FunctionUrlAuthType.NONE,
+            invoke_mode=_lambda.InvokeMode.RESPONSE_STREAM,
         )
-        thread_runner_lambda_function.grant_invoke(api_lambda_function)
+
+        for function in [api_lambda_function, api_stream_lambda_function]:
+            function.add_to_role_policy(
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=['lambda:InvokeFunction'],
+                    resources=[thread_runner_lambda_function.function_arn],
+                ),
+            )
+            thread_runner_lambda_function.grant_invoke(function)
+            thread_run_queue.grant_send_messages(function)
+            bucket.grant_read(function)
 
         # Grant the Lambda function read/write permissions to the bucket
         bucket.grant_read_write(thread_runner_lambda_function)
@@ -113,7 +210,9 @@ class Stack(cdk.Stack):
 
         # Output the API Gateway URL
         cdk.CfnOutput(self, 'api_endpoint', value=api.url)  # type: ignore
+        cdk.CfnOutput(self, 'api_stream_endpoint', value=api_stream_url.url)  # type: ignore
         cdk.CfnOutput(self, 'bucket_name', value=bucket.bucket_name)  # type: ignore
+        cdk.CfnOutput(self, 'thread_run_queue_url', value=thread_run_queue.queue_url)  # type: ignore
 
 
 CDK_DEFAULT_REGION = os.environ.get('CDK_DEFAULT_REGION')
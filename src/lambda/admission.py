@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections.abc import Awaitable
+from collections.abc import Callable
+from typing import Optional
+
+from cache import TTLCache
+
+# Statuses of a run during which no message can be added to its thread,
+# nor another run created
+ACTIVE_RUN_STATUSES = {'queued', 'in_progress', 'requires_action', 'cancelling'}
+
+# Metadata key, on the runs created by `RunAdmission`, holding the
+# idempotency key of the request that created the run
+IDEMPOTENCY_KEY_METADATA = 'idempotency_key'
+
+
+class RunActiveError(Exception):
+    def __init__(self, run_id: str):
+        super().__init__(f'Run {run_id} is still active')
+        self.run_id = run_id
+
+
+StartRun = Callable[[str, list[str], dict], Awaitable[dict]]
+
+
+class _PendingMessage:
+    def __init__(
+        self,
+        message: str,
+        key: Optional[str],
+        idempotency_key: Optional[str],
+        deadline: float,
+        start_run: Optional[StartRun] = None,
+    ):
+        self.message = message
+        self.key = key
+        self.idempotency_key = idempotency_key
+        self.deadline = deadline
+        self.start_run = start_run
+        self.future: asyncio.Future[dict] = asyncio.get_running_loop().create_future()
+        # Retries awaiting the same message may be gone by the time it fails
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+class RunAdmission:
+    """
+    Per-thread admission control for new messages:
+    - a retried request (same idempotency key) gets the run created for
+      the original request, whether it's still in flight, was created by
+      this container (cached for `idempotency_ttl` seconds), or is the
+      thread's latest run (the key is stored in the run's metadata)
+    - while the thread has an active run, messages wait (up to
+      `wait_timeout` seconds, after which `RunActiveError` is raised) and
+      all the messages that arrive in the meantime are added together,
+      in order, followed by a single run for all of them
+    `start_run(thread_id, messages, metadata)` adds the messages and starts
+    the run, all or nothing, raising `RunActiveError` if the thread has an
+    active run, `get_latest_run(thread_id)` returns the thread's latest run
+    (or None). Both return runs as dicts. A message submitted with its own
+    `start_run` (eg: to stream the run) gets a run of its own, once the
+    runs of the messages submitted before it are done.
+    Other containers admit messages to the same threads, so a run may
+    start between checking the thread and starting a run: the messages
+    then wait for that run as well, unless it's the run of a retry of
+    the same request, which they get instead.
+    """
+
+    def __init__(
+        self,
+        start_run: StartRun,
+        get_latest_run: Callable[[str], Awaitable[Optional[dict]]],
+        wait_timeout: float = 20,
+        idempotency_ttl: float = 3600,
+        poll_initial_delay: float = 0.5,
+        poll_max_delay: float = 2,
+    ):
+        self.start_run = start_run
+        self.get_latest_run = get_latest_run
+        self.wait_timeout = wait_timeout
+        self.poll_initial_delay = poll_initial_delay
+        self.poll_max_delay = poll_max_delay
+        self.runs = TTLCache(ttl=idempotency_ttl)
+        # Messages waiting for a run, and the task admitting them, by thread
+        self.pending: dict[str, list[_PendingMessage]] = {}
+        self.drivers: dict[str, asyncio.Task] = {}
+        self.in_flight: dict[str, asyncio.Future[dict]] = {}
+        self.coalesced = 0
+        self.deduplicated = 0
+
+    async def submit(
+        self,
+        thread_id: str,
+        message: str,
+        idempotency_key: Optional[str] = None,
+        start_run: Optional[StartRun] = None,
+    ) -> dict:
+        key = f'{thread_id}:{idempotency_key}' if idempotency_key else None
+        if key is not None:
+            cached: Optional[dict] = self.runs.get(key)
+            if cached is not None:
+                self.deduplicated += 1
+                return cached
+            if key in self.in_flight:
+                self.deduplicated += 1
+                return await asyncio.shield(self.in_flight[key])
+
+        pending = _PendingMessage(
+            message,
+            key,
+            idempotency_key,
+            time.monotonic() + self.wait_timeout,
+            start_run=start_run,
+        )
+        if key is not None:
+            self.in_flight[key] = pending.future
+        self.pending.setdefault(thread_id, []).append(pending)
+        if thread_id not in self.drivers:
+            self.drivers[thread_id] = asyncio.create_task(self._drive(thread_id))
+
+        try:
+            run = await asyncio.shield(pending.future)
+        finally:
+            if key is not None:
+                self.in_flight.pop(key, None)
+        if key is not None:
+            self.runs.set(key, run)
+        return run
+
+    async def _drive(self, thread_id: str):
+        """
+        Admits the thread's pending messages, in batches: each batch waits
+        for the thread's latest run to finish, then gets a run of its own.
+        """
+        delay = self.poll_initial_delay
+        try:
+            while self.pending.get(thread_id):
+                try:
+                    run = await self.get_latest_run(thread_id)
+                except Exception as e:
+                    self._remove(thread_id, lambda p: True, e)
+                    continue
+
+                # Retries of requests handled by another container
+                if run is not None:
+                    run_key = (run.get('metadata') or {}).get(IDEMPOTENCY_KEY_METADATA)
+                    for p in self.pending[thread_id]:
+                        if run_key is not None and p.idempotency_key == run_key:
+                            self.deduplicated += 1
+                            p.future.set_result(run)
+                    self._remove(thread_id, lambda p: p.future.done())
+                    if thread_id not in self.pending:
+                        break
+
+                if run is not None and run['status'] in ACTIVE_RUN_STATUSES:
+                    self._remove(
+                        thread_id,
+                        lambda p: time.monotonic() + delay > p.deadline,
+                        RunActiveError(run['id']),
+                    )
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.poll_max_delay)
+                    continue
+
+                # Messages that arrive from now on go in the next batch.
+                # There's no await since the last check, so none is missed.
+                # Messages with their own `start_run` are admitted alone
+                pending = self.pending.pop(thread_id)
+                size = 1
+                while size < len(pending) and not pending[0].start_run and not pending[size].start_run:
+                    size += 1
+                batch = pending[:size]
+                if size < len(pending):
+                    self.pending[thread_id] = pending[size:]
+                keys = [p.idempotency_key for p in batch if p.idempotency_key is not None]
+                # Retries of the other messages of the batch are only
+                # deduplicated by the container that received them
+                metadata = {IDEMPOTENCY_KEY_METADATA: keys[0]} if keys else {}
+                start_run = batch[0].start_run or self.start_run
+                try:
+                    run = await start_run(thread_id, [p.message for p in batch], metadata)
+                except RunActiveError as e:
+                    # A run was started elsewhere in the meantime. The batch
+                    # goes back in front of the messages that arrived since,
+                    # and the next check of the latest run matches its key
+                    self.pending[thread_id] = batch + self.pending.get(thread_id, [])
+                    self._remove(thread_id, lambda p: time.monotonic() + delay > p.deadline, e)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.poll_max_delay)
+                    continue
+                except Exception as e:
+                    for p in batch:
+                        p.future.set_exception(e)
+                else:
+                    self.coalesced += len(batch) - 1
+                    for p in batch:
+                        p.future.set_result(run)
+                delay = self.poll_initial_delay
+        finally:
+            del self.drivers[thread_id]
+
+    def _remove(
+        self,
+        thread_id: str,
+        predicate: Callable[[_PendingMessage], bool],
+        error: Optional[Exception] = None,
+    ):
+        # Removes the pending messages matching `predicate`, failing them
+        # with `error` unless they're already done
+        remaining = []
+        for p in self.pending.get(thread_id, []):
+            if predicate(p):
+                if not p.future.done():
+                    assert error is not None, 'Pending messages can only be removed with an error'
+                    p.future.set_exception(error)
+            else:
+                remaining.append(p)
+        if remaining:
+            self.pending[thread_id] = remaining
+        else:
+            self.pending.pop(thread_id, None)
+
+    def stats(self) -> dict:
+        return {
+            'pending_threads': len(self.pending),
+            'coalesced': self.coalesced,
+            'deduplicated': self.deduplicated,
+        }
@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Optional
+
+
+class CacheBackend:
+    """
+    Interface for a shared, second tier cache store. Values must be JSON
+    serializable. Implementations are expected to be safe to use from
+    several containers/processes at once.
+    """
+
+    def get(self, key: str) -> Optional[tuple[float, Any]]:
+        """Returns (expires_at, value) or None"""
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, expires_at: float):
+        raise NotImplementedError
+
+
+class FileCacheBackend(CacheBackend):
+    """
+    Stores each entry as a JSON file in a directory, which can be a local
+    path (eg: /tmp, shared by all invocations of a warm container) or a
+    mounted, shared file system (eg: EFS, shared by sibling containers).
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(
+            self.directory,
+            hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json',
+        )
+
+    def get(self, key: str) -> Optional[tuple[float, Any]]:
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry['expires_at'], entry['value']
+
+    def set(self, key: str, value: Any, expires_at: float):
+        path = self._path(key)
+        # Write to a temporary file first so that concurrent readers
+        # never see a partially written entry
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'expires_at': expires_at, 'value': value}, f)
+        os.replace(tmp_path, path)
+
+
+class TTLCache:
+    """
+    Thread-safe, in-process LRU cache where entries expire `ttl` seconds
+    after being set. An optional backend acts as a shared second tier: it's
+    checked on in-process misses and written to on every set.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 3600,
+        backend: Optional[CacheBackend] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+
+    def _get_local(self, key: str) -> Optional[tuple[float, Any]]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry
+
+    def _set_local(self, key: str, value: Any, expires_at: float):
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._get_local(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+
+        if self.backend is not None:
+            entry = self.backend.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.backend_hits += 1
+                self._set_local(key, entry[1], entry[0])
+                return entry[1]
+
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._set_local(key, value, expires_at)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, value, expires_at)
+            except OSError as e:
+                # The shared tier is an optimization, never fail a request
+                # because of it
+                print(f'Failed to write to cache backend: {e}')
+
+    def delete(self, key: str):
+        # Only the in-process tier: backend entries expire on their own
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'backend_hits': self.backend_hits,
+            'misses': self.misses,
+            'size': len(self._data),
+        }
+
+
+class ResponseCache:
+    """
+    Caches the results of slow lookups (eg: remote API calls) by key:
+    - results are fresh for `ttl` seconds
+    - for `stale_ttl` more seconds, a stale result is refreshed within
+      the request, for up to `revalidate_timeout` seconds, after which the
+      stale result is returned (stale-while-revalidate). The refresh isn't
+      left to run in the background only, since a Lambda environment is
+      frozen between invocations
+    - `None` results (eg: 404s) are cached for `negative_ttl` seconds
+    Exceptions raised by the lookup are never cached.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 3600,
+        stale_ttl: float = 24 * 3600,
+        negative_ttl: float = 300,
+        revalidate_timeout: float = 2,
+        backend: Optional[CacheBackend] = None,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.revalidate_timeout = revalidate_timeout
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl + stale_ttl, backend=backend)
+        self.revalidating: set[str] = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.revalidations = 0
+
+    def _fetch(self, key: str, fetch: Callable[[], Any]) -> Any:
+        value = fetch()
+        if value is None:
+            self.cache.set(key, {'value': None, 'fresh_until': None}, ttl=self.negative_ttl)
+        else:
+            self.cache.set(key, {'value': value, 'fresh_until': time.time() + self.ttl})
+        return value
+
+    def _revalidate(self, key: str, fetch: Callable[[], Any]) -> Any:
+        try:
+            return self._fetch(key, fetch)
+        finally:
+            with self.lock:
+                self.revalidating.discard(key)
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any]) -> Any:
+        entry = self.cache.get(key)
+        if entry is None:
+            return self._fetch(key, fetch)
+
+        if entry['fresh_until'] is None:
+            self.negative_hits += 1
+            return None
+
+        if entry['fresh_until'] < time.time():
+            self.stale_hits += 1
+            # Only one refresh per key at a time, other requests get the
+            # stale result
+            with self.lock:
+                start = key not in self.revalidating
+                self.revalidating.add(key)
+            if start:
+                self.revalidations += 1
+                future = self.executor.submit(self._revalidate, key, fetch)
+                try:
+                    return future.result(timeout=self.revalidate_timeout)
+                except concurrent.futures.TimeoutError:
+                    print(f'Revalidating {key} timed out, returning stale result')
+                except Exception as e:
+                    print(f'Failed to revalidate {key}: {e}')
+
+        return entry['value']
+
+    def stats(self) -> dict:
+        return {
+            **self.cache.stats(),
+            'stale_hits': self.stale_hits,
+            'negative_hits': self.negative_hits,
+            'revalidations': self.revalidations,
+        }
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import csv
+import io
+import json
+import math
+import zipfile
+from collections.abc import Iterator
+from typing import Any
+from typing import IO
+from typing import Optional
+
+from json_stream import JSONStreamReader
+
+# Columns with more distinct values than this are reported as such,
+# rather than counted exactly
+MAX_TRACKED_DISTINCT_VALUES = 1000
+
+
+class ColumnStats:
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.numeric = 0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self.sum = 0.0
+        self.distinct: set = set()
+        self.too_many_distinct = False
+
+    def add(self, value: Any):
+        if value is None or value == '':
+            self.nulls += 1
+            return
+        self.count += 1
+
+        number = to_number(value)
+        if number is not None:
+            self.numeric += 1
+            self.sum += number
+            self.min = number if self.min is None else min(self.min, number)
+            self.max = number if self.max is None else max(self.max, number)
+
+        if not self.too_many_distinct:
+            self.distinct.add(value if isinstance(value, (str, int, float, bool)) else str(value))
+            if len(self.distinct) > MAX_TRACKED_DISTINCT_VALUES:
+                self.too_many_distinct = True
+                self.distinct = set()
+
+    def summary(self) -> dict:
+        # A column is numeric if (almost) all of its values are numbers
+        is_numeric = self.count > 0 and self.numeric >= 0.95 * self.count
+        summary: dict[str, Any] = {
+            'type': 'number' if is_numeric else 'string',
+            'count': self.count,
+            'nulls': self.nulls,
+            'distinct': (
+                f'>{MAX_TRACKED_DISTINCT_VALUES}'
+                if self.too_many_distinct
+                else len(self.distinct)
+            ),
+        }
+        if is_numeric:
+            summary.update(
+                {'min': self.min, 'max': self.max, 'mean': self.sum / self.numeric},
+            )
+        return summary
+
+
+def to_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) if math.isfinite(value) else None
+    if isinstance(value, str):
+        try:
+            number = float(value.replace(',', ''))
+        except ValueError:
+            return None
+        return number if math.isfinite(number) else None
+    return None
+
+
+def summarize_rows(rows: Iterator[dict], sample_size: int = 10) -> dict:
+    """
+    Consumes rows one at a time and returns a bounded summary: the columns
+    (in order of appearance), per column statistics, the number of rows
+    and the first `sample_size` rows.
+    """
+    stats: dict[str, ColumnStats] = {}
+    sample: list[dict] = []
+    num_rows = 0
+
+    for row in rows:
+        num_rows += 1
+        if len(sample) < sample_size:
+            sample.append(row)
+        for column, value in row.items():
+            if column not in stats:
+                stats[column] = ColumnStats()
+            stats[column].add(value)
+
+    return {
+        'row_count': num_rows,
+        'columns': {column: s.summary() for column, s in stats.items()},
+        'sample_rows': sample,
+    }
+
+
+def iter_csv_rows(fp: IO[bytes]) -> Iterator[dict]:
+    text = io.TextIOWrapper(fp, encoding='utf-8-sig', errors='replace', newline='')
+    sample = text.read(64 * 1024)
+    text.seek(0)
+    try:
+        dialect: Any = csv.Sniffer().sniff(sample)
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.DictReader(text, dialect=dialect)
+
+
+def iter_excel_rows(path: str) -> Iterator[dict]:
+    # openpyxl's read only mode streams rows rather than loading
+    # the whole workbook
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(c) if c is not None else f'column_{i}' for i, c in enumerate(next(rows, []))]
+        for values in rows:
+            yield {
+                h: (v.isoformat() if hasattr(v, 'isoformat') else v)
+                for h, v in zip(header, values)
+            }
+    finally:
+        workbook.close()
+
+
+def iter_json_rows(fp: IO[str], metadata: dict) -> Iterator[dict]:
+    """
+    Yields the rows of a JSON document that's either a list of rows, or an
+    object with (at least) one list of rows. Other (top level) values of
+    the object are collected in `metadata`.
+    """
+    reader = JSONStreamReader(fp)
+    if reader.peek() == '[':
+        yield from (r if isinstance(r, dict) else {'value': r} for r in reader.iter_array())
+        return
+
+    reader.expect('{')
+    found_rows = False
+    while reader.peek() != '}':
+        key = reader.decode()
+        reader.expect(':')
+        if not found_rows and reader.peek() == '[':
+            found_rows = True
+            metadata['rows_key'] = key
+            yield from (r if isinstance(r, dict) else {'value': r} for r in reader.iter_array())
+        else:
+            value = reader.decode()
+            # Only keep small values, so that the summary stays bounded
+            if len(json.dumps(value, default=str)) <= 1000:
+                metadata[key] = value
+        if reader.peek() == ',':
+            reader.pos += 1
+
+
+def detect_format(path: str, content_type: str) -> str:
+    with open(path, 'rb') as f:
+        head = f.read(1024)
+    if head.startswith(b'PK\x03\x04'):
+        # Excel workbooks are zip archives too, with a workbook part
+        return 'excel' if is_excel_workbook(path) else 'zip'
+    if 'spreadsheet' in content_type or 'excel' in content_type:
+        return 'excel'
+    if 'json' in content_type or head.lstrip()[:1] in (b'{', b'['):
+        return 'json'
+    return 'csv'
+
+
+def is_excel_workbook(path: str) -> bool:
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return 'xl/workbook.xml' in archive.namelist()
+    except zipfile.BadZipFile:
+        return False
+
+
+def summarize_zip(path: str, max_files: int = 100) -> dict:
+    with zipfile.ZipFile(path) as archive:
+        files = [i for i in archive.infolist() if not i.is_dir()]
+    return {
+        'file_count': len(files),
+        'files': [{'name': i.filename, 'size_bytes': i.file_size} for i in files[:max_files]],
+    }
+
+
+def summarize_file(path: str, content_type: str, sample_size: int = 10) -> dict:
+    _format = detect_format(path, content_type)
+
+    if _format == 'zip':
+        return {'format': _format, **summarize_zip(path)}
+
+    if _format == 'excel':
+        return {'format': _format, **summarize_rows(iter_excel_rows(path), sample_size)}
+
+    if _format == 'json':
+        metadata: dict = {}
+        with open(path, encoding='utf-8') as f:
+            summary = summarize_rows(iter_json_rows(f, metadata), sample_size)
+        return {'format': _format, 'metadata': metadata, **summary}
+
+    with open(path, 'rb') as f:
+        return {'format': _format, **summarize_rows(iter_csv_rows(f), sample_size)}
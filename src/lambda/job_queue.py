@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Optional
+
+
+class Job:
+    def __init__(
+        self,
+        thread_id: str,
+        run_id: str,
+        enqueued_at: Optional[float] = None,
+        id: Optional[str] = None,
+        receipt: Optional[str] = None,
+        attempts: int = 0,
+    ):
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.enqueued_at = time.time() if enqueued_at is None else enqueued_at
+        self.id = id or uuid.uuid4().hex
+        # Backend specific handle, used to acknowledge the job
+        self.receipt = receipt
+        self.attempts = attempts
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {'thread_id': self.thread_id, 'run_id': self.run_id, 'enqueued_at': self.enqueued_at},
+        )
+
+    @classmethod
+    def from_json(cls, body: str, **kwargs) -> 'Job':
+        data = json.loads(body)
+        return cls(data['thread_id'], data['run_id'], enqueued_at=data.get('enqueued_at'), **kwargs)
+
+
+class JobQueue:
+    """
+    Interface for the queue of thread runs to process. Jobs are delivered
+    at least once: a job that isn't acknowledged (`ack`) within the
+    visibility timeout, or is released (`nack`), is delivered again, until
+    it's been attempted `max_attempts` times, after which it's moved to a
+    dead letter queue.
+    """
+
+    def put(self, job: Job):
+        raise NotImplementedError
+
+    def get_batch(self, max_jobs: int, wait_time: float) -> list[Job]:
+        """Returns up to `max_jobs` jobs, waiting up to `wait_time` seconds for one"""
+        raise NotImplementedError
+
+    def ack(self, job: Job):
+        raise NotImplementedError
+
+    def nack(self, job: Job):
+        raise NotImplementedError
+
+    def depth(self) -> int:
+        """(Approximate) number of jobs waiting to be delivered"""
+        raise NotImplementedError
+
+
+class MemoryJobQueue(JobQueue):
+    """
+    In-process queue, for running the API and the worker together locally.
+    Jobs don't survive a restart.
+    """
+
+    def __init__(self, max_attempts: int = 3):
+        self.max_attempts = max_attempts
+        self.jobs: deque[Job] = deque()
+        self.dead_letters: list[Job] = []
+        self.condition = threading.Condition()
+
+    def put(self, job: Job):
+        with self.condition:
+            self.jobs.append(job)
+            self.condition.notify()
+
+    def get_batch(self, max_jobs: int, wait_time: float) -> list[Job]:
+        with self.condition:
+            self.condition.wait_for(lambda: self.jobs, timeout=wait_time)
+            batch: list[Job] = []
+            while self.jobs and len(batch) < max_jobs:
+                job = self.jobs.popleft()
+                job.attempts += 1
+                batch.append(job)
+            return batch
+
+    def ack(self, job: Job):
+        pass
+
+    def nack(self, job: Job):
+        if job.attempts >= self.max_attempts:
+            self.dead_letters.append(job)
+        else:
+            self.put(job)
+
+    def depth(self) -> int:
+        return len(self.jobs)
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Durable queue in a local SQLite database, a stand-in for SQS when
+    running locally: jobs survive restarts, and several worker processes
+    can share the database file.
+    """
+
+    def __init__(self, path: str, visibility_timeout: float = 15 * 60, max_attempts: int = 3):
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                visible_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                dead INTEGER NOT NULL DEFAULT 0
+            )
+            """,
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS jobs_visible_at ON jobs (dead, visible_at)',
+        )
+
+    def put(self, job: Job):
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO jobs (id, body, visible_at) VALUES (?, ?, ?)',
+                (job.id, job.to_json(), time.time()),
+            )
+
+    def _receive(self, max_jobs: int) -> list[Job]:
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.connection.execute(
+                    'SELECT id, body, attempts FROM jobs WHERE dead = 0 AND visible_at <= ? '
+                    'ORDER BY visible_at LIMIT ?',
+                    (now, max_jobs),
+                ).fetchall()
+                self.connection.executemany(
+                    'UPDATE jobs SET visible_at = ?, attempts = attempts + 1 WHERE id = ?',
+                    [(now + self.visibility_timeout, _id) for _id, _, _ in rows],
+                )
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return [
+            Job.from_json(body, id=_id, receipt=_id, attempts=attempts + 1)
+            for _id, body, attempts in rows
+        ]
+
+    def get_batch(self, max_jobs: int, wait_time: float) -> list[Job]:
+        deadline = time.monotonic() + wait_time
+        while True:
+            jobs = self._receive(max_jobs)
+            if jobs or time.monotonic() >= deadline:
+                return jobs
+            time.sleep(min(0.5, max(0, deadline - time.monotonic())))
+
+    def ack(self, job: Job):
+        with self.lock:
+            self.connection.execute('DELETE FROM jobs WHERE id = ?', (job.receipt,))
+
+    def nack(self, job: Job):
+        with self.lock:
+            if job.attempts >= self.max_attempts:
+                self.connection.execute('UPDATE jobs SET dead = 1 WHERE id = ?', (job.receipt,))
+            else:
+                self.connection.execute(
+                    'UPDATE jobs SET visible_at = ? WHERE id = ?',
+                    (time.time(), job.receipt),
+                )
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM jobs WHERE dead = 0 AND visible_at <= ?',
+                (time.time(),),
+            ).fetchone()[0]
+
+
+class SQSJobQueue(JobQueue):
+    """
+    Amazon SQS queue. Dead lettering is configured on the queue itself
+    (with a redrive policy, see `app.py`), so `max_attempts` isn't used.
+    """
+
+    def __init__(self, queue_url: str):
+        import boto3
+
+        self.queue_url = queue_url
+        self.sqs = boto3.client('sqs')
+
+    def put(self, job: Job):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=job.to_json())
+
+    def get_batch(self, max_jobs: int, wait_time: float) -> list[Job]:
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            # SQS limits
+            MaxNumberOfMessages=max(1, min(max_jobs, 10)),
+            WaitTimeSeconds=max(0, min(int(wait_time), 20)),
+            AttributeNames=['ApproximateReceiveCount'],
+        )
+        return [
+            Job.from_json(
+                m['Body'],
+                id=m['MessageId'],
+                receipt=m['ReceiptHandle'],
+                attempts=int(m['Attributes']['ApproximateReceiveCount']),
+            )
+            for m in response.get('Messages', [])
+        ]
+
+    def ack(self, job: Job):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=job.receipt)
+
+    def nack(self, job: Job):
+        # Makes the message visible again right away
+        self.sqs.change_message_visibility(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=job.receipt,
+            VisibilityTimeout=0,
+        )
+
+    def depth(self) -> int:
+        response = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=['ApproximateNumberOfMessages'],
+        )
+        return int(response['Attributes']['ApproximateNumberOfMessages'])
+
+
+def get_job_queue(backend: str) -> JobQueue:
+    """
+    Returns the queue for the `THREAD_RUN_DISPATCH` backend: `sqs` (the
+    queue at `THREAD_RUN_QUEUE_URL`), `sqlite` (the database at
+    `THREAD_RUN_QUEUE_PATH`) or `memory`.
+    """
+    if backend == 'sqs':
+        return SQSJobQueue(os.environ['THREAD_RUN_QUEUE_URL'])
+    if backend == 'sqlite':
+        return SQLiteJobQueue(os.environ.get('THREAD_RUN_QUEUE_PATH', 'thread_runs.sqlite'))
+    if backend == 'memory':
+        return MemoryJobQueue()
+    raise ValueError(f'Unknown thread run queue backend: {backend}')
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import json
+import re
+from collections.abc import Iterator
+from typing import Any
+from typing import IO
+
+NUMBER_START = frozenset('-0123456789')
+# Any character that can't be part of a number
+NUMBER_END = re.compile(r'[^-+.eE0-9]')
+
+
+class JSONStreamReader:
+    """
+    Minimal incremental reader for large JSON documents. Only the
+    top level structure is parsed by hand, each item is decoded
+    with `json.JSONDecoder.raw_decode`, so only one item (plus a
+    read buffer) is held in memory at a time.
+    """
+
+    def __init__(self, fp: IO[str], chunk_size: int = 1 << 16):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size: int) -> bool:
+        if self.eof:
+            return False
+        chunk = self.fp.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(self.chunk_size):
+                return ''
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at offset {self.pos}, got {self.peek()!r}')
+        self.pos += 1
+
+    def decode(self) -> Any:
+        size = self.chunk_size
+        if self.peek() in NUMBER_START:
+            # A number is only complete once followed by a delimiter (or
+            # the end of the file): `1.5e10` read up to `1.` decodes as `1`
+            while not NUMBER_END.search(self.buffer, self.pos):
+                if not self._fill(size):
+                    break
+                size *= 2
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value that ends exactly at the end of the buffer may
+                # have been cut short (eg: `true` split across chunks)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow read size so that large values don't need to be
+            # re-decoded too many times
+            if not self._fill(size):
+                continue
+            size *= 2
+
+    def iter_array(self) -> Iterator[Any]:
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            separator = self.peek()
+            self.pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f'Expected "," or "]" at offset {self.pos}, got {separator!r}')
+
+
+def iter_json_items(fp: IO[str], chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """
+    Yields the items of a JSON file one at a time: the elements of a top
+    level array, or, for a top level object, the elements of its `data`
+    array. Objects without a `data` array (ie: files which map ids to
+    records) are read a second time, if the file is seekable, to yield
+    their values.
+    """
+    reader = JSONStreamReader(fp, chunk_size=chunk_size)
+
+    if reader.peek() == '[':
+        yield from reader.iter_array()
+        return
+
+    has_data = False
+    for key in iter_object_keys(reader):
+        if key == 'data' and reader.peek() == '[':
+            has_data = True
+            yield from reader.iter_array()
+        else:
+            reader.decode()
+
+    if has_data or not fp.seekable():
+        return
+    fp.seek(0)
+    reader = JSONStreamReader(fp, chunk_size=chunk_size)
+    for _ in iter_object_keys(reader):
+        yield reader.decode()
+
+
+def iter_object_keys(reader: JSONStreamReader) -> Iterator[str]:
+    """
+    Yields the keys of the object at the reader's position, leaving the
+    reader at each key's value, which the caller must consume
+    """
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.pos += 1
+        return
+    while True:
+        key = reader.decode()
+        reader.expect(':')
+        yield key
+        separator = reader.peek()
+        reader.pos += 1
+        if separator == '}':
+            return
+        if separator != ',':
+            raise ValueError(f'Expected "," or "}}" at offset {reader.pos}, got {separator!r}')
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import math
+import re
+from collections import Counter
+from collections.abc import Iterable
+from typing import Optional
+
+import numpy as np
+
+# Columns of a record whose text is indexed
+TEXT_COLUMNS = ['id', 'title', 'name', 'text_to_embed']
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has',
+    'have', 'how', 'in', 'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the',
+    'this', 'to', 'was', 'were', 'what', 'which', 'with',
+}
+
+
+def tokenize(text: str) -> list[str]:
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+def get_record_text(record: dict) -> str:
+    return ' '.join(str(record[c]) for c in TEXT_COLUMNS if record.get(c) is not None)
+
+
+class LexicalIndex:
+    """
+    BM25 index over the records' ids, titles and texts, stored as numpy
+    arrays: postings are in CSR format (for each term, the documents it
+    appears in and its frequency in each), so a query only touches the
+    postings of its own terms. Documents are referred to by position,
+    with `ids` and `types` holding each document's `id` and `type`.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        types: np.ndarray,
+        terms: np.ndarray,
+        indptr: np.ndarray,
+        doc_indices: np.ndarray,
+        term_freqs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.ids = ids
+        self.types = types
+        self.indptr = indptr
+        self.doc_indices = doc_indices
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.term_index = {t: i for i, t in enumerate(terms.tolist())}
+        self.id_index = {str(_id).lower(): i for i, _id in enumerate(ids.tolist())}
+        self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, records: Iterable[dict], k1: float = 1.2, b: float = 0.75) -> 'LexicalIndex':
+        ids, types, doc_lengths = [], [], []
+        postings: dict[str, list[tuple[int, int]]] = {}
+        for i, record in enumerate(records):
+            ids.append(str(record.get('id')))
+            types.append(str(record.get('type') or ''))
+            tokens = tokenize(get_record_text(record))
+            doc_lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                postings.setdefault(term, []).append((i, count))
+
+        terms = sorted(postings)
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(postings[t]) for t in terms])
+        doc_indices = np.array([d for t in terms for d, _ in postings[t]], dtype=np.int32)
+        term_freqs = np.array([c for t in terms for _, c in postings[t]], dtype=np.float32)
+
+        return cls(
+            ids=np.array(ids, dtype=str),
+            types=np.array(types, dtype=str),
+            terms=np.array(terms, dtype=str),
+            indptr=indptr,
+            doc_indices=doc_indices,
+            term_freqs=term_freqs,
+            doc_lengths=np.array(doc_lengths, dtype=np.float32),
+            k1=k1,
+            b=b,
+        )
+
+    def save(self, path: str):
+        terms = sorted(self.term_index, key=self.term_index.__getitem__)
+        np.savez_compressed(
+            path,
+            ids=self.ids,
+            types=self.types,
+            terms=np.array(terms, dtype=str),
+            indptr=self.indptr,
+            doc_indices=self.doc_indices,
+            term_freqs=self.term_freqs,
+            doc_lengths=self.doc_lengths,
+            params=np.array([self.k1, self.b]),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'LexicalIndex':
+        with np.load(path, allow_pickle=False) as data:
+            k1, b = data['params'].tolist()
+            return cls(
+                ids=data['ids'],
+                types=data['types'],
+                terms=data['terms'],
+                indptr=data['indptr'],
+                doc_indices=data['doc_indices'],
+                term_freqs=data['term_freqs'],
+                doc_lengths=data['doc_lengths'],
+                k1=k1,
+                b=b,
+            )
+
+    def search(
+        self,
+        query: str,
+        num_results: int = 10,
+        datatype: Optional[str] = None,
+    ) -> list[tuple[str, float]]:
+        """Returns the (id, BM25 score) of the best matching documents"""
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        num_docs = len(self.ids)
+        for term in set(tokenize(query)):
+            i = self.term_index.get(term)
+            if i is None:
+                continue
+            start, end = self.indptr[i], self.indptr[i + 1]
+            docs = self.doc_indices[start:end]
+            freqs = self.term_freqs[start:end]
+            idf = math.log(1 + (num_docs - (end - start) + 0.5) / ((end - start) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avg_doc_length)
+            scores[docs] += idf * freqs * (self.k1 + 1) / (freqs + norm)
+
+        if datatype:
+            scores[self.types != datatype] = 0
+
+        matches = np.flatnonzero(scores)
+        if len(matches) > num_results:
+            matches = matches[np.argpartition(-scores[matches], num_results - 1)[:num_results]]
+        matches = matches[np.argsort(-scores[matches])]
+        return [(str(self.ids[i]), float(scores[i])) for i in matches]
+
+    def lookup_ids(self, query: str, datatype: Optional[str] = None) -> list[str]:
+        """
+        If the query consists only of ids (eg: project codes, or dataset
+        unique ids), case insensitively, returns them (those of type
+        `datatype`, if given), otherwise returns an empty list. Ids within
+        a longer query are matched by `search`.
+        """
+        parts = [p for p in re.split(r'[\s,;]+', query.strip()) if p]
+        rows = [self.id_index.get(p.lower()) for p in parts]
+        if not rows or None in rows:
+            return []
+        return [
+            str(self.ids[i])
+            for i in dict.fromkeys(rows)
+            if not datatype or self.types[i] == datatype  # type: ignore
+        ]
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[tuple[str, float]]:
+    """
+    Merges several rankings (lists of ids, best first) into one, scoring
+    each id by the sum of 1 / (k + rank) over the rankings it appears in
+    """
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, _id in enumerate(ranking, start=1):
+            scores[_id] = scores.get(_id, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
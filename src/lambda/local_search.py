@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import json
+import os
+from typing import Optional
+
+import numpy as np
+import pyarrow as pa
+from quantization import quantize
+from quantization import score
+
+VECTORS_FILE = 'vectors.npy'
+METADATA_FILE = 'metadata.arrow'
+MANIFEST_FILE = 'index.json'
+SCALES_FILE = 'scales.npy'
+RESCORE_VECTORS_FILE = 'rescore_vectors.npy'
+
+
+# Returns the names of the index's files, according to its manifest
+def get_index_files(manifest: dict) -> list[str]:
+    files = [VECTORS_FILE, METADATA_FILE]
+    if manifest.get('scales'):
+        files.append(SCALES_FILE)
+    if manifest.get('rescore_dtype'):
+        files.append(RESCORE_VECTORS_FILE)
+    return files
+
+
+def write_index(
+    directory: str,
+    vectors: np.ndarray,
+    metadata: pa.Table,
+    dtype: str = 'float32',
+    rescore_dtype: Optional[str] = None,
+) -> list[str]:
+    """
+    Writes an index of the (L2 normalized) `vectors`, in the `dtype`
+    storage format (see `quantization.DTYPES`), and the rows of
+    `metadata`, in the same order, to `directory`. With `rescore_dtype`,
+    the vectors are also written in that (float) format. Returns the names
+    of the written files, the manifest last, so that, when uploaded in
+    order, it never describes files that haven't been uploaded yet.
+    """
+    quantized, scales = quantize(vectors, dtype)
+    manifest = {
+        'dtype': dtype,
+        'dimensions': vectors.shape[1],
+        'scales': scales is not None,
+        'rescore_dtype': rescore_dtype,
+    }
+
+    np.save(os.path.join(directory, VECTORS_FILE), quantized)
+    if scales is not None:
+        np.save(os.path.join(directory, SCALES_FILE), scales)
+    if rescore_dtype:
+        np.save(os.path.join(directory, RESCORE_VECTORS_FILE), vectors.astype(rescore_dtype))
+    with pa.OSFile(os.path.join(directory, METADATA_FILE), 'wb') as sink:
+        with pa.ipc.new_file(sink, metadata.schema) as writer:
+            writer.write_table(metadata)
+    with open(os.path.join(directory, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+
+    return get_index_files(manifest) + [MANIFEST_FILE]
+
+
+class LocalSearchIndex:
+    """
+    In-memory alternative to searching the LanceDB table in S3. Vectors are
+    stored, L2 normalized, as a single (memory mapped) matrix, so a cosine
+    search is a single matrix-vector product. The vectors may be quantized
+    (int8 or binary, see `quantization.py`), in which case, if the index
+    has them, the best `rescore_factor` times more matches than requested
+    are re-scored with float vectors. Metadata is stored as an Arrow IPC
+    file and only the matching rows are read.
+    """
+
+    def __init__(self, directory: str, rescore_factor: int = 4):
+        manifest_path = os.path.join(directory, MANIFEST_FILE)
+        # Indices exported before quantization was supported have no manifest
+        self.manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        self.dtype = self.manifest.get('dtype', 'float32')
+        self.rescore_factor = rescore_factor
+
+        self.vectors = np.load(os.path.join(directory, VECTORS_FILE), mmap_mode='r')
+        self.scales = (
+            np.load(os.path.join(directory, SCALES_FILE))
+            if self.manifest.get('scales')
+            else None
+        )
+        self.rescore_vectors = (
+            np.load(os.path.join(directory, RESCORE_VECTORS_FILE), mmap_mode='r')
+            if self.manifest.get('rescore_dtype')
+            else None
+        )
+        self.metadata = pa.ipc.open_file(
+            pa.memory_map(os.path.join(directory, METADATA_FILE)),
+        ).read_all()
+
+        # Precompute a row mask per type, for prefiltered searches
+        types = np.array(self.metadata.column('type').to_pylist(), dtype=object)
+        self.type_masks = {t: types == t for t in set(types) if t is not None}
+
+        # Row of each id, for lookups by id
+        self.id_rows = {str(_id): i for i, _id in enumerate(self.metadata.column('id').to_pylist())}
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def get(self, ids: list[str], columns: Optional[list[str]] = None) -> list[dict]:
+        """Returns the rows with the given ids (in the same order)"""
+        rows = [self.id_rows[_id] for _id in ids if _id in self.id_rows]
+        metadata = self.metadata
+        if columns:
+            metadata = metadata.select([c for c in columns if c in metadata.column_names])
+        return [
+            {k: v for k, v in row.items() if v is not None}
+            for row in metadata.take(pa.array(rows, type=pa.int64())).to_pylist()
+        ]
+
+    def search(
+        self,
+        vector: list[float],
+        num_results: int = 5,
+        datatype: Optional[str] = None,
+        columns: Optional[list[str]] = None,
+    ) -> list[dict]:
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query)
+
+        scores = score(
+            self.vectors,
+            self.dtype,
+            query,
+            self.scales,
+            dimensions=self.manifest.get('dimensions'),
+        )
+
+        if datatype:
+            mask = self.type_masks.get(datatype)
+            if mask is None:
+                return []
+            scores = np.where(mask, scores, -np.inf)
+            num_results = min(num_results, int(mask.sum()))
+
+        num_results = min(num_results, len(scores))
+        if num_results <= 0:
+            return []
+
+        # Only the top k scores need to be sorted. With quantized vectors,
+        # more candidates are selected, and re-scored exactly
+        num_candidates = num_results
+        if self.rescore_vectors is not None:
+            num_candidates = min(num_results * self.rescore_factor, int(np.isfinite(scores).sum()))
+        top = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+        if self.rescore_vectors is not None:
+            # Sorted, so that the memory mapped rows are read in order
+            top = np.sort(top)
+            scores[top] = np.asarray(self.rescore_vectors[top], dtype=np.float32) @ query
+            top = top[np.argsort(-scores[top])][:num_results]
+        else:
+            top = top[np.argsort(-scores[top])]
+
+        metadata = self.metadata
+        if columns:
+            metadata = metadata.select([c for c in columns if c in metadata.column_names])
+        rows = metadata.take(pa.array(top)).to_pylist()
+        # Same shape as LanceDB results: non-null columns, and the cosine
+        # distance under `_distance`
+        return [
+            {
+                **{k: v for k, v in row.items() if v is not None},
+                '_distance': float(1 - scores[i]),
+            }
+            for row, i in zip(rows, top)
+        ]
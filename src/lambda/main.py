@@ -1,28 +1,71 @@
 from __future__ import annotations
 
-import json
-import os
+import time
 
-import boto3
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from mangum import Mangum
-from models import Prompt
-from openai import OpenAI
+# Set before the other imports, so that their cost is included
+MODULE_INIT_STARTED = time.perf_counter()
+
+import asyncio  # noqa: E402
+import hashlib  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import re  # noqa: E402
+from functools import lru_cache  # noqa: E402
+from typing import Optional  # noqa: E402
+
+from admission import RunActiveError  # noqa: E402
+from admission import RunAdmission  # noqa: E402
+from cache import TTLCache  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from fastapi import Header  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+from fastapi import Query  # noqa: E402
+from fastapi import Response  # noqa: E402
+from fastapi.middleware.cors import CORSMiddleware  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.responses import StreamingResponse  # noqa: E402
+from job_queue import get_job_queue  # noqa: E402
+from job_queue import Job  # noqa: E402
+from mangum import Mangum  # noqa: E402
+from models import Prompt  # noqa: E402
+from timing import timed  # noqa: E402
 
 # LOAD ENV VARS
 # TODO: migrate this to Pydantic.BaseSettings (see utils/config.py)
 # Ideally import for a shared location to avoid code duplication
 OPENAI_ASSISTANT_ID = os.environ['OPENAI_ASSISTANT_ID']
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
-THREAD_RUNNER_LAMBDA_ARN = os.environ['THREAD_RUNNER_LAMBDA_ARN']
 STAGE = os.environ['STAGE']
 
+# How runs are handed over to the thread runner: `lambda` (an async
+# invocation of the thread runner Lambda per run), `sqs` (a message on the
+# thread run queue, processed by the thread runner Lambda in batches),
+# `sqlite` (a local queue, processed by `python worker.py`) or `memory`
+# (a queue processed by a worker in this process, for local development)
+THREAD_RUN_DISPATCH = os.environ.get('THREAD_RUN_DISPATCH', 'lambda')
+THREAD_RUNNER_LAMBDA_ARN = os.environ.get('THREAD_RUNNER_LAMBDA_ARN')
 
-FRONTEND_DOMAIN = os.environ.get('FRONTEND_DOMAIN')
+# Size of the OpenAI client's connection pool, ie: the number of requests
+# to OpenAI that can be in flight at once across all concurrent users
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', 100))
 
+# Pages of messages are cached (per thread, per container) for this many
+# seconds, so that repeated polls of an unchanged thread don't call OpenAI
+MESSAGES_CACHE_TTL = float(os.environ.get('MESSAGES_CACHE_TTL', 2))
+MESSAGES_CACHE_SIZE = int(os.environ.get('MESSAGES_CACHE_SIZE', 1024))
+
+# How long a new message waits for the thread's active run to finish,
+# before a 409 is returned. API Gateway times out requests after 30 seconds
+ADMISSION_WAIT_TIMEOUT = float(os.environ.get('ADMISSION_WAIT_TIMEOUT', 20))
+
+# The streaming endpoint hands the run over to the thread runner (and
+# sends a `dispatched` event) once it's been streaming for this many
+# seconds, before API Gateway (after 30 seconds) or the Lambda (see
+# `app.py`) cut the connection
+STREAM_MAX_DURATION = float(os.environ.get('STREAM_MAX_DURATION', 25))
+
+FRONTEND_DOMAIN = os.environ.get('FRONTEND_DOMAIN')
 
-_lambda = boto3.client('lambda')
 
 app = FastAPI(root_path=f'/api/{STAGE}')
 
@@ -36,56 +79,436 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=['*'],
     allow_headers=['*'],
+    # Read by the frontend when polling for messages
+    expose_headers=['ETag', 'X-Has-More'],
 )
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+
+# Clients are created on first use (boto3 and openai are only imported
+# then), so that cold starts of requests that don't need them, such as
+# the healthcheck, don't pay for them. The OpenAI client is async, with
+# a single connection pool shared by all requests, so that a worker
+# doesn't block on any of the calls it makes
+@lru_cache(maxsize=None)
+def get_client():
+    with timed('OpenAI client init'):
+        import httpx
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                ),
+            ),
+        )
+
+
+@lru_cache(maxsize=None)
+def get_lambda_client():
+    with timed('Lambda client init'):
+        import boto3
+
+        return boto3.client('lambda')
+
+
+@lru_cache(maxsize=None)
+def get_thread_run_queue():
+    with timed('Thread run queue init'):
+        return get_job_queue(THREAD_RUN_DISPATCH)
+
+
+# Function to create (ahead of a dispatch) the client it needs
+def get_dispatch_client():
+    return get_lambda_client() if THREAD_RUN_DISPATCH == 'lambda' else get_thread_run_queue()
+
+
+# Function to hand a run over to the thread runner, which submits the
+# outputs of its tool calls until it's done
+def dispatch_thread_run(thread_id: str, run_id: str):
+    if THREAD_RUN_DISPATCH == 'lambda':
+        get_lambda_client().invoke(
+            FunctionName=THREAD_RUNNER_LAMBDA_ARN,
+            InvocationType='Event',
+            Payload=json.dumps({'thread_id': thread_id, 'run_id': run_id}).encode('utf-8'),
+        )
+    else:
+        get_thread_run_queue().put(Job(thread_id, run_id))
+
+
+@app.on_event('startup')
+async def start_worker():
+    # Not run by Mangum (lifespan events are off), only when running with
+    # Uvicorn, which is when the `memory` backend is meant to be used
+    if THREAD_RUN_DISPATCH == 'memory':
+        import thread_runner
+        from worker import run_worker
+
+        app.state.worker = asyncio.create_task(
+            run_worker(get_thread_run_queue(), thread_runner.process_thread_run),
+        )
+
+
+# Cached pages of messages, by thread id and query parameters, each with
+# its own expiry. The keys of each thread's pages are kept (for as long as
+# its latest page), so that a thread's pages are all dropped whenever a
+# message is added to it
+messages_cache = TTLCache(maxsize=MESSAGES_CACHE_SIZE, ttl=MESSAGES_CACHE_TTL)
+messages_cache_keys = TTLCache(maxsize=MESSAGES_CACHE_SIZE, ttl=MESSAGES_CACHE_TTL)
+
+
+def delete_cached_messages(thread_id: str):
+    for key in messages_cache_keys.get(thread_id) or ():
+        messages_cache.delete(key)
+    messages_cache_keys.delete(thread_id)
 
 
 @app.get('/healthcheck')
-def healthcheck():
+async def healthcheck():
     return {'status': 'running'}
 
 
 @app.post('/threads')
-def create_thread():
-    thread = client.beta.threads.create()
+async def create_thread():
+    thread = await get_client().beta.threads.create()
     return thread
 
 
+# OpenAI refuses to start a run on (or add messages to) a thread with an
+# active run with a 400, whose message names the active run
+ACTIVE_RUN_ERROR = re.compile(r'active run (run_\w+)|(run_\w+) is active')
+
+
+# Function to create a run for the messages, which are added to the
+# thread (in order) only if the run is created, so that a message is
+# never added without its run. Raises RunActiveError if the thread has an
+# active run, eg: started by another container
+async def create_run(thread_id: str, messages: list[str], metadata: dict, **kwargs):
+    from openai import BadRequestError
+
+    try:
+        run = await get_client().beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=OPENAI_ASSISTANT_ID,
+            additional_messages=[{'role': 'user', 'content': message} for message in messages],
+            metadata=metadata,
+            **kwargs,
+        )
+    except BadRequestError as e:
+        match = ACTIVE_RUN_ERROR.search(str(e))
+        if match is None:
+            raise
+        raise RunActiveError(match.group(1) or match.group(2)) from e
+    delete_cached_messages(thread_id)
+    return run
+
+
+# Function to add the (coalesced) messages of a thread to it, and start
+# a run for them, used by `admission`
+async def start_run(thread_id: str, messages: list[str], metadata: dict) -> dict:
+    # The dispatch client is created in the background while the run is
+    # being created, rather than after it
+    dispatch_client = asyncio.create_task(asyncio.to_thread(get_dispatch_client))
+
+    run = await create_run(thread_id, messages, metadata)
+
+    await dispatch_client
+    # boto3 has no async API, but its clients are thread-safe, so the
+    # (short) dispatch call runs in a thread rather than on the event loop
+    await asyncio.to_thread(dispatch_thread_run, thread_id, run.id)
+
+    return run.model_dump(mode='json')
+
+
+async def get_latest_run(thread_id: str) -> Optional[dict]:
+    # Only the latest run of a thread can be active
+    runs = await get_client().beta.threads.runs.list(thread_id=thread_id, limit=1)
+    return runs.data[0].model_dump(mode='json') if runs.data else None
+
+
+admission = RunAdmission(
+    start_run=start_run,
+    get_latest_run=get_latest_run,
+    wait_timeout=ADMISSION_WAIT_TIMEOUT,
+)
+
+
 @app.post('/threads/{thread_id}/messages')
-def create_message(thread_id: str, prompt: Prompt):
+async def create_message(thread_id: str, prompt: Prompt):
+    """
+    Adds the message to the thread and starts a run for it, or returns the
+    run already started for the same `prompt.run_id` (an idempotency key
+    generated by the client, so that retries don't start duplicate runs).
+    If the thread has an active run, the message waits for it to finish,
+    together with any other message sent in the meantime, which all go in
+    the same (next) run. Returns a 409 if the active run doesn't finish
+    within `ADMISSION_WAIT_TIMEOUT` seconds.
+    """
+    try:
+        return await admission.submit(thread_id, prompt.message, idempotency_key=prompt.run_id)
+    except RunActiveError as e:
+        raise HTTPException(
+            status_code=409,
+            detail={'message': 'The thread has an active run', 'run_id': e.run_id},
+        )
 
-    client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role='user',
-        content=prompt.message,
+
+# Formats a single Server-Sent Event
+def sse(event: str, data: dict) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, default=str)}\n\n'
+
+
+async def stream_run_events(thread_id: str, stream, run: Optional[dict] = None):
+    """
+    Forwards the events of an assistant run as Server-Sent Events:
+    - `run`: the run's status changed
+    - `delta`: a chunk of the assistant's response text
+    - `tool_calls`: the tools the assistant requested, before they're run
+    - `tool_output`: a tool call completed (or failed)
+    - `done`: the run completed, failed, was cancelled or expired
+    - `dispatched`: the run was handed over to the thread runner, the
+      client should poll its status
+    Tool calls are run here (with the thread runner's functions) and their
+    outputs submitted with streaming, so the run's events keep flowing in
+    the same response. If the client disconnects, the stream reaches
+    STREAM_MAX_DURATION or OpenAI ends it before the run is done, the run
+    is dispatched to the thread runner to finish it. `run` is the run as of the events already
+    read from the stream, if any.
+    """
+    # Only imported here: the thread runner's dependencies are only needed
+    # once a run requires action
+    import thread_runner
+
+    done_statuses = thread_runner.RUN_STOP_STATUSES - {'requires_action'}
+    deadline = time.monotonic() + STREAM_MAX_DURATION
+    run_id: Optional[str] = None
+    status: Optional[str] = None
+    timed_out = False
+    try:
+        if run is not None:
+            run_id, status = run['id'], run['status']
+            yield sse('run', {'run_id': run_id, 'status': status})
+
+        while stream is not None:
+            required_action = None
+            try:
+                events = aiter(stream)
+                while True:
+                    try:
+                        event = await asyncio.wait_for(anext(events), deadline - time.monotonic())
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        timed_out = True
+                        break
+
+                    if event.event.startswith('thread.run.') and not event.event.startswith(
+                        'thread.run.step.',
+                    ):
+                        run_id, status = event.data.id, event.data.status
+                        yield sse('run', {'run_id': run_id, 'status': status})
+                        if status == 'requires_action':
+                            required_action = event.data.required_action
+
+                    elif event.event == 'thread.message.completed':
+                        delete_cached_messages(thread_id)
+
+                    elif event.event == 'thread.message.delta':
+                        for content in event.data.delta.content or []:
+                            if content.type == 'text' and content.text and content.text.value:
+                                yield sse(
+                                    'delta',
+                                    {'message_id': event.data.id, 'text': content.text.value},
+                                )
+            finally:
+                await stream.close()
+
+            stream = None
+            if required_action is not None and not timed_out:
+                tool_calls = required_action.submit_tool_outputs.tool_calls
+                yield sse(
+                    'tool_calls',
+                    {
+                        'tool_calls': [
+                            {'id': t.id, 'name': t.function.name, 'arguments': t.function.arguments}
+                            for t in tool_calls
+                        ],
+                    },
+                )
+                # The tool functions are blocking, so they run (concurrently,
+                # on the thread runner's executor) outside of the event loop.
+                # If they don't complete in time, the thread runner runs them
+                # again
+                failed: set[str] = set()
+                try:
+                    tool_outputs = await asyncio.wait_for(
+                        asyncio.to_thread(thread_runner.execute_tool_calls, thread_id, tool_calls, failed),
+                        deadline - time.monotonic(),
+                    )
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    break
+                for output in tool_outputs:
+                    yield sse(
+                        'tool_output',
+                        {
+                            'tool_call_id': output['tool_call_id'],
+                            'error': output['tool_call_id'] in failed,
+                        },
+                    )
+                stream = await get_client().beta.threads.runs.submit_tool_outputs(
+                    thread_id=thread_id,
+                    run_id=run_id,
+                    tool_outputs=tool_outputs,
+                    stream=True,
+                )
+
+        if status in done_statuses:
+            yield sse('done', {'run_id': run_id, 'status': status})
+        else:
+            # Either out of time, or OpenAI ended the stream before the
+            # run was done. The thread runner finishes it (see below)
+            if timed_out:
+                print(f'Stream of run {run_id} reached {STREAM_MAX_DURATION}s')
+            yield sse('dispatched', {'run_id': run_id, 'status': status})
+
+    finally:
+        if run_id is not None and status not in done_statuses:
+            # The client went away (or the stream failed) mid-run: hand
+            # the run over to the thread runner. This is a blocking call
+            # since the generator may be being cancelled
+            print(f'Stream of run {run_id} ended with status {status}, dispatching to the thread runner')
+            dispatch_thread_run(thread_id, run_id)
+
+
+@app.post('/threads/{thread_id}/messages/stream')
+async def create_message_stream(thread_id: str, prompt: Prompt):
+    """
+    Same as `create_message` (including its admission control), but rather
+    than starting the thread runner and returning the run, streams the
+    run's events (see `stream_run_events`) until it's done, so that the
+    client neither polls nor waits for the whole run to see the response.
+    The message gets a run of its own. Only the request that started the
+    run can stream it: a retry gets the run's `run` and `dispatched` events.
+    """
+    started: dict = {}
+
+    async def start_run_stream(thread_id: str, messages: list[str], metadata: dict) -> dict:
+        stream = await create_run(thread_id, messages, metadata, stream=True)
+        # The first event is the run's creation
+        try:
+            event = await anext(stream)
+        except BaseException:
+            await stream.close()
+            raise
+        started['stream'] = stream
+        return event.data.model_dump(mode='json')
+
+    try:
+        run = await admission.submit(
+            thread_id,
+            prompt.message,
+            idempotency_key=prompt.run_id,
+            start_run=start_run_stream,
+        )
+    except RunActiveError as e:
+        raise HTTPException(
+            status_code=409,
+            detail={'message': 'The thread has an active run', 'run_id': e.run_id},
+        )
+
+    async def retried_run_events():
+        yield sse('run', {'run_id': run['id'], 'status': run['status']})
+        yield sse('dispatched', {'run_id': run['id'], 'status': run['status']})
+
+    return StreamingResponse(
+        stream_run_events(thread_id, started['stream'], run) if 'stream' in started else retried_run_events(),
+        media_type='text/event-stream',
+        # Proxies must not buffer the events
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
     )
 
-    # TODO: check for any active runs first
-    run = client.beta.threads.runs.create(
+
+async def list_messages(thread_id: str, params: dict) -> dict:
+    """
+    Returns a page of the thread's messages (as JSON serializable dicts),
+    the page's ETag and whether there are more messages, from the cache
+    if possible.
+    """
+    key = f'{thread_id}:{json.dumps(params, sort_keys=True)}'
+    cached: Optional[dict] = messages_cache.get(key)
+    if cached is not None:
+        return cached
+
+    messages = await get_client().beta.threads.messages.list(
         thread_id=thread_id,
-        assistant_id=OPENAI_ASSISTANT_ID,
+        **{k: v for k, v in params.items() if v is not None},
     )
+    data = [m.model_dump(mode='json') for m in messages.data]
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    page = {
+        'data': data,
+        'etag': f'"{digest[:32]}"',
+        'has_more': messages.has_more,
+    }
+    messages_cache.set(key, page)
+    messages_cache_keys.set(thread_id, {*(messages_cache_keys.get(thread_id) or ()), key})
+    return page
 
-    # TODO: invoke thread_run_handler lambda
-    _lambda.invoke(
-        FunctionName=THREAD_RUNNER_LAMBDA_ARN,
-        InvocationType='Event',
-        Payload=json.dumps({'thread_id': thread_id, 'run_id': run.id}).encode('utf-8'),
-    )
 
-    return run
+@app.get('/threads/{thread_id}/messages')
+async def get_messages(
+    thread_id: str,
+    limit: int = Query(20, ge=1, le=100),
+    order: str = Query('desc', pattern='^(asc|desc)$'),
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    since: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    Returns a page of the thread's messages, newest first by default.
+    Pages are navigated with the `after`/`before` cursors (message ids),
+    and `since` returns only the messages added after the given message,
+    oldest first. Whether there are more messages is returned in the
+    `X-Has-More` header. The response has an ETag: if it matches the
+    `If-None-Match` header, a 304 (with no body) is returned instead.
+    """
+    if since is not None:
+        if after is not None or before is not None:
+            raise HTTPException(status_code=400, detail='`since` cannot be used with `after`/`before`')
+        order, after = 'asc', since
 
+    page = await list_messages(
+        thread_id,
+        {'limit': limit, 'order': order, 'after': after, 'before': before},
+    )
 
-@app.get('/threads/{thread_id}/messages')
-def get_messages(thread_id: str):
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
-    return messages.data
+    headers = {
+        'ETag': page['etag'],
+        'Cache-Control': 'no-cache',
+        'X-Has-More': 'true' if page['has_more'] else 'false',
+    }
+    if if_none_match is not None and page['etag'] in [t.strip() for t in if_none_match.split(',')]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=page['data'], headers=headers)
 
 
 @app.get('/threads/{thread_id}/runs/{run_id}/status')
-def get_run_status(run_id: str, thread_id: str):
-    run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+async def get_run_status(run_id: str, thread_id: str):
+    run = await get_client().beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
     return {'status': run.status}
 
 
 handler = Mangum(app, lifespan='off')
+
+print(f'main module initialized in {(time.perf_counter() - MODULE_INIT_STARTED) * 1000:.0f} ms')
+
+if __name__ == '__main__':
+    # Run locally, or in a container, with a single async worker:
+    # python main.py
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+
+# Storage formats of L2 normalized vectors, and their size per dimension:
+# - float32: 4 bytes, exact
+# - float16: 2 bytes, near exact
+# - int8: 1 byte, each vector scaled so its largest component is 127
+#   (the scale is stored, as float32, alongside the vectors)
+# - binary: 1 bit, the sign of each component, compared with the hamming
+#   distance, which approximates the angle between vectors
+DTYPES = ['float32', 'float16', 'int8', 'binary']
+
+# Rows scored at once, bounding the size of temporary (float32) arrays
+CHUNK_SIZE = 65536
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Returns the (L2 normalized) `vectors` in the `dtype` storage format,
+    and the per vector scales (int8 only)
+    """
+    if dtype in ('float32', 'float16'):
+        return vectors.astype(dtype), None
+    if dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+    if dtype == 'binary':
+        return np.packbits(vectors > 0, axis=1), None
+    raise ValueError(f'Unknown vector dtype: {dtype}')
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return np.unpackbits(x[..., None], axis=-1).sum(axis=-1, dtype=np.uint8)
+
+
+def score(
+    vectors: np.ndarray,
+    dtype: str,
+    query: np.ndarray,
+    scales: Optional[np.ndarray] = None,
+    dimensions: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Returns the (approximate, unless `dtype` is float32) cosine similarity
+    of the L2 normalized `query` (float32) with each of the quantized
+    `vectors`. Binary vectors need the number of (unpacked) `dimensions`.
+    """
+    scores = np.empty(vectors.shape[0], dtype=np.float32)
+
+    if dtype == 'binary':
+        query_bits = np.packbits(query > 0)
+        dimensions = dimensions or len(query)
+        for start in range(0, vectors.shape[0], CHUNK_SIZE):
+            chunk = np.asarray(vectors[start: start + CHUNK_SIZE])
+            distances = _popcount(np.bitwise_xor(chunk, query_bits)).sum(axis=1)
+            scores[start: start + CHUNK_SIZE] = 1 - 2 * distances / dimensions
+        return scores
+
+    for start in range(0, vectors.shape[0], CHUNK_SIZE):
+        chunk = np.asarray(vectors[start: start + CHUNK_SIZE], dtype=np.float32)
+        scores[start: start + CHUNK_SIZE] = chunk @ query
+    if dtype == 'int8':
+        scores *= scales
+    return scores
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+from typing import Optional
+
+# Fields of a search result that make up the passage scored by the model
+PASSAGE_FIELDS = ['title', 'name', 'description', 'summary', 'text_to_embed']
+
+
+def get_passage(result: dict) -> str:
+    return '\n'.join(
+        str(result[f]) for f in PASSAGE_FIELDS if isinstance(result.get(f), str) and result[f]
+    )
+
+
+class Reranker:
+    """
+    Reorders search results by the relevance of their text to the query,
+    according to a small cross-encoder, run on CPU with ONNX runtime by
+    `flashrank` (an optional dependency, imported when a reranker is
+    created). Scoring a passage with a cross-encoder is slower than
+    comparing vectors, but more precise, so only the top candidates of
+    the search are reranked.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str, max_length: int = 256):
+        from flashrank import Ranker
+
+        self.ranker = Ranker(model_name=model_name, cache_dir=cache_dir, max_length=max_length)
+
+    def rerank(self, query: str, results: list[dict], num_results: Optional[int] = None) -> list[dict]:
+        from flashrank import RerankRequest
+
+        passages = [{'id': i, 'text': get_passage(r)} for i, r in enumerate(results)]
+        ranked = self.ranker.rerank(RerankRequest(query=query, passages=passages))
+        return [results[p['id']] for p in ranked][:num_results]
@@ -1,92 +1,657 @@
 from __future__ import annotations
 
-import json
-import os
 import time
-from typing import Optional
 
-import lancedb
-import requests
-from openai import OpenAI
+# Set before the other imports, so that their cost is included
+MODULE_INIT_STARTED = time.perf_counter()
+
+import concurrent.futures  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import re  # noqa: E402
+import tempfile  # noqa: E402
+import threading  # noqa: E402
+from collections.abc import Callable  # noqa: E402
+from functools import lru_cache  # noqa: E402
+from functools import wraps  # noqa: E402
+from typing import Any  # noqa: E402
+from typing import Optional  # noqa: E402
+from urllib.parse import urlencode  # noqa: E402
+
+import httpx  # noqa: E402
+import orjson  # noqa: E402
+from cache import FileCacheBackend  # noqa: E402
+from cache import ResponseCache  # noqa: E402
+from cache import TTLCache  # noqa: E402
+from data_files import detect_format  # noqa: E402
+from data_files import summarize_file  # noqa: E402
+from http_client import HttpClient  # noqa: E402
+from job_queue import Job  # noqa: E402
+from openai import APIError  # noqa: E402
+from openai import OpenAI  # noqa: E402
+from requests import HTTPError  # noqa: E402
+from reranker import PASSAGE_FIELDS  # noqa: E402
+from timing import timed  # noqa: E402
+
+# Heavy libraries (lancedb, numpy, pyarrow, tiktoken, boto3) are imported
+# lazily, by the accessors that need them, so that cold starts only pay
+# for what an invocation actually uses
 
 # TODO: import this from a shared location (with main.py)
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
 OPENAI_EMBEDDING_MODEL = os.environ['OPENAI_EMBEDDING_MODEL']
+# Must match the dimensions of the table's embeddings (0 for the full size)
+OPENAI_EMBEDDING_DIMENSIONS = int(os.environ.get('OPENAI_EMBEDDING_DIMENSIONS', 0))
 LANCEDB_DATA_PATH = os.environ.get('LANCEDB_DATA_PATH')
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get('QUERY_EMBEDDING_CACHE_SIZE', 1024))
+QUERY_EMBEDDING_CACHE_TTL = int(os.environ.get('QUERY_EMBEDDING_CACHE_TTL', 24 * 60 * 60))
+# Optional directory for a second cache tier, shared across invocations
+# of a warm container (eg: /tmp/...) or across containers (eg: an EFS mount)
+QUERY_EMBEDDING_CACHE_DIR = os.environ.get('QUERY_EMBEDDING_CACHE_DIR')
+# Vector index search parameters: more probes/refinement trade latency for
+# recall (see `vector_database.benchmark_index`). These are ignored until
+# the table has a vector index
+LANCEDB_NPROBES = int(os.environ.get('LANCEDB_NPROBES', 20))
+LANCEDB_REFINE_FACTOR = int(os.environ.get('LANCEDB_REFINE_FACTOR', 0)) or None
+# `lancedb` searches the table in S3, `numpy` searches an in-memory copy
+# of the vectors (see `utils/vector_database.export_local_index`)
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'lancedb')
+LOCAL_INDEX_PATH = os.environ.get('LOCAL_INDEX_PATH', 'app_data/local_index')
+LOCAL_INDEX_DIR = '/tmp/local_index'
+# With a quantized local index, this many times more matches than needed
+# are re-scored with float vectors (if the index has them)
+LOCAL_INDEX_RESCORE_FACTOR = int(os.environ.get('LOCAL_INDEX_RESCORE_FACTOR', 4))
+# Hybrid search: a BM25 index (see `utils/vector_database.build_lexical_index`)
+# is searched alongside the vectors, and both rankings are merged with
+# reciprocal rank fusion. Queries consisting only of ids skip the embedding
+HYBRID_SEARCH = os.environ.get('HYBRID_SEARCH', 'true').lower() == 'true'
+LEXICAL_INDEX_PATH = os.environ.get('LEXICAL_INDEX_PATH', 'app_data/lexical_index.npz')
+LEXICAL_INDEX_FILE = '/tmp/lexical_index.npz'
+# Number of results of each ranking that are merged
+HYBRID_SEARCH_CANDIDATES = int(os.environ.get('HYBRID_SEARCH_CANDIDATES', 20))
+RRF_K = int(os.environ.get('RRF_K', 60))
+# Optional reranking of the top RERANK_CANDIDATES search results with a
+# local cross-encoder (requires `flashrank`). Searches return the search
+# order as is when reranking takes longer than RERANK_TIME_BUDGET_MS
+RERANK_ENABLED = os.environ.get('RERANK_ENABLED', 'false').lower() == 'true'
+RERANK_MODEL = os.environ.get('RERANK_MODEL', 'ms-marco-TinyBERT-L-2-v2')
+RERANK_CANDIDATES = int(os.environ.get('RERANK_CANDIDATES', 50))
+RERANK_TIME_BUDGET_MS = float(os.environ.get('RERANK_TIME_BUDGET_MS', 300))
+RERANK_CACHE_DIR = os.environ.get('RERANK_CACHE_DIR', '/tmp/flashrank')
+# Follow run events with the streaming API rather than by polling
+THREAD_RUN_STREAMING = os.environ.get('THREAD_RUN_STREAMING', 'true').lower() == 'true'
+POLL_INITIAL_DELAY = 0.1
+POLL_MAX_DELAY = 2.0
+POLL_BACKOFF_FACTOR = 1.5
+
+# Tool calls of a run step are executed concurrently (up to
+# TOOL_CALL_MAX_WORKERS at once, on a thread pool of the step's own, so
+# that the runs processed at once don't compete for workers), each within
+# this many seconds of starting
+TOOL_CALL_TIMEOUT = float(os.environ.get('TOOL_CALL_TIMEOUT', 60))
+TOOL_CALL_MAX_WORKERS = int(os.environ.get('TOOL_CALL_MAX_WORKERS', 8))
+
+# World Bank APIs used by the tool functions (can be pointed at a local
+# stub server for testing)
+WORLDBANK_SEARCH_API_URL = os.environ.get(
+    'WORLDBANK_SEARCH_API_URL',
+    'https://search.worldbank.org/api/v2',
+)
+WORLDBANK_DATA_CATALOG_API_URL = os.environ.get(
+    'WORLDBANK_DATA_CATALOG_API_URL',
+    'https://datacatalogapi.worldbank.org/ddhxext',
+)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))
+# Catalog metadata (datasets, resources, projects) responses are fresh for
+# CATALOG_CACHE_TTL seconds, then refreshed when requested, or served stale
+# if that takes more than CATALOG_CACHE_REVALIDATE_TIMEOUT seconds, for
+# CATALOG_CACHE_STALE_TTL more seconds. Not found responses are cached for
+# CATALOG_CACHE_NEGATIVE_TTL seconds
+CATALOG_CACHE_SIZE = int(os.environ.get('CATALOG_CACHE_SIZE', 1024))
+CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL', 60 * 60))
+CATALOG_CACHE_STALE_TTL = int(os.environ.get('CATALOG_CACHE_STALE_TTL', 24 * 60 * 60))
+CATALOG_CACHE_NEGATIVE_TTL = int(os.environ.get('CATALOG_CACHE_NEGATIVE_TTL', 5 * 60))
+CATALOG_CACHE_REVALIDATE_TIMEOUT = float(os.environ.get('CATALOG_CACHE_REVALIDATE_TIMEOUT', 2))
+# Optional directory for a shared second cache tier (see QUERY_EMBEDDING_CACHE_DIR)
+CATALOG_CACHE_DIR = os.environ.get('CATALOG_CACHE_DIR')
+# Data files (open_data_file/download_data_file) larger than this are
+# rejected (Lambda's /tmp storage is limited), and JSON responses smaller
+# than DATA_FILE_INLINE_MAX_BYTES are returned as is rather than summarized
+DATA_FILE_MAX_BYTES = int(os.environ.get('DATA_FILE_MAX_BYTES', 400 * 1024 * 1024))
+DATA_FILE_INLINE_MAX_BYTES = int(os.environ.get('DATA_FILE_INLINE_MAX_BYTES', 32 * 1024))
+DATA_FILE_SAMPLE_ROWS = int(os.environ.get('DATA_FILE_SAMPLE_ROWS', 10))
+DATA_FILE_UPLOAD = os.environ.get('DATA_FILE_UPLOAD', 'true').lower() == 'true'
+# Uploaded data files are attached to the run's thread (for the code
+# interpreter) and reused by calls for the same data file for
+# DATA_FILE_CACHE_TTL seconds. They're deleted DATA_FILE_UPLOAD_TTL seconds
+# after being uploaded, which must be longer than DATA_FILE_CACHE_TTL
+DATA_FILE_CACHE_SIZE = int(os.environ.get('DATA_FILE_CACHE_SIZE', 256))
+DATA_FILE_CACHE_TTL = int(os.environ.get('DATA_FILE_CACHE_TTL', 60 * 60))
+DATA_FILE_UPLOAD_TTL = int(os.environ.get('DATA_FILE_UPLOAD_TTL', 24 * 60 * 60))
+# Expired uploads are looked for at most every DATA_FILE_CLEANUP_INTERVAL seconds
+DATA_FILE_CLEANUP_INTERVAL = int(os.environ.get('DATA_FILE_CLEANUP_INTERVAL', 60 * 60))
+# Prefix of the uploaded data files' names, which tells them apart from
+# other files of the OpenAI project when cleaning up
+DATA_FILE_UPLOAD_PREFIX = 'data_file-'
+# The code interpreter accepts up to 20 files per thread
+THREAD_MAX_CODE_INTERPRETER_FILES = 20
+# Columns of the search results returned to the assistant (an empty value
+# returns all columns). Long text fields are truncated to
+# SEARCH_RESULT_MAX_TOKENS_PER_FIELD tokens (0 disables truncation). The
+# content of some records is only in `name` (datasets), `excerpt` (videos)
+# or `text_to_embed`, so these are returned too
+SEARCH_RESULT_COLUMNS = [
+    c.strip()
+    for c in os.environ.get(
+        'SEARCH_RESULT_COLUMNS',
+        'id,type,title,name,description,summary,excerpt,text_to_embed,url,link',
+    ).split(',')
+    if c.strip()
+]
+SEARCH_RESULT_MAX_TOKENS_PER_FIELD = int(os.environ.get('SEARCH_RESULT_MAX_TOKENS_PER_FIELD', 200))
+# Optional resources (the lexical index, the reranker) that fail to load
+# are loaded again on use after this many seconds, so that a transient
+# error doesn't disable them for the container's lifetime
+OPTIONAL_RESOURCE_RETRY_INTERVAL = float(os.environ.get('OPTIONAL_RESOURCE_RETRY_INTERVAL', 60))
+# Open the table (or load the local index), the OpenAI client and the
+# tokenizer while the Lambda is initializing rather than on first use
+WARM_UP_ON_INIT = os.environ.get('WARM_UP_ON_INIT', 'false').lower() == 'true'
+
+# Number of the runs of an SQS batch processed at once, by one invocation
+THREAD_RUN_BATCH_CONCURRENCY = int(os.environ.get('THREAD_RUN_BATCH_CONCURRENCY', 10))
+# The failed runs of an SQS batch are retried after this many seconds,
+# rather than after the queue's visibility timeout (an hour, see app.py),
+# by which time their runs would have expired
+THREAD_RUN_QUEUE_URL = os.environ.get('THREAD_RUN_QUEUE_URL')
+THREAD_RUN_RETRY_DELAY = int(os.environ.get('THREAD_RUN_RETRY_DELAY', 60))
+
+RUN_STOP_STATUSES = {'requires_action', 'completed', 'failed', 'cancelled', 'expired', 'incomplete'}
+# Stop statuses of runs that ended without completing, eg: `incomplete`
+# when the run hit its token limits
+RUN_FAILED_STATUSES = {'failed', 'expired', 'incomplete'}
 
 # TODO: package this as its own lambda function with it's own dockerfile
 # etc - since it doens't need FastAPI/Mangum, etc
 
-db = lancedb.connect(f's3://{BUCKET_NAME}/{LANCEDB_DATA_PATH}')
-table = db.open_table('agrifood')
-
-client = OpenAI(api_key=OPENAI_API_KEY)
+local_index_lock = threading.Lock()
+# Reranking runs outside of the tool call's thread, so that the call
+# doesn't wait for it beyond its time budget
+rerank_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+http_client = HttpClient(
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=HTTP_READ_TIMEOUT,
+    max_retries=HTTP_MAX_RETRIES,
+    # Enough connections for the tool calls of all the runs of a batch
+    # to run at once
+    pool_maxsize=TOOL_CALL_MAX_WORKERS * THREAD_RUN_BATCH_CONCURRENCY,
+)
+
+query_embedding_cache = TTLCache(
+    maxsize=QUERY_EMBEDDING_CACHE_SIZE,
+    ttl=QUERY_EMBEDDING_CACHE_TTL,
+    backend=(
+        FileCacheBackend(QUERY_EMBEDDING_CACHE_DIR)
+        if QUERY_EMBEDDING_CACHE_DIR
+        else None
+    ),
+)
+
+data_file_cache = TTLCache(maxsize=DATA_FILE_CACHE_SIZE, ttl=DATA_FILE_CACHE_TTL)
+# Serializes updates of the threads' files, which are read-modify-write
+thread_files_lock = threading.Lock()
+data_file_cleanup = {'last_run': 0.0}
+
+catalog_cache = ResponseCache(
+    maxsize=CATALOG_CACHE_SIZE,
+    ttl=CATALOG_CACHE_TTL,
+    stale_ttl=CATALOG_CACHE_STALE_TTL,
+    negative_ttl=CATALOG_CACHE_NEGATIVE_TTL,
+    revalidate_timeout=CATALOG_CACHE_REVALIDATE_TIMEOUT,
+    backend=FileCacheBackend(CATALOG_CACHE_DIR) if CATALOG_CACHE_DIR else None,
+)
+
+
+# Decorator for the accessors of optional resources, which return None if
+# the resource is unavailable: a loaded resource is kept, like with
+# lru_cache, but a failure is only kept for OPTIONAL_RESOURCE_RETRY_INTERVAL
+# seconds, after which the resource is loaded again
+def cache_optional_resource(load: Callable[[], Any]) -> Callable[[], Any]:
+    lock = threading.Lock()
+    resource = None
+    failed_at: Optional[float] = None
+
+    @wraps(load)
+    def get():
+        nonlocal resource, failed_at
+        if resource is not None:
+            return resource
+        with lock:
+            if resource is None and (
+                failed_at is None or time.monotonic() - failed_at >= OPTIONAL_RESOURCE_RETRY_INTERVAL
+            ):
+                resource = load()
+                failed_at = None if resource is not None else time.monotonic()
+        return resource
+
+    return get
+
+
+# Note: the accessors below are memoized with lru_cache, which doesn't
+# prevent concurrent first calls from both initializing the resource, in
+# which case one of the two instances is simply discarded
+@lru_cache(maxsize=None)
+def get_client():
+    with timed('OpenAI client init'):
+        return OpenAI(api_key=OPENAI_API_KEY)
+
+
+@lru_cache(maxsize=None)
+def get_table():
+    with timed('LanceDB table open'):
+        import lancedb
+
+        db = lancedb.connect(f's3://{BUCKET_NAME}/{LANCEDB_DATA_PATH}')
+        return db.open_table('agrifood')
+
+
+# Loading the encoding is expensive, so it's only done once
+@lru_cache(maxsize=None)
+def get_encoding():
+    with timed('Tokenizer init'):
+        import tiktoken
+
+        return tiktoken.get_encoding('cl100k_base')
+
+
+# Function to look up (mostly static) catalog metadata, using cached
+# responses when available. 404s are cached too, while other errors
+# aren't cached and return None, as before
+def cached_catalog_lookup(url: str, params: dict):
+    def fetch():
+        response = http_client.post(url, params=params)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        try:
+            return response.json()
+        except ValueError as e:
+            # eg: an HTML error page served with a 200, which shouldn't
+            # be cached, nor replace a cached (stale) response
+            raise HTTPError(f'Invalid JSON response from {url}', response=response) from e
+
+    key = f'{url}?{urlencode(sorted(params.items()))}'
+    try:
+        return catalog_cache.get_or_fetch(key, fetch)
+    except HTTPError:
+        return None
+    finally:
+        print(f'Catalog cache stats: {catalog_cache.stats()}')
 
 
 # TODO: adding typing to function parameters + output
 # Function to get use case details
 def get_use_case_details(use_case_id):
-    url = 'https://search.worldbank.org/api/v2/projects'
+    url = f'{WORLDBANK_SEARCH_API_URL}/projects'
     params = {'id': use_case_id}
-    response = requests.post(url, params=params)
-    return response.json() if response.status_code == 200 else None
+    return cached_catalog_lookup(url, params)
 
 
 # Function to get data details
 def get_data_details(data_unique_id):
-    url = 'https://datacatalogapi.worldbank.org/ddhxext/DatasetView'
+    url = f'{WORLDBANK_DATA_CATALOG_API_URL}/DatasetView'
     params = {'dataset_unique_id': data_unique_id}
-    response = requests.post(url, params=params)
-    return response.json() if response.status_code == 200 else None
+    return cached_catalog_lookup(url, params)
 
 
 # Function to get data file details
 def get_data_file_details(data_file_unique_id):
-    url = 'https://datacatalogapi.worldbank.org/ddhxext/ResourceView'
+    url = f'{WORLDBANK_DATA_CATALOG_API_URL}/ResourceView'
     params = {'resource_unique_id': data_file_unique_id}
-    response = requests.post(url, params=params)
-    return response.json() if response.status_code == 200 else None
+    return cached_catalog_lookup(url, params)
+
+
+# Function to fetch a (possibly very large) data file. The response is
+# streamed to disk and summarized incrementally (schema, row count,
+# column statistics and sample rows), so memory use doesn't depend on the
+# size of the file. The full file is uploaded to OpenAI's file storage,
+# for the code interpreter, and referenced by its ID in the summary.
+# Small JSON responses (eg: links or metadata) are returned as is.
+# Responses are cached by data file, so a file is only uploaded once (and
+# attached to each thread that asks for it)
+def fetch_data_file(url: str, params: dict, name: str, thread_id: Optional[str] = None):
+    key = f'{url}?{urlencode(sorted(params.items()))}'
+    result = data_file_cache.get(key)
+    if result is None:
+        result = download_and_summarize_data_file(url, params, name)
+        if result is not None and not (isinstance(result, dict) and 'error' in result):
+            data_file_cache.set(key, result)
+
+    if thread_id and isinstance(result, dict) and result.get('file_id'):
+        try:
+            attach_file_to_thread(thread_id, result['file_id'])
+        except APIError as e:
+            # The summary is still useful without the file
+            print(f'Failed to attach file {result["file_id"]} to thread {thread_id}: {e}')
+    return result
+
+
+def download_and_summarize_data_file(url: str, params: dict, name: str):
+    with http_client.post(url, params=params, stream=True) as response:
+        if response.status_code != 200:
+            return None
+        content_type = response.headers.get('content-type', '').lower()
+
+        with tempfile.NamedTemporaryFile(dir='/tmp') as f:
+            size = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > DATA_FILE_MAX_BYTES:
+                    return {'error': f'Data file is larger than {DATA_FILE_MAX_BYTES} bytes'}
+                f.write(chunk)
+            f.flush()
+
+            if size <= DATA_FILE_INLINE_MAX_BYTES and detect_format(f.name, content_type) == 'json':
+                f.seek(0)
+                return json.load(f)
+
+            summary = summarize_file(f.name, content_type, sample_size=DATA_FILE_SAMPLE_ROWS)
+            summary['size_bytes'] = size
+
+            if DATA_FILE_UPLOAD:
+                extension = {'excel': 'xlsx'}.get(summary['format'], summary['format'])
+                f.seek(0)
+                uploaded = get_client().files.create(
+                    file=(f'{DATA_FILE_UPLOAD_PREFIX}{name}.{extension}', f),
+                    purpose='assistants',
+                )
+                summary['file_id'] = uploaded.id
+
+            return summary
+
+
+# Function to make an uploaded file available to the code interpreter in
+# the thread. The oldest files are detached past the code interpreter's
+# limit of files per thread
+def attach_file_to_thread(thread_id: str, file_id: str):
+    with thread_files_lock:
+        thread = get_client().beta.threads.retrieve(thread_id)
+        resources = thread.tool_resources
+        file_ids = list(
+            resources.code_interpreter.file_ids or []
+            if resources and resources.code_interpreter
+            else [],
+        )
+        if file_id in file_ids:
+            return
+        file_ids = (file_ids + [file_id])[-THREAD_MAX_CODE_INTERPRETER_FILES:]
+        get_client().beta.threads.update(
+            thread_id,
+            tool_resources={'code_interpreter': {'file_ids': file_ids}},
+        )
+
+
+# Function to delete the data files uploaded more than DATA_FILE_UPLOAD_TTL
+# seconds ago, by any instance, at most every DATA_FILE_CLEANUP_INTERVAL
+# seconds. Runs once the invocation's runs are done, so it never delays them
+def cleanup_data_file_uploads():
+    if not DATA_FILE_UPLOAD:
+        return
+    now = time.time()
+    with thread_files_lock:
+        if now - data_file_cleanup['last_run'] < DATA_FILE_CLEANUP_INTERVAL:
+            return
+        data_file_cleanup['last_run'] = now
+
+    with timed('Data file upload cleanup'):
+        try:
+            expired = [
+                file.id
+                for file in get_client().files.list(purpose='assistants')
+                if file.filename.startswith(DATA_FILE_UPLOAD_PREFIX)
+                and file.created_at < now - DATA_FILE_UPLOAD_TTL
+            ]
+            for file_id in expired:
+                get_client().files.delete(file_id)
+        except (APIError, httpx.HTTPError) as e:
+            # Left for the next clean up
+            print(f'Failed to clean up data file uploads: {e}')
 
 
 # Function to download data file
-def download_data_file(data_file_unique_id, version_id):
-    url = 'https://datacatalogapi.worldbank.org/ddhxext/DownloadResource'
+def download_data_file(data_file_unique_id, version_id, thread_id=None):
+    url = f'{WORLDBANK_DATA_CATALOG_API_URL}/DownloadResource'
     params = {'resource_unique_id': data_file_unique_id, 'version_id': version_id}
-    response = requests.post(url, params=params)
-    return response.json() if response.status_code == 200 else None
+    return fetch_data_file(url, params, name=data_file_unique_id, thread_id=thread_id)
 
 
 # Function to open data file
-def open_data_file(data_file_unique_id):
-    url = 'https://datacatalogapi.worldbank.org/ddhxext/OpenResource'
+def open_data_file(data_file_unique_id, thread_id=None):
+    url = f'{WORLDBANK_DATA_CATALOG_API_URL}/OpenResource'
     params = {'resource_unique_id': data_file_unique_id}
-    response = requests.post(url, params=params)
-    return response.json() if response.status_code == 200 else None
+    return fetch_data_file(url, params, name=data_file_unique_id, thread_id=thread_id)
 
 
 # Function to get embeddings
 def get_embedding(text: str):
-    return (
-        client.embeddings.create(input=text, model=OPENAI_EMBEDDING_MODEL)
-        .data[0]
-        .embedding
+    params: dict = {'model': OPENAI_EMBEDDING_MODEL}
+    if OPENAI_EMBEDDING_DIMENSIONS:
+        params['dimensions'] = OPENAI_EMBEDDING_DIMENSIONS
+    return get_client().embeddings.create(input=text, **params).data[0].embedding
+
+
+# Function to get embeddings for a search query, using cached
+# embeddings for queries that have already been seen
+def get_query_embedding(query: str):
+    # Queries that only differ in case or whitespace share a cache entry
+    normalized_query = re.sub(r'\s+', ' ', query).strip().lower()
+    key = f'{OPENAI_EMBEDDING_MODEL}@{OPENAI_EMBEDDING_DIMENSIONS}:{normalized_query}'
+
+    embedding = query_embedding_cache.get(key)
+    if embedding is None:
+        embedding = get_embedding(query)
+        query_embedding_cache.set(key, embedding)
+
+    print(f'Query embedding cache stats: {query_embedding_cache.stats()}')
+    return embedding
+
+
+# Function to load the in-memory search index, once per container
+@lru_cache(maxsize=None)
+def get_local_index():
+    import boto3
+    from botocore.exceptions import ClientError
+    from local_search import get_index_files
+    from local_search import LocalSearchIndex
+    from local_search import MANIFEST_FILE
+
+    # Concurrent tool calls must not download the files at the same time
+    with local_index_lock, timed('Local index load'):
+        os.makedirs(LOCAL_INDEX_DIR, exist_ok=True)
+        s3 = boto3.client('s3')
+
+        manifest = {}
+        manifest_path = os.path.join(LOCAL_INDEX_DIR, MANIFEST_FILE)
+        try:
+            if not os.path.exists(manifest_path):
+                s3.download_file(BUCKET_NAME, f'{LOCAL_INDEX_PATH}/{MANIFEST_FILE}', manifest_path)
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except ClientError:
+            # Exported before quantization was supported: float vectors
+            print('Local index has no manifest')
+
+        for filename in get_index_files(manifest):
+            path = os.path.join(LOCAL_INDEX_DIR, filename)
+            if not os.path.exists(path):
+                s3.download_file(BUCKET_NAME, f'{LOCAL_INDEX_PATH}/{filename}', path)
+        return LocalSearchIndex(LOCAL_INDEX_DIR, rescore_factor=LOCAL_INDEX_RESCORE_FACTOR)
+
+
+# Function to load the lexical (BM25) index, once per container. Returns
+# None if it's unavailable, in which case searches are vector only
+@cache_optional_resource
+def get_lexical_index():
+    import boto3
+    from lexical_index import LexicalIndex
+
+    with local_index_lock, timed('Lexical index load'):
+        try:
+            if not os.path.exists(LEXICAL_INDEX_FILE):
+                tmp_path = f'{LEXICAL_INDEX_FILE}.tmp'
+                boto3.client('s3').download_file(BUCKET_NAME, LEXICAL_INDEX_PATH, tmp_path)
+                os.replace(tmp_path, LEXICAL_INDEX_FILE)
+            return LexicalIndex.load(LEXICAL_INDEX_FILE)
+        except Exception as e:
+            print(f'Lexical index unavailable ({e}), searching vectors only')
+            return None
+
+
+# Columns read from the search backend: the returned columns, plus the
+# id, which hybrid search uses to merge results, and, when reranking, the
+# text scored by the reranker (dropped by project_search_result)
+def get_search_columns():
+    if not SEARCH_RESULT_COLUMNS:
+        return None
+    extra_columns = ['id'] + (PASSAGE_FIELDS if RERANK_ENABLED else [])
+    return SEARCH_RESULT_COLUMNS + [c for c in extra_columns if c not in SEARCH_RESULT_COLUMNS]
+
+
+def search_lancedb(query_embedding: list, datatype: Optional[str], num_results: int):
+    table = get_table()
+    search_query = (
+        table.search(query_embedding)
+        .metric('cosine')
+        .nprobes(LANCEDB_NPROBES)
+        .limit(num_results)
     )
-
-
-# Function to get top 10 query results from Pinecone
-def get_rag_matches(query: str, datatype: Optional[str] = None, num_results: int = 5):
-    query_embedding = get_embedding(query)
-    search_query = table.search(query_embedding).metric('cosine').limit(num_results)
+    # Only read the columns that are returned to the assistant
+    if get_search_columns():
+        search_query = search_query.select(
+            [c for c in get_search_columns() if c in table.schema.names],
+        )
+    if LANCEDB_REFINE_FACTOR:
+        search_query = search_query.refine_factor(LANCEDB_REFINE_FACTOR)
 
     if datatype:
         search_query = search_query.where(f"type = '{datatype}'", prefilter=True)
 
-    query_response = [
+    return [
         {k: v for k, v in r.items() if (k != 'vector' and v is not None)}
         for r in search_query.to_list()
     ]
 
+
+def search_vectors(query_embedding: list, datatype: Optional[str], num_results: int):
+    if SEARCH_BACKEND == 'numpy':
+        return get_local_index().search(
+            query_embedding,
+            num_results,
+            datatype,
+            columns=get_search_columns(),
+        )
+    return search_lancedb(query_embedding, datatype, num_results)
+
+
+# Function to get records by id, in the same order as `ids`
+def get_records_by_id(ids: list[str]):
+    if not ids:
+        return []
+    if SEARCH_BACKEND == 'numpy':
+        return get_local_index().get(ids, columns=get_search_columns())
+
+    import pyarrow as pa
+
+    table = get_table()
+    if pa.types.is_integer(table.schema.field('id').type):
+        values = [_id for _id in ids if _id.lstrip('-').isdigit()]
+    else:
+        values = ["'" + _id.replace("'", "''") + "'" for _id in ids]
+    if not values:
+        return []
+    columns = get_search_columns() or [c for c in table.schema.names if c != 'vector']
+    rows = table.to_lance().to_table(
+        columns=[c for c in columns if c in table.schema.names],
+        filter=f'id IN ({", ".join(values)})',
+    ).to_pylist()
+    by_id = {str(r['id']): {k: v for k, v in r.items() if v is not None} for r in rows}
+    return [by_id[_id] for _id in ids if _id in by_id]
+
+
+# Function to merge the vector and lexical search results with reciprocal
+# rank fusion. Records only found by the lexical search are fetched by id
+def fuse_results(vector_results: list[dict], lexical_matches: list[tuple[str, float]], num_results: int):
+    # Imported here: lexical_index imports numpy
+    from lexical_index import reciprocal_rank_fusion
+
+    records = {str(r['id']): r for r in vector_results}
+    fused = reciprocal_rank_fusion(
+        [list(records), [_id for _id, _ in lexical_matches]],
+        k=RRF_K,
+    )[:num_results]
+    records.update(
+        {str(r['id']): r for r in get_records_by_id([_id for _id, _ in fused if _id not in records])},
+    )
+    return [records[_id] for _id, _ in fused if _id in records]
+
+
+# Function to truncate text to (at most) `max_tokens` tokens
+def truncate_text(text: str, max_tokens: int):
+    # Texts this short can't exceed the budget, no need to tokenize them
+    if len(text) <= max_tokens:
+        return text
+    tokens = get_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoding().decode(tokens[:max_tokens]) + '...'
+
+
+# Function to keep only the columns the assistant needs from a search
+# result, with long text fields truncated to the token budget
+def project_search_result(result: dict):
+    return {
+        k: (
+            truncate_text(v, SEARCH_RESULT_MAX_TOKENS_PER_FIELD)
+            if isinstance(v, str) and SEARCH_RESULT_MAX_TOKENS_PER_FIELD
+            else v
+        )
+        for k, v in result.items()
+        if not SEARCH_RESULT_COLUMNS or k in SEARCH_RESULT_COLUMNS or k == '_distance'
+    }
+
+
+# Function to get top 10 query results from Pinecone
+def get_rag_matches(query: str, datatype: Optional[str] = None, num_results: int = 5):
+    lexical_index = get_lexical_index() if HYBRID_SEARCH else None
+
+    # Queries that consist only of ids (eg: a project's P-number) are
+    # looked up directly, without embedding the query
+    ids = lexical_index.lookup_ids(query, datatype) if lexical_index is not None else []
+    query_response = get_records_by_id(ids[:num_results]) if ids else []
+
+    if not query_response:
+        # When reranking, more results are fetched, and only the top
+        # `num_results` are kept after reranking them
+        num_fetched = max(num_results, RERANK_CANDIDATES) if get_reranker() else num_results
+
+        query_embedding = get_query_embedding(query)
+        if lexical_index is not None:
+            num_candidates = max(num_fetched, HYBRID_SEARCH_CANDIDATES)
+            query_response = fuse_results(
+                search_vectors(query_embedding, datatype, num_candidates),
+                lexical_index.search(query, num_candidates, datatype),
+                num_fetched,
+            )
+        else:
+            query_response = search_vectors(query_embedding, datatype, num_fetched)
+
+        query_response = rerank_rag_matches(query, query_response, num_results)
+
+    query_response = [project_search_result(r) for r in query_response]
+
     print(f'Num results: {len(query_response)}')
     print(f'Query response: {query_response}')
 
@@ -98,13 +663,43 @@ def get_rag_matches(query: str, datatype: Optional[str] = None, num_results: int
     # return rag_matches
 
 
-# TODO: do we need re-ranking?
-# # Function to rerank the top 10 query results from Pinecone
-# def rerank_rag_matches(query, documents):
-#     reranked_results = co.rerank(
-#         query=query, documents=documents, top_n=5, model="rerank-multilingual-v2.0"
-#     )
-#     return reranked_results
+# Function to load the reranking model, once per container. Returns None
+# if reranking is disabled or unavailable
+@cache_optional_resource
+def get_reranker():
+    if not RERANK_ENABLED:
+        return None
+    try:
+        from reranker import Reranker
+
+        with timed('Reranker load'):
+            return Reranker(RERANK_MODEL, cache_dir=RERANK_CACHE_DIR)
+    except Exception as e:
+        print(f'Reranker unavailable ({e}), search results are not reranked')
+        return None
+
+
+# Function to rerank search results, keeping the top `num_results`. The
+# search order is kept if the reranker is unavailable, fails or exceeds
+# its time budget
+def rerank_rag_matches(query: str, results: list[dict], num_results: int):
+    reranker = get_reranker()
+    if reranker is None or len(results) <= 1:
+        return results[:num_results]
+
+    start = time.perf_counter()
+    future = rerank_executor.submit(reranker.rerank, query, results, num_results)
+    try:
+        reranked = future.result(timeout=RERANK_TIME_BUDGET_MS / 1000)
+    except concurrent.futures.TimeoutError:
+        print(f'Reranking {len(results)} results exceeded {RERANK_TIME_BUDGET_MS:.0f} ms, skipping')
+        return results[:num_results]
+    except Exception as e:
+        print(f'Reranking failed ({e}), skipping')
+        return results[:num_results]
+
+    print(f'Reranked {len(results)} results in {(time.perf_counter() - start) * 1000:.0f} ms')
+    return reranked
 
 
 # Function to search a knowledge base
@@ -114,11 +709,11 @@ def search_knowledge_base(query: str, datatype: Optional[str] = None):
 
 
 # Function to submit tool outputs
-def submit_tool_outputs(thread_id, run_id, tool_call_id, output):
-    client.beta.threads.runs.submit_tool_outputs(
+def submit_tool_outputs(thread_id, run_id, tool_outputs):
+    get_client().beta.threads.runs.submit_tool_outputs(
         thread_id=thread_id,
         run_id=run_id,
-        tool_outputs=[{'tool_call_id': tool_call_id, 'output': json.dumps(output)}],
+        tool_outputs=tool_outputs,
     )
 
 
@@ -144,42 +739,270 @@ function_mapping = {
     'download_data_file': download_data_file,
     'open_data_file': open_data_file,
 }
+# Functions that are also passed the id of the run's thread
+THREAD_FUNCTIONS = {'download_data_file', 'open_data_file'}
 
 
-def process_thread_run(thread_id: str, run_id: str):
-
-    run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-
-    while run.status != 'completed':
+# Function to wait until a run requires action or is done, polling with
+# a backoff that starts short, since most state transitions are quick
+def wait_for_run(thread_id: str, run_id: str):
+    delay = POLL_INITIAL_DELAY
+    run = get_client().beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    while run.status not in RUN_STOP_STATUSES:
         print(f'Run status: {run.status}')
+        time.sleep(delay)
+        delay = min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY)
+        run = get_client().beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    return run
+
+
+# Function to submit tool outputs and follow the run's events until it
+# requires action or is done, falling back to polling if streaming fails
+def submit_tool_outputs_and_wait(thread_id: str, run_id: str, tool_outputs: list):
+    if not THREAD_RUN_STREAMING:
+        submit_tool_outputs(thread_id, run_id, tool_outputs)
+        return wait_for_run(thread_id, run_id)
+
+    try:
+        stream = get_client().beta.threads.runs.submit_tool_outputs(
+            thread_id=thread_id,
+            run_id=run_id,
+            tool_outputs=tool_outputs,
+            stream=True,
+        )
+    except TypeError:
+        # OpenAI client without streaming support
+        print('Run streaming unavailable, polling instead')
+        submit_tool_outputs(thread_id, run_id, tool_outputs)
+        return wait_for_run(thread_id, run_id)
+
+    # The outputs have been submitted at this point, so if anything goes
+    # wrong while reading the stream, the run's status is polled instead
+    try:
+        for event in stream:
+            # Run events (as opposed to run step/message events) carry
+            # the updated run object
+            if event.event.startswith('thread.run.') and not event.event.startswith(
+                'thread.run.step.',
+            ):
+                print(f'Run event: {event.event}')
+                if event.data.status in RUN_STOP_STATUSES:
+                    return event.data
+    except (APIError, httpx.HTTPError) as e:
+        print(f'Run stream interrupted ({e}), polling instead')
+    finally:
+        stream.response.close()
+
+    return wait_for_run(thread_id, run_id)
+
+
+# Function to serialize a tool output for submit_tool_outputs. orjson is
+# much faster than json for large outputs, and handles dates natively
+def serialize_tool_output(output):
+    return orjson.dumps(output, default=str).decode('utf-8')
+
+
+# Function to run a single tool call, returning its (serialized) output
+def call_tool(function_name: str, arguments: dict, thread_id: str):
+    print(f'Calling function {function_name} with args: {arguments}')
+    if function_name in THREAD_FUNCTIONS:
+        arguments = {**arguments, 'thread_id': thread_id}
+
+    response = function_mapping[function_name](**arguments)  # type: ignore
+
+    print(f'Function response: {response}')
+    return serialize_tool_output(response)
+
+
+# Function to wait for the result of a tool call until TOOL_CALL_TIMEOUT
+# seconds after it started (`started_at()`, None while it's queued)
+def wait_for_tool_call(future: concurrent.futures.Future, started_at: Callable[[], Optional[float]]):
+    while True:
+        start = started_at()
+        deadline = (time.monotonic() if start is None else start) + TOOL_CALL_TIMEOUT
+        try:
+            return future.result(timeout=max(0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            # Otherwise the call was queued, and may have started since
+            if start is not None:
+                raise
+
+
+# Function to run all the tool calls of a run step concurrently, each
+# with its own timeout, returning their outputs in a single list. The ids
+# of the calls that failed or timed out are added to `failed`, if given
+def execute_tool_calls(thread_id: str, tool_calls, failed: Optional[set[str]] = None):
+    calls = []
+    for tool_call in tool_calls:
+
+        # Eventually tool_call.type may be other than
+        # `function`, at which point we'll need to handle
+        function_name = tool_call.function.name
+
+        arguments = json.loads(tool_call.function.arguments)
+
+        if function_name not in function_mapping.keys():
+            raise Exception(f'Function requested: {function_name} unknown')
+
+        calls.append((tool_call, function_name, arguments))
+
+    # Start times of the calls, by id: calls beyond TOOL_CALL_MAX_WORKERS
+    # wait for a worker, and their timeout only starts with them
+    started: dict[str, float] = {}
+
+    def run(tool_call_id: str, function_name: str, arguments: dict):
+        started[tool_call_id] = time.monotonic()
+        return call_tool(function_name, arguments, thread_id)
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(len(calls), TOOL_CALL_MAX_WORKERS)),
+    )
+    futures = [
+        (tool_call, executor.submit(run, tool_call.id, function_name, arguments))
+        for tool_call, function_name, arguments in calls
+    ]
+    # Calls that time out can't be interrupted, they're left to finish
+    # in the background
+    executor.shutdown(wait=False)
+
+    tool_outputs = []
+    for tool_call, future in futures:
+        try:
+            output = wait_for_tool_call(future, lambda: started.get(tool_call.id))
+        except concurrent.futures.TimeoutError:
+            print(f'Function {tool_call.function.name} timed out')
+            output = serialize_tool_output({'error': f'Timed out after {TOOL_CALL_TIMEOUT} seconds'})
+            if failed is not None:
+                failed.add(tool_call.id)
+        except Exception as e:
+            print(f'Function {tool_call.function.name} failed: {e}')
+            output = serialize_tool_output({'error': str(e)})
+            if failed is not None:
+                failed.add(tool_call.id)
+        tool_outputs.append({'tool_call_id': tool_call.id, 'output': output})
+
+    return tool_outputs
 
-        if run.status == 'requires_action':
-
-            for tool_call in run.required_action.submit_tool_outputs.tool_calls:  # type: ignore
-
-                # Eventually tool_call.type may be other than
-                # `function`, at which point we'll need to handle
-                function_name = tool_call.function.name
-
-                arguments = json.loads(tool_call.function.arguments)
 
-                if function_name not in function_mapping.keys():
-                    raise Exception(f'Function requested: {function_name} unknown')
+def process_thread_run(thread_id: str, run_id: str):
 
-                print(f'Calling function {function_name} with args: {arguments}')
+    run = wait_for_run(thread_id, run_id)
 
-                response = function_mapping[function_name](**arguments)  # type: ignore
+    while run.status == 'requires_action':
+        print(f'Run status: {run.status}')
 
-                print(f'Function response: {response}')
-                submit_tool_outputs(thread_id, run.id, tool_call.id, response)
+        tool_outputs = execute_tool_calls(
+            thread_id,
+            run.required_action.submit_tool_outputs.tool_calls,  # type: ignore
+        )
 
-        time.sleep(1)
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+        # All of the outputs of a step are submitted together, so the
+        # run can resume as soon as the slowest call returns
+        run = submit_tool_outputs_and_wait(thread_id, run.id, tool_outputs)
 
     print(f'Run status: {run.status}')
+    if run.status in RUN_FAILED_STATUSES:
+        reason = run.last_error or getattr(run, 'incomplete_details', None)
+        print(f'Run {run.id} ended with status {run.status}: {reason}')
+
+
+# Function to prefetch everything a tool call may need, in parallel: the
+# OpenAI client, the tokenizer, the lexical index, the reranking model,
+# and either the local index or the table's manifest and vector index
+def warm_up():
+    def prefetch_table():
+        table = get_table()
+        table.count_rows()
+        # A (throwaway) search loads the vector index, if any
+        dimensions = table.schema.field('vector').type.list_size
+        table.search([1.0] * dimensions).metric('cosine').limit(1).to_list()
+
+    tasks = [get_client, get_encoding]
+    tasks.append(get_local_index if SEARCH_BACKEND == 'numpy' else prefetch_table)
+    if HYBRID_SEARCH:
+        tasks.append(get_lexical_index)
+    if RERANK_ENABLED:
+        tasks.append(get_reranker)
+
+    with timed('Warm up'), concurrent.futures.ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        for future in [executor.submit(task) for task in tasks]:
+            future.result()
+
+
+# Function to process a batch of thread runs from the SQS queue
+# concurrently, returning the ids of the messages that failed, so that
+# only those are retried (and eventually dead lettered)
+def process_queue_batch(records: list[dict]):
+    jobs = [(r['messageId'], Job.from_json(r['body'])) for r in records]
+    now = time.time()
+    for _, job in jobs:
+        print(f'Run {job.run_id} waited {now - job.enqueued_at:.2f}s in the queue')
+
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=THREAD_RUN_BATCH_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(process_thread_run, job.thread_id, job.run_id): message_id
+            for message_id, job in jobs
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f'Failed to process message {futures[future]}: {e}')
+                failures.append({'itemIdentifier': futures[future]})
+
+    failed_ids = {f['itemIdentifier'] for f in failures}
+    delay_retries([r['receiptHandle'] for r in records if r['messageId'] in failed_ids])
+    return {'batchItemFailures': failures}
+
+
+# Function to make the (failed) messages of an SQS batch visible again
+# after THREAD_RUN_RETRY_DELAY seconds. If this fails, they're retried
+# after the queue's visibility timeout instead
+def delay_retries(receipt_handles: list[str]):
+    if not receipt_handles or not THREAD_RUN_QUEUE_URL:
+        return
+    import boto3
+
+    sqs = boto3.client('sqs')
+    # At most 10 entries per request
+    for start in range(0, len(receipt_handles), 10):
+        entries = [
+            {'Id': str(i), 'ReceiptHandle': handle, 'VisibilityTimeout': THREAD_RUN_RETRY_DELAY}
+            for i, handle in enumerate(receipt_handles[start: start + 10])
+        ]
+        try:
+            response = sqs.change_message_visibility_batch(QueueUrl=THREAD_RUN_QUEUE_URL, Entries=entries)
+        except Exception as e:
+            print(f'Failed to delay the retries of {len(entries)} messages: {e}')
+            continue
+        for failed in response.get('Failed', []):
+            print(f"Failed to delay the retry of a message: {failed.get('Message')}")
 
 
 def handler(event, context):
-    # TODO: validate event contains thread_id and run_id
-    print(f"Processing thread run: {event['thread_id'], event['run_id']}")
-    process_thread_run(event['thread_id'], event['run_id'])
+    # Scheduled "keep warm" invocations
+    if event.get('warmup'):
+        warm_up()
+        cleanup_data_file_uploads()
+        return
+
+    try:
+        # Batches of runs from the thread run queue
+        if 'Records' in event:
+            return process_queue_batch(event['Records'])
+
+        # TODO: validate event contains thread_id and run_id
+        print(f"Processing thread run: {event['thread_id'], event['run_id']}")
+        process_thread_run(event['thread_id'], event['run_id'])
+    finally:
+        cleanup_data_file_uploads()
+
+
+if WARM_UP_ON_INIT:
+    warm_up()
+elif RERANK_ENABLED:
+    # Load the model during init rather than in the first search
+    get_reranker()
+
+print(f'thread_runner module initialized in {(time.perf_counter() - MODULE_INIT_STARTED) * 1000:.0f} ms')
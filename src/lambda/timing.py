@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def timed(label: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        print(f'{label} took {(time.perf_counter() - start) * 1000:.0f} ms')
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from job_queue import get_job_queue
+from job_queue import Job
+from job_queue import JobQueue
+
+# Number of runs processed at once. A run spends most of its time waiting
+# on OpenAI, so a single worker can process many
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 32))
+WORKER_POLL_WAIT = float(os.environ.get('WORKER_POLL_WAIT', 20))
+WORKER_STATS_INTERVAL = float(os.environ.get('WORKER_STATS_INTERVAL', 60))
+
+
+class WorkerStats:
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        # Seconds from enqueue to start, and from start to end, of the
+        # runs processed since the last report
+        self.queue_latencies: list[float] = []
+        self.run_durations: list[float] = []
+
+    def report(self, depth: int):
+        def p(values: list[float], q: float) -> str:
+            return f'{sorted(values)[int(len(values) * q)]:.2f}s' if values else '-'
+
+        print(
+            f'Worker: queue depth={depth} in flight={self.in_flight} '
+            f'processed={self.processed} failed={self.failed} '
+            f'queue latency p50={p(self.queue_latencies, 0.5)} p95={p(self.queue_latencies, 0.95)} '
+            f'run duration p50={p(self.run_durations, 0.5)} p95={p(self.run_durations, 0.95)}',
+        )
+        self.queue_latencies = []
+        self.run_durations = []
+
+
+async def run_worker(
+    queue: JobQueue,
+    process: Callable[[str, str], None],
+    concurrency: int = WORKER_CONCURRENCY,
+    poll_wait: float = WORKER_POLL_WAIT,
+    stats_interval: float = WORKER_STATS_INTERVAL,
+):
+    """
+    Processes the queue's jobs with `process(thread_id, run_id)`, up to
+    `concurrency` at once. `process` is blocking (the thread runner polls
+    OpenAI and runs tool calls), so jobs run on a dedicated thread pool,
+    while fetching jobs and bookkeeping happen on the event loop. Jobs are
+    acknowledged when processed, and released for a retry if they fail.
+    """
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    slots = asyncio.Semaphore(concurrency)
+    stats = WorkerStats()
+    loop = asyncio.get_running_loop()
+
+    async def handle(job: Job):
+        started = time.time()
+        stats.queue_latencies.append(started - job.enqueued_at)
+        stats.in_flight += 1
+        try:
+            await loop.run_in_executor(executor, process, job.thread_id, job.run_id)
+        except Exception as e:
+            print(f'Run {job.run_id} failed (attempt {job.attempts}): {e}')
+            stats.failed += 1
+            await asyncio.to_thread(queue.nack, job)
+        else:
+            stats.processed += 1
+            await asyncio.to_thread(queue.ack, job)
+        finally:
+            stats.in_flight -= 1
+            stats.run_durations.append(time.time() - started)
+            slots.release()
+
+    async def report():
+        while True:
+            await asyncio.sleep(stats_interval)
+            stats.report(await asyncio.to_thread(queue.depth))
+
+    reporter = asyncio.create_task(report())
+    tasks: set[asyncio.Task] = set()
+    try:
+        while True:
+            # Only fetch as many jobs as can be started right away, so that
+            # jobs this worker can't process stay available to other workers
+            await slots.acquire()
+            free = 1
+            while not slots.locked():
+                await slots.acquire()
+                free += 1
+
+            jobs = await asyncio.to_thread(queue.get_batch, free, poll_wait)
+            for _ in range(free - len(jobs)):
+                slots.release()
+            for job in jobs:
+                task = asyncio.create_task(handle(job))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    finally:
+        reporter.cancel()
+        executor.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    # Local worker, for the `sqlite` (or `sqs`) dispatch backend:
+    # python worker.py
+    import thread_runner
+
+    asyncio.run(
+        run_worker(
+            get_job_queue(os.environ.get('THREAD_RUN_DISPATCH', 'sqlite')),
+            thread_runner.process_thread_run,
+        ),
+    )
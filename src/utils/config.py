@@ -14,8 +14,32 @@ class Settings(BaseSettings):
     OPENAI_ASSISTANT_NAME: str
     OPENAI_API_KEY: str
     OPENAI_EMBEDDING_MODEL: str
+    # Shortened embeddings (text-embedding-3 models only), 0 for the
+    # model's full size. Must be the same for the table and the API
+    OPENAI_EMBEDDING_DIMENSIONS: int = 0
     LANCEDB_DATA_PATH: str
+    LOCAL_INDEX_PATH: str = 'app_data/local_index'
+    LEXICAL_INDEX_PATH: str = 'app_data/lexical_index.npz'
+    SEARCH_BACKEND: str = 'lancedb'
+    # `sqs` or `lambda` (see `THREAD_RUN_DISPATCH` in lambda/main.py)
+    THREAD_RUN_DISPATCH: str = 'sqs'
+    # Number of runs a thread runner invocation processes at once
+    THREAD_RUN_BATCH_SIZE: int = 10
+    # Seconds the thread runner waits to fill a batch. Each second is added
+    # to the start of a run when there are fewer runs than the batch size
+    # (ie: most of the time), so runs are processed as soon as they arrive
+    # by default
+    THREAD_RUN_BATCH_WINDOW: int = 0
+    # Seconds after which the failed runs of a batch are retried
+    THREAD_RUN_RETRY_DELAY: int = 60
     FORCE_RECREATE: bool = False
+    # Set to an empty string to disable the embedding cache
+    EMBEDDING_CACHE_PATH: str = 'embedding_cache.sqlite'
+    EMBEDDING_CACHE_MAX_SIZE_MB: int = 2048
+    EMBEDDING_MAX_CONCURRENCY: int = 8
+    EMBEDDING_REQUESTS_PER_MINUTE: int = 3000
+    EMBEDDING_TOKENS_PER_MINUTE: int = 1_000_000
+    EMBEDDING_MAX_RETRIES: int = 6
 
 
 settings = Settings(
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import sqlite3
+import time
+from array import array
+from collections.abc import Iterable
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache of embeddings, stored in a SQLite
+    file. Entries are keyed by (model name, sha256 of the embedded text), so
+    any change to a record's `text_to_embed` (or to the embedding model)
+    results in a cache miss. Embeddings are stored as packed float32 values.
+
+    When the cache grows beyond `max_size_mb`, the least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, path: str, model: str, max_size_mb: Optional[int] = None):
+        self.path = path
+        self.model = model
+        self.max_size_bytes = max_size_mb * 1024 * 1024 if max_size_mb else None
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """,
+        )
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)',
+        )
+        self.conn.commit()
+
+    def get(self, text: str) -> Optional[list[float]]:
+        return self.get_many([text])[0]
+
+    def get_many(self, texts: list[str]) -> list[Optional[list[float]]]:
+        hashes = [hash_text(t) for t in texts]
+        found: dict[str, list[float]] = {}
+
+        # SQLite limits the number of variables in a single statement
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i: i + 500]
+            rows = self.conn.execute(
+                f"""
+                SELECT text_hash, embedding FROM embeddings
+                WHERE model = ? AND text_hash IN ({','.join('?' * len(chunk))})
+                """,
+                [self.model, *chunk],
+            ).fetchall()
+            found.update({h: array('f', e).tolist() for h, e in rows})
+
+        if found:
+            self.conn.executemany(
+                'UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?',
+                [(time.time(), self.model, h) for h in found],
+            )
+            self.conn.commit()
+
+        results = [found.get(h) for h in hashes]
+        num_hits = sum(1 for r in results if r is not None)
+        self.hits += num_hits
+        self.misses += len(results) - num_hits
+        return results
+
+    def set_many(self, items: Iterable[tuple[str, list[float]]]):
+        now = time.time()
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)',
+            [
+                (self.model, hash_text(text), array('f', embedding).tobytes(), now)
+                for text, embedding in items
+            ],
+        )
+        self.conn.commit()
+        self.evict()
+
+    def size_bytes(self) -> int:
+        [(size,)] = self.conn.execute(
+            'SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings',
+        ).fetchall()
+        return size
+
+    def evict(self):
+        if not self.max_size_bytes:
+            return
+        excess = self.size_bytes() - self.max_size_bytes
+        if excess <= 0:
+            return
+
+        # Walk entries from least to most recently used until enough
+        # space has been freed
+        to_delete = []
+        freed = 0
+        for model, text_hash, size in self.conn.execute(
+            'SELECT model, text_hash, LENGTH(embedding) FROM embeddings ORDER BY last_access',
+        ):
+            to_delete.append((model, text_hash))
+            freed += size
+            if freed >= excess:
+                break
+
+        self.conn.executemany(
+            'DELETE FROM embeddings WHERE model = ? AND text_hash = ?',
+            to_delete,
+        )
+        self.conn.commit()
+        logger.info(f'Evicted {len(to_delete)} embeddings from cache')
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from collections.abc import Iterable
+from collections.abc import Iterator
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Optional
+
+from openai import APIConnectionError
+from openai import APITimeoutError
+from openai import InternalServerError
+from openai import RateLimitError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+# Errors signalling that too many requests are in flight. Timeouts aren't:
+# the latency of a request grows with its size (up to the ~300k tokens of
+# a full batch), so it isn't a usable signal on its own. Neither are
+# server errors, which are retried like timeouts
+OVERLOAD_ERRORS = (RateLimitError,)
+
+
+class RateLimiter:
+    """
+    Token bucket limiting both the number of requests and the number of
+    (embedding) tokens sent per minute. `acquire` blocks until both
+    budgets allow the request to be sent.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.capacity = {'requests': requests_per_minute, 'tokens': tokens_per_minute}
+        self.available = dict(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for k, capacity in self.capacity.items():
+            self.available[k] = min(capacity, self.available[k] + elapsed * capacity / 60)
+
+    def acquire(self, num_tokens: int):
+        # A single request larger than the whole budget can never be
+        # sent otherwise
+        needed = {'requests': 1, 'tokens': min(num_tokens, self.capacity['tokens'])}
+        while True:
+            with self.lock:
+                self._refill()
+                wait = max(
+                    (needed[k] - self.available[k]) * 60 / self.capacity[k]
+                    for k in needed
+                )
+                if wait <= 0:
+                    for k in needed:
+                        self.available[k] -= needed[k]
+                    return
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the number of requests in flight. The limit is halved whenever
+    the API is overloaded (it responds with a 429), and increased by one
+    after each successful request (AIMD).
+    """
+
+    def __init__(self, max_concurrency: int, min_concurrency: int = 1):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    def release(self, succeeded: bool = False, overloaded: bool = False):
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                logger.info(f'Reducing embedding concurrency to {self.limit}')
+            elif succeeded:
+                self.limit = min(self.max_concurrency, self.limit + 1)
+            self.condition.notify_all()
+
+
+class EmbeddingExecutor:
+    """
+    Runs embedding jobs on a thread pool, within the configured requests
+    and tokens per minute budgets, adapting the concurrency to 429s and
+    retrying failed requests (429s, server errors, timeouts and connection
+    errors) with exponential backoff and full jitter.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        requests_per_minute: int = 3000,
+        tokens_per_minute: int = 1_000_000,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        retry_after = None
+        response = getattr(error, 'response', None)
+        if response is not None:
+            retry_after = response.headers.get('retry-after')
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                delay = math.nan
+            # Don't trust the server to ask for a sensible wait
+            if math.isfinite(delay):
+                return min(self.max_delay, max(0.0, delay))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def run(self, fn: Callable[[Any], Any], item: Any, num_tokens: int) -> Any:
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(num_tokens)
+            self.concurrency.acquire()
+            try:
+                result = fn(item)
+            except RETRYABLE_ERRORS as e:
+                self.concurrency.release(overloaded=isinstance(e, OVERLOAD_ERRORS))
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning(f'{type(e).__name__}, retrying in {delay:.1f}s (attempt {attempt + 1})')
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.concurrency.release()
+                raise
+            self.concurrency.release(succeeded=True)
+            return result
+
+    def map(
+        self,
+        fn: Callable[[Any], Any],
+        items: Iterable[Any],
+        num_tokens: Callable[[Any], int] = lambda _: 0,
+    ) -> Iterator[Any]:
+        """
+        Applies `fn` to each item, concurrently, yielding results in input
+        order. Items are consumed lazily: only a bounded window of jobs is
+        in flight (or waiting to be yielded) at any time.
+        """
+        window: deque[Future] = deque()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            for item in items:
+                window.append(pool.submit(self.run, fn, item, num_tokens(item)))
+                if len(window) >= self.max_concurrency * 2:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+
+
+class Checkpoint:
+    """
+    Records how many records have been written to an output file, so that
+    an interrupted run can resume where it stopped. The checkpoint is only
+    valid for the same set of (unmodified) source files.
+    """
+
+    def __init__(self, path: str, sources: list[str]):
+        self.path = path
+        self.signature = {
+            s: [os.path.getsize(s), os.path.getmtime(s)] if os.path.exists(s) else None
+            for s in sources
+        }
+
+    def load(self) -> Optional[dict]:
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('signature') != self.signature:
+            logger.info('Source files changed since the last checkpoint, starting over')
+            return None
+        return state
+
+    def save(self, records_done: int, output_offset: int):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(
+                {
+                    'signature': self.signature,
+                    'records_done': records_done,
+                    'output_offset': output_offset,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -2,9 +2,20 @@ from __future__ import annotations
 
 import json
 import logging
+import os
+from collections.abc import Iterable
+from collections.abc import Iterator
+from functools import lru_cache
+from itertools import islice
+from typing import Optional
 
 import tiktoken
 from config import settings
+from embedding_cache import EmbeddingCache
+from embedding_executor import Checkpoint
+from embedding_executor import EmbeddingExecutor
+from json_stream import iter_json_items
+from openai import BadRequestError
 from openai import OpenAI
 from tqdm import tqdm
 
@@ -16,24 +27,93 @@ logger.setLevel(logging.INFO)
 
 client = OpenAI(api_key=settings.OPENAI_API_KEY)
 
+# Limits of the embeddings endpoint (ref: https://platform.openai.com/docs/api-reference/embeddings/create)
+MAX_TOKENS_PER_INPUT = 8191
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300_000
+
+SOURCE_FILES = [
+    'wb_ag_apps.json',
+    'wb_ag_projects.json',
+    'wb_ag_datasets.json',
+    'wb_ag_microdatasets.json',
+    'wb_ag_projects_datasets.json',
+    'wb_youtube_videos.json',
+    'wb_datasets.json',
+    'wb_projects.json',
+]
+# Number of records read from a source file at a time
+PREP_CHUNK_SIZE = 500
+OUTPUT_PATH = 'records.jsonl'
+TOKENIZER_THREADS = os.cpu_count() or 4
+
+
+# Loading the encoding is expensive, so it's only done once
+@lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.get_encoding('cl100k_base')
+
 
 def get_tokens(text: str):
     text = text.replace('\n', ' ')
-    encoding = tiktoken.get_encoding('cl100k_base')
-    return encoding.encode(text)
+    return get_encoding().encode(text)
+
+
+def get_tokens_batch(texts: list[str]) -> list[list[int]]:
+    # tiktoken releases the GIL while encoding, so the batch is
+    # tokenized in parallel threads
+    return get_encoding().encode_batch(
+        [text.replace('\n', ' ') for text in texts],
+        num_threads=TOKENIZER_THREADS,
+    )
+
+
+def truncate_tokens(tokens: list):
+    if len(tokens) > MAX_TOKENS_PER_INPUT:
+        logger.error(
+            f'Token length execeeds {MAX_TOKENS_PER_INPUT} tokens, truncating to {MAX_TOKENS_PER_INPUT} tokens',
+        )
+        tokens = tokens[:MAX_TOKENS_PER_INPUT]
+    return tokens
+
+
+def get_embedding_params() -> dict:
+    params: dict = {'model': settings.OPENAI_EMBEDDING_MODEL}
+    if settings.OPENAI_EMBEDDING_DIMENSIONS:
+        params['dimensions'] = settings.OPENAI_EMBEDDING_DIMENSIONS
+    return params
+
+
+# Embeddings of different sizes are cached separately
+def get_embedding_cache_key() -> str:
+    if settings.OPENAI_EMBEDDING_DIMENSIONS:
+        return f'{settings.OPENAI_EMBEDDING_MODEL}@{settings.OPENAI_EMBEDDING_DIMENSIONS}'
+    return settings.OPENAI_EMBEDDING_MODEL
 
 
 def get_embedding(tokens: list):
+    return get_embeddings([tokens])[0]
 
-    if len(tokens) > 8191:
-        logger.error('Token length execeeds 8191 tokens, truncating to 8191 tokens')
-        tokens = tokens[:8191]
 
-    return (
-        client.embeddings.create(input=tokens, model=settings.OPENAI_EMBEDDING_MODEL)
-        .data[0]
-        .embedding
-    )
+def get_embeddings(batch: list[list[int]]) -> list[list[float]]:
+    """
+    Embeds a batch of token lists with a single request. If the API rejects
+    the request (eg: because the batch exceeds the per-request token limit)
+    the batch is split in half and each half is retried, recursively.
+    Embeddings are returned in the same order as the input token lists.
+    """
+    batch = [truncate_tokens(tokens) for tokens in batch]
+    try:
+        response = client.embeddings.create(input=batch, **get_embedding_params())
+    except BadRequestError:
+        if len(batch) == 1:
+            raise
+        logger.warning(f'Batch of {len(batch)} inputs rejected, splitting and retrying')
+        middle = len(batch) // 2
+        return get_embeddings(batch[:middle]) + get_embeddings(batch[middle:])
+
+    # The API doesn't guarantee that results are returned in input order
+    return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
 
 
 def get_text_to_embed(data):
@@ -52,76 +132,201 @@ def get_text_to_embed(data):
     return text
 
 
-def prep_data():
+def iter_chunks(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def iter_source_records(f: str) -> Iterator[dict]:
+    with open(f'../data/{f}') as fp:
+        yield from iter_json_items(fp)
+
+
+def prep_data(cache: Optional[EmbeddingCache] = None, skip: int = 0) -> Iterator[dict]:
+    """
+    Streams records from each of the source files, so that only a single
+    chunk of records is held in memory at any time. The first `skip`
+    records are dropped before being tokenized.
+    """
     # TODO: fetch these from github?
-    records = []
-    for f in [
-        'wb_ag_apps.json',
-        'wb_ag_projects.json',
-        'wb_ag_datasets.json',
-        'wb_ag_microdatasets.json',
-        'wb_ag_projects_datasets.json',
-        'wb_youtube_videos.json',
-        'wb_datasets.json',
-        'wb_projects.json',
-    ]:
+    num_records = 0
+    for f in SOURCE_FILES:
         logger.info(f'Processing file: {f}')
 
-        with open(f'../data/{f}') as fp:
-            data = json.load(fp)
-            if isinstance(data, dict):
-                if data.get('data'):
-                    data = data['data']
-                else:
-                    data = data.values()
-
         _type = f.split('_')[-1].replace('s.json', '')
-        # TODO: generate in batches
-        records.extend(
-            [
-                {
-                    'tokens': get_tokens(get_text_to_embed(d)),
+        stats = {'records': 0, 'cached': 0, 'tokens': 0, 'max_tokens': 0, 'truncated': 0}
+
+        # text_to_embed is computed once per record
+        data = (
+            (d, t)
+            for d in iter_source_records(f)
+            if (t := get_text_to_embed(d))
+        )
+        if skip:
+            # Records already written by a previous (interrupted) run
+            num_skipped = sum(1 for _ in islice(data, skip))
+            skip -= num_skipped
+            num_records += num_skipped
+
+        for chunk in iter_chunks(data, PREP_CHUNK_SIZE):
+            texts = [t for _, t in chunk]
+
+            # Records with an embedding in the cache don't need to be
+            # tokenized (or embedded) again
+            cached = cache.get_many(texts) if cache else [None] * len(chunk)
+            tokens = iter(
+                get_tokens_batch([t for t, e in zip(texts, cached) if e is None]),
+            )
+
+            for (d, t), e in zip(chunk, cached):
+                record_tokens = [] if e else next(tokens)
+                record = {
+                    'tokens': record_tokens,
                     'metadata': {
                         **d,
                         'type': _type,
-                        'text_to_embed': get_text_to_embed(d),
+                        'text_to_embed': t,
                     },
                 }
-                for d in data
-                if get_text_to_embed(d)
-            ],
+                if e:
+                    record['embedding'] = e
+                yield record
+
+                stats['cached'] += 1 if e else 0
+                stats['tokens'] += len(record_tokens)
+                stats['max_tokens'] = max(stats['max_tokens'], len(record_tokens))
+                stats['truncated'] += 1 if len(record_tokens) > MAX_TOKENS_PER_INPUT else 0
+
+            stats['records'] += len(chunk)
+
+        tokenized = stats['records'] - stats['cached']
+        logger.info(
+            f'{f}: {stats["records"]} records ({stats["cached"]} cached), '
+            f'{stats["tokens"]} tokens (mean: {stats["tokens"] / max(tokenized, 1):.1f}, '
+            f'max: {stats["max_tokens"]}, truncated: {stats["truncated"]})',
         )
-    logger.info(f'Prepped {len(records)} records to embed')
-    return records
+        num_records += stats['records']
+
+    logger.info(f'Prepped {num_records} records to embed')
+
 
+def split_into_batches(
+    data: Iterable[dict],
+    max_tokens: int = MAX_TOKENS_PER_REQUEST,
+    max_items: int = MAX_INPUTS_PER_REQUEST,
+) -> Iterator[list[dict]]:
+    """
+    Packs records into consecutive batches so that each batch stays under
+    the per-request token and input limits of the embeddings endpoint.
+    Already embedded records don't count towards the token limit, but are
+    kept in their batch to preserve record order across (and within)
+    batches.
+    """
+    current_batch: list[dict] = []
+    current_tokens = 0
 
-# TODO: batch embeddings queries for speed
-# def split_into_batches(data, threshold=8191):
-#     result = []
-#     current_batch = []
+    for d in data:
+        num_tokens = 0 if 'embedding' in d else min(len(d['tokens']), MAX_TOKENS_PER_INPUT)
+        if current_batch and (
+            current_tokens + num_tokens > max_tokens or len(current_batch) >= max_items
+        ):
+            yield current_batch
+            current_batch = []
+            current_tokens = 0
+        current_batch.append(d)
+        current_tokens += num_tokens
 
-#     for d in data:
-#         if sum([len(cd["tokens"]) for cd in current_batch]) + len(d["tokens"]) <= X:
-#             current_batch.append(d["tokens"])
-#         else:
-#             result.append(current_batch)
-#             current_batch = [d["tokens"]]
+    if current_batch:
+        yield current_batch
+
+
+def embed_batch(batch: list[dict]) -> list[dict]:
+    to_embed = [d for d in batch if 'embedding' not in d]
+    if to_embed:
+        embeddings = get_embeddings([d['tokens'] for d in to_embed])
+        for d, e in zip(to_embed, embeddings):
+            d['embedding'] = e
+    return batch
+
+
+def generate_embeddings(output_path: str = OUTPUT_PATH, resume: bool = True):
+    """
+    Embeds all records and writes them, one JSON object per line, to
+    `output_path`. Records are written as soon as their batch has been
+    embedded, so memory use is bounded by the batch size rather than by
+    the size of the catalog.
+
+    Batches are embedded concurrently by a rate limited `EmbeddingExecutor`
+    and progress is checkpointed after each batch, so that an interrupted
+    run resumes from the last written record (if `resume` is set).
+    """
+    cache = None
+    if settings.EMBEDDING_CACHE_PATH:
+        cache = EmbeddingCache(
+            settings.EMBEDDING_CACHE_PATH,
+            model=get_embedding_cache_key(),
+            max_size_mb=settings.EMBEDDING_CACHE_MAX_SIZE_MB,
+        )
+
+    executor = EmbeddingExecutor(
+        max_concurrency=settings.EMBEDDING_MAX_CONCURRENCY,
+        requests_per_minute=settings.EMBEDDING_REQUESTS_PER_MINUTE,
+        tokens_per_minute=settings.EMBEDDING_TOKENS_PER_MINUTE,
+        max_retries=settings.EMBEDDING_MAX_RETRIES,
+    )
+
+    checkpoint = Checkpoint(
+        f'{output_path}.checkpoint',
+        sources=[f'../data/{f}' for f in SOURCE_FILES],
+    )
+    state = checkpoint.load() if resume and os.path.exists(output_path) else None
+    num_records = state['records_done'] if state else 0
+    if state:
+        logger.info(f'Resuming from checkpoint, skipping {num_records} records')
 
-#     if current_batch:
-#         result.append(current_batch)
+    num_tokens = 0
+    with open(output_path, 'r+b' if state else 'wb') as fp:
+        if state:
+            # Drop anything written after the last checkpoint
+            fp.truncate(state['output_offset'])
+            fp.seek(state['output_offset'])
 
-#     return result
+        batches = split_into_batches(prep_data(cache=cache, skip=num_records))
+        for batch in tqdm(
+            executor.map(
+                embed_batch,
+                batches,
+                num_tokens=lambda batch: sum([len(d['tokens']) for d in batch]),
+            ),
+        ):
+            to_cache = [d for d in batch if d['tokens']]
+            # Cache each batch as soon as it's embedded, so that an
+            # interrupted run doesn't lose the work already done
+            if cache and to_cache:
+                cache.set_many(
+                    [(d['metadata']['text_to_embed'], d['embedding']) for d in to_cache],
+                )
 
+            # Token lists are only needed to create the embeddings, so
+            # they're not written to the output
+            for d in batch:
+                fp.write(
+                    (json.dumps({'embedding': d['embedding'], **d['metadata']}) + '\n').encode('utf-8'),
+                )
+            fp.flush()
 
-def generate_embeddings():
-    data = prep_data()
+            num_records += len(batch)
+            num_tokens += sum([len(d['tokens']) for d in to_cache])
+            checkpoint.save(records_done=num_records, output_offset=fp.tell())
 
-    data = [{'embedding': get_embedding(d['tokens']), **d} for d in tqdm(data)]
+    checkpoint.clear()
 
-    with open('records.json', 'w') as fp:
-        json.dump(data, fp)
+    if cache:
+        logger.info(f'Embedding cache hits: {cache.hits}, misses: {cache.misses}')
+        cache.close()
 
-    num_tokens = sum([len(d['tokens']) for d in data])
+    logger.info(f'Wrote {num_records} records to {output_path}')
     logger.info(
         f'Estimated total cost: {num_tokens / 1000 * 0.00002} dollars (for {num_tokens} tokens)',
     )
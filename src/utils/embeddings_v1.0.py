@@ -1,18 +1,20 @@
 from __future__ import annotations
 
-import concurrent.futures
 import csv
 import json
 import os
 
 import tiktoken
+from embedding_executor import EmbeddingExecutor
 from openai import OpenAI
 from tqdm import tqdm
 
+# Loading the encoding is expensive, so it's only done once
+encoding = tiktoken.get_encoding('cl100k_base')
+
 
 def get_tokens(text: str):
     text = text.replace('\n', ' ')
-    encoding = tiktoken.get_encoding('cl100k_base')
     return encoding.encode(text)
 
 
@@ -91,15 +93,16 @@ if __name__ == '__main__':
 
     client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        embeddings = list(
-            tqdm(
-                executor.map(
-                    lambda d: get_embedding(
-                        get_tokens(d['text_to_embed']),
-                    ),  # some boto3 operation
-                    data,
-                ),
-                total=len(data),  # sets total length of progressbar
-            ),
-        )
+    # Tokenize all records up front, in parallel threads
+    tokens = encoding.encode_batch(
+        [d['text_to_embed'].replace('\n', ' ') for d in data],
+        num_threads=os.cpu_count() or 4,
+    )
+
+    executor = EmbeddingExecutor(max_concurrency=10)
+    embeddings = list(
+        tqdm(
+            executor.map(get_embedding, tokens, num_tokens=len),
+            total=len(data),  # sets total length of progressbar
+        ),
+    )
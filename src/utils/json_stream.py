@@ -0,0 +1 @@
+../lambda/json_stream.py
\ No newline at end of file
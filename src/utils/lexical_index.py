@@ -0,0 +1 @@
+../lambda/lexical_index.py
\ No newline at end of file
@@ -0,0 +1 @@
+../lambda/local_search.py
\ No newline at end of file
@@ -0,0 +1 @@
+../lambda/quantization.py
\ No newline at end of file
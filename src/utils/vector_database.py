@@ -1,71 +1,456 @@
 from __future__ import annotations
 
+import argparse
+import hashlib
 import json
 import logging
+import math
+import os
+import random
+import tempfile
+import time
 
 import boto3
 import embeddings
 import lancedb
+import numpy as np
+import pyarrow as pa
 from config import settings
+from lexical_index import LexicalIndex
+from lexical_index import TEXT_COLUMNS
+from local_search import write_index
+from quantization import DTYPES
+from quantization import quantize
+from quantization import score
 
 # TODO: why doesn't logger print anything?
 logger = logging.getLogger(__name__)
 logging.getLogger().setLevel(logging.INFO)
 
-client = boto3.client('cloudformation', region_name='us-east-1')
-
-response = client.describe_stacks(
-    StackName=f'wb-agrifoods-data-lab-{settings.STAGE}'.lower(),
-)
-outputs = response['Stacks'][0]['Outputs']
-[bucket_name] = [o['OutputValue'] for o in outputs if o['OutputKey'] == 'bucketname']
-
-
-db = lancedb.connect(f's3://{bucket_name}/{settings.LANCEDB_DATA_PATH}')
-
-with open('records_v1.0.json', 'r') as f:
-    records = json.loads(f.read())
-# Flatten records
-data = [
-    {'vector': r['embedding'], **{k: v for k, v in r.items() if k != 'embedding'}}
-    for r in records
-]
-
-# LanceDB assumes uses the keys from the first list element
-# as the table columns, so we first ensure that all records
-# have the set same of keys (values will be None for keys
-# not relevant to a record)
-key_set = set()
-for d in data:
-    key_set.update(set(d.keys()))
-data = [{**{k: None for k in key_set}, **d} for d in data]
-
-print(len(data))
-
-# Note: AWS S3 Buckets are not region specific, so the region
-# doesn't really matter here
-
-db.create_table('agrifood', data, mode='overwrite')
-
-table = db.open_table('agrifood')
-
-
-logger.info(table.head())
-queries = [
-    'How is food security affected by drought in north africa?',
-    'How has climate change affected wheat production in asian minor in the past decade?',
-    'In what regions of the world is pivot irrigation most common?',
-]
-query_vectors = [
-    embeddings.client.embeddings.create(input=q, model=settings.OPENAI_EMBEDDING_MODEL)
-    .data[0]
-    .embedding
-    for q in queries
-]
-
-for q, v in zip(queries, query_vectors):
-    _type = 'project'
-    query_result = table.search(v).metric('cosine').where(f"type='{_type}'").limit(5)
-    print(f'QUERY: {q}')
-    print(f'RESULT: {query_result.to_list()}')
-    print('\n')
+TABLE_NAME = 'agrifood'
+RECORDS_PATH = 'records_v1.0.json'
+
+# Product quantization needs at least 256 rows to train its codebooks,
+# and below a few thousand rows a brute force scan is fast enough
+MIN_ROWS_FOR_INDEX = 5000
+
+# Metadata columns commonly used to filter searches (eg: by the thread
+# runner's `search_knowledge_base`, or to look records up by id),
+# indexed when present in the table
+SCALAR_INDEX_COLUMNS = ['id', 'type', 'region', 'country', 'year']
+
+
+def get_bucket_name():
+    client = boto3.client('cloudformation', region_name='us-east-1')
+
+    response = client.describe_stacks(
+        StackName=f'wb-agrifoods-data-lab-{settings.STAGE}'.lower(),
+    )
+    outputs = response['Stacks'][0]['Outputs']
+    [bucket_name] = [o['OutputValue'] for o in outputs if o['OutputKey'] == 'bucketname']
+    return bucket_name
+
+
+def load_records(path: str):
+    # Supports both a single JSON list and JSON Lines (one record per
+    # line, as written by `embeddings.generate_embeddings`)
+    with open(path, 'r') as f:
+        if path.endswith('.jsonl'):
+            yield from (json.loads(line) for line in f if line.strip())
+        else:
+            yield from json.loads(f.read())
+
+
+def get_content_hash(record: dict):
+    return hashlib.sha256(
+        json.dumps(record, sort_keys=True, default=str).encode('utf-8'),
+    ).hexdigest()
+
+
+def prep_table_data(records):
+    # Flatten records
+    data = [
+        {'vector': r['embedding'], **{k: v for k, v in r.items() if k != 'embedding'}}
+        for r in records
+    ]
+
+    # LanceDB assumes uses the keys from the first list element
+    # as the table columns, so we first ensure that all records
+    # have the set same of keys (values will be None for keys
+    # not relevant to a record)
+    key_set = set()
+    for d in data:
+        key_set.update(set(d.keys()))
+    data = [{**{k: None for k in key_set}, **d} for d in data]
+
+    # The content hash lets an incremental sync detect which
+    # records have changed without comparing every column
+    return [{**d, 'content_hash': get_content_hash(d)} for d in data]
+
+
+def overwrite_table(db, data: list[dict]):
+    # Note: AWS S3 Buckets are not region specific, so the region
+    # doesn't really matter here
+    db.create_table(TABLE_NAME, data, mode='overwrite')
+    return db.open_table(TABLE_NAME)
+
+
+def sql_literal(value, type_: pa.DataType) -> str:
+    """Returns `value` as an SQL literal, for a column of Arrow type `type_`"""
+    if pa.types.is_integer(type_):
+        return str(int(value))
+    if pa.types.is_floating(type_):
+        return repr(float(value))
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def sync_table(db, data: list[dict]):
+    """
+    Incrementally applies `data` to the existing table: rows are matched by
+    `id`, and only new, changed (according to their content hash) and
+    deleted rows are written. Each write creates a new table version, so
+    readers keep querying the previous version until the sync completes.
+    """
+    if TABLE_NAME not in db.table_names():
+        logger.info(f'Table {TABLE_NAME} not found, creating it')
+        return overwrite_table(db, data)
+
+    table = db.open_table(TABLE_NAME)
+
+    columns = set(table.schema.names)
+    if not data or set(data[0].keys()) != columns:
+        logger.info('Table schema differs from the records, overwriting table')
+        return overwrite_table(db, data)
+
+    missing_ids = [d for d in data if d.get('id') is None]
+    if missing_ids:
+        logger.warning(f'Skipping {len(missing_ids)} records without an id')
+
+    # If an id appears more than once, the last record wins
+    records = {str(d['id']): d for d in data if d.get('id') is not None}
+
+    # Only read the columns needed to compute the diff
+    rows = table.to_lance().to_table(columns=['id', 'content_hash']).to_pylist()
+    existing = {str(r['id']): r['content_hash'] for r in rows}
+
+    upserts = [d for _id, d in records.items() if existing.get(_id) != d['content_hash']]
+    # Deleted ids are kept as stored, so they can be quoted according to
+    # the type of the `id` column
+    deletes = list(dict.fromkeys(r['id'] for r in rows if str(r['id']) not in records))
+    logger.info(
+        f'Sync: {len(records)} records, '
+        f'{sum(1 for d in upserts if str(d["id"]) not in existing)} new, '
+        f'{sum(1 for d in upserts if str(d["id"]) in existing)} updated, '
+        f'{len(deletes)} deleted',
+    )
+
+    if upserts:
+        (
+            table.merge_insert('id')
+            .when_matched_update_all()
+            .when_not_matched_insert_all()
+            .execute(upserts)
+        )
+
+    id_type = table.schema.field('id').type
+    for i in range(0, len(deletes), 500):
+        ids = ', '.join(sql_literal(_id, id_type) for _id in deletes[i: i + 500])
+        table.delete(f'id IN ({ids})')
+
+    return table
+
+
+def get_num_sub_vectors(dimensions: int) -> int:
+    """
+    Returns the number of PQ sub-vectors for vectors of `dimensions`: each
+    sub-vector should cover 8 or 16 dimensions, and their number must
+    divide the dimensions, which shortened embeddings (eg: 100 or 200
+    dimensions) don't always allow, so the largest divisor below that
+    target is used
+    """
+    target = dimensions // 16 if dimensions % 16 == 0 else dimensions // 8
+    return max(n for n in range(1, max(1, target) + 1) if dimensions % n == 0)
+
+
+def build_vector_index(table, replace: bool = True):
+    """
+    Builds (or rebuilds) an IVF-PQ index on the `vector` column, sized
+    to the number of rows in the table. Rows added after the index is
+    built are still searched, with a brute force scan, so the index should
+    be rebuilt after every update.
+    """
+    num_rows = table.count_rows()
+    if num_rows < MIN_ROWS_FOR_INDEX:
+        logger.info(f'Only {num_rows} rows, skipping vector index')
+        return
+
+    dimensions = table.schema.field('vector').type.list_size
+    num_partitions = max(1, int(math.sqrt(num_rows)))
+    num_sub_vectors = get_num_sub_vectors(dimensions)
+
+    logger.info(
+        f'Building IVF-PQ index: {num_rows} rows, {num_partitions} partitions, '
+        f'{num_sub_vectors} sub-vectors',
+    )
+    table.create_index(
+        metric='cosine',
+        num_partitions=num_partitions,
+        num_sub_vectors=num_sub_vectors,
+        replace=replace,
+    )
+
+
+def build_scalar_indices(table, replace: bool = True):
+    """
+    Builds (or rebuilds) a scalar (BTree) index on each of the filter
+    columns present in the table, so that prefiltered vector searches
+    (eg: `.where("type = 'dataset'", prefilter=True)`) use the index
+    instead of scanning the column.
+    """
+    for column in SCALAR_INDEX_COLUMNS:
+        if column not in table.schema.names:
+            continue
+        _type = table.schema.field(column).type
+        if not (
+            pa.types.is_string(_type)
+            or pa.types.is_large_string(_type)
+            or pa.types.is_integer(_type)
+            or pa.types.is_floating(_type)
+            or pa.types.is_temporal(_type)
+        ):
+            logger.info(f'Column {column} has type {_type}, skipping scalar index')
+            continue
+        logger.info(f'Building scalar index on {column}')
+        table.create_scalar_index(column, replace=replace)
+
+
+def get_normalized_vectors(table) -> tuple[list, np.ndarray]:
+    rows = table.to_lance().to_table(columns=['id', 'vector']).to_pylist()
+    vectors = np.array([r['vector'] for r in rows], dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return [r['id'] for r in rows], vectors
+
+
+def export_local_index(
+    table,
+    bucket_name: str,
+    dtype: str = 'float32',
+    rescore_dtype: str | None = None,
+):
+    """
+    Exports the table for the thread runner's in-memory (`numpy`) search
+    backend: L2 normalized vectors as a single `.npy` matrix, in the
+    `dtype` storage format (see `quantization.DTYPES`), and the other
+    columns as an Arrow IPC file, both uploaded under
+    `settings.LOCAL_INDEX_PATH` in S3. Rows are stored in the same order
+    in both files. With `rescore_dtype`, the vectors are also exported in
+    that (float) format, used to re-score the best matches of the
+    quantized vectors exactly. `index.json` describes the files.
+    """
+    data = table.to_lance().to_table()
+
+    vectors = np.array(data.column('vector').to_pylist(), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    metadata = data.drop(['vector'])
+
+    s3 = boto3.client('s3')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # The manifest comes last, so that it never describes files that
+        # haven't been uploaded yet
+        for name in write_index(tmpdir, vectors, metadata, dtype, rescore_dtype):
+            path = os.path.join(tmpdir, name)
+            key = f'{settings.LOCAL_INDEX_PATH}/{name}'
+            logger.info(f'Uploading {path} ({os.path.getsize(path)} bytes) to s3://{bucket_name}/{key}')
+            s3.upload_file(path, bucket_name, key)
+
+
+def build_lexical_index(table, bucket_name: str):
+    """
+    Builds the BM25 index over the records' ids, titles and texts, used
+    by the thread runner alongside the vector search (LanceDB's own full
+    text search only supports tables on a local file system), and uploads
+    it to `settings.LEXICAL_INDEX_PATH` in S3.
+    """
+    columns = [c for c in TEXT_COLUMNS + ['type'] if c in table.schema.names]
+    index = LexicalIndex.build(table.to_lance().to_table(columns=columns).to_pylist())
+    logger.info(f'Built lexical index: {len(index)} records, {len(index.term_index)} terms')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'lexical_index.npz')
+        index.save(path)
+        logger.info(f'Uploading {path} to s3://{bucket_name}/{settings.LEXICAL_INDEX_PATH}')
+        boto3.client('s3').upload_file(path, bucket_name, settings.LEXICAL_INDEX_PATH)
+
+
+def benchmark_index(
+    table,
+    num_queries: int = 50,
+    k: int = 10,
+    nprobes_values: tuple[int, ...] = (1, 5, 10, 20, 50),
+    refine_factors: tuple[int | None, ...] = (None, 5, 10),
+):
+    """
+    Prints the recall@k and latency of ANN searches with different
+    `nprobes`/`refine_factor` settings, compared against an exact (brute
+    force) search. Rows sampled from the table are used as queries.
+    """
+    ids, vectors = get_normalized_vectors(table)
+    queries = vectors[random.sample(range(len(ids)), min(num_queries, len(ids)))]
+
+    start = time.perf_counter()
+    exact = [
+        {ids[i] for i in np.argsort(-(vectors @ q))[:k]}
+        for q in queries
+    ]
+    exact_latency = (time.perf_counter() - start) / len(queries)
+    print(f'exact (in memory): {exact_latency * 1000:.1f} ms/query')
+
+    for nprobes in nprobes_values:
+        for refine_factor in refine_factors:
+            latencies = []
+            recalls = []
+            for q, expected in zip(queries, exact):
+                query = table.search(q.tolist()).metric('cosine').nprobes(nprobes).limit(k)
+                if refine_factor:
+                    query = query.refine_factor(refine_factor)
+                start = time.perf_counter()
+                results = query.to_list()
+                latencies.append(time.perf_counter() - start)
+                recalls.append(len({r['id'] for r in results} & expected) / k)
+
+            latencies.sort()
+            print(
+                f'nprobes={nprobes} refine_factor={refine_factor}: '
+                f'recall@{k}={sum(recalls) / len(recalls):.3f} '
+                f'p50={latencies[len(latencies) // 2] * 1000:.1f} ms '
+                f'p95={latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms',
+            )
+
+
+def benchmark_quantization(table, num_queries: int = 100, k: int = 10, rescore_factor: int = 4):
+    """
+    Prints the size, recall@k (compared to an exact float32 search) and
+    latency of an in-memory search with each vector storage format, with
+    and without re-scoring the top `k * rescore_factor` matches exactly.
+    Rows sampled from the table are used as queries.
+    """
+    _, vectors = get_normalized_vectors(table)
+    queries = vectors[random.sample(range(len(vectors)), min(num_queries, len(vectors)))]
+    exact = [set(np.argsort(-(vectors @ q))[:k].tolist()) for q in queries]
+
+    for dtype in DTYPES:
+        quantized, scales = quantize(vectors, dtype)
+        size = quantized.nbytes + (scales.nbytes if scales is not None else 0)
+
+        for rescore in (False, True):
+            if rescore and dtype == 'float32':
+                continue
+            recalls, latencies = [], []
+            for q, expected in zip(queries, exact):
+                start = time.perf_counter()
+                scores = score(quantized, dtype, q, scales, dimensions=vectors.shape[1])
+                num_candidates = k * rescore_factor if rescore else k
+                top = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+                if rescore:
+                    top = top[np.argsort(-(vectors[top] @ q))[:k]]
+                latencies.append(time.perf_counter() - start)
+                recalls.append(len(set(top.tolist()) & expected) / k)
+
+            print(
+                f'{dtype}{" + rescore" if rescore else ""}: '
+                f'size={size / 1024 / 1024:.1f} MB ({vectors.nbytes / size:.0f}x smaller) '
+                f'recall@{k}={sum(recalls) / len(recalls):.3f} '
+                f'latency={sum(latencies) / len(latencies) * 1000:.1f} ms/query',
+            )
+
+
+def run_sample_queries(table):
+    queries = [
+        'How is food security affected by drought in north africa?',
+        'How has climate change affected wheat production in asian minor in the past decade?',
+        'In what regions of the world is pivot irrigation most common?',
+    ]
+    query_vectors = [
+        embeddings.client.embeddings.create(input=q, **embeddings.get_embedding_params())
+        .data[0]
+        .embedding
+        for q in queries
+    ]
+
+    for q, v in zip(queries, query_vectors):
+        _type = 'project'
+        query_result = (
+            table.search(v)
+            .metric('cosine')
+            .where(f"type = '{_type}'", prefilter=True)
+            .limit(5)
+        )
+        print(f'QUERY: {q}')
+        print(f'RESULT: {query_result.to_list()}')
+        print('\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the knowledge base')
+    parser.add_argument('--records', default=RECORDS_PATH, help='JSON or JSON Lines records file')
+    parser.add_argument(
+        '--mode',
+        choices=['overwrite', 'sync'],
+        default='overwrite',
+        help='Re-create the table, or only add/update/delete the rows that changed',
+    )
+    parser.add_argument('--skip-index', action='store_true', help="Don't (re)build the table indices")
+    parser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help='Report recall and latency of the vector index against an exact search',
+    )
+    parser.add_argument(
+        '--export-local-index',
+        choices=DTYPES,
+        help='Also export the vectors, in the given format, for the in-memory search backend',
+    )
+    parser.add_argument(
+        '--rescore-dtype',
+        choices=['float32', 'float16'],
+        help='Also export the vectors in this format, to re-score the matches of quantized vectors',
+    )
+    parser.add_argument(
+        '--benchmark-quantization',
+        action='store_true',
+        help='Report size, recall and latency of each vector storage format against an exact search',
+    )
+    args = parser.parse_args()
+
+    bucket_name = get_bucket_name()
+    db = lancedb.connect(f's3://{bucket_name}/{settings.LANCEDB_DATA_PATH}')
+
+    data = prep_table_data(load_records(args.records))
+    print(len(data))
+
+    if args.mode == 'sync':
+        table = sync_table(db, data)
+    else:
+        table = overwrite_table(db, data)
+
+    if not args.skip_index:
+        build_vector_index(table)
+        build_scalar_indices(table)
+        build_lexical_index(table, bucket_name)
+
+    logger.info(table.head())
+    run_sample_queries(table)
+
+    if args.export_local_index:
+        export_local_index(
+            table,
+            bucket_name,
+            dtype=args.export_local_index,
+            rescore_dtype=args.rescore_dtype,
+        )
+
+    if args.benchmark:
+        benchmark_index(table)
+
+    if args.benchmark_quantization:
+        benchmark_quantization(table)
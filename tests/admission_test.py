@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from admission import ACTIVE_RUN_STATUSES
+from admission import IDEMPOTENCY_KEY_METADATA
+from admission import RunActiveError
+from admission import RunAdmission
+
+
+class FakeThread:
+    """
+    A thread whose runs stay `in_progress` until `finish` is called, and
+    which, like OpenAI, refuses to start a run while one is active
+    """
+
+    def __init__(self):
+        self.runs: list[dict] = []
+        self.batches: list[list[str]] = []
+
+    async def start_run(self, thread_id: str, messages: list[str], metadata: dict) -> dict:
+        await asyncio.sleep(0)
+        if self.runs and self.runs[-1]['status'] in ACTIVE_RUN_STATUSES:
+            raise RunActiveError(self.runs[-1]['id'])
+        self.batches.append(messages)
+        run = {'id': f'run_{len(self.runs)}', 'status': 'in_progress', 'metadata': metadata}
+        self.runs.append(run)
+        return run
+
+    async def get_latest_run(self, thread_id: str):
+        await asyncio.sleep(0)
+        return self.runs[-1] if self.runs else None
+
+    def finish(self):
+        self.runs[-1]['status'] = 'completed'
+
+
+def make_admission(thread: FakeThread, wait_timeout: float = 1) -> RunAdmission:
+    return RunAdmission(
+        start_run=thread.start_run,
+        get_latest_run=thread.get_latest_run,
+        wait_timeout=wait_timeout,
+        poll_initial_delay=0.01,
+        poll_max_delay=0.01,
+    )
+
+
+def test_concurrent_retries_start_a_single_run():
+    async def main():
+        thread = FakeThread()
+        admission = make_admission(thread)
+        runs = await asyncio.gather(
+            *[admission.submit('thread', 'hello', idempotency_key='key') for _ in range(3)],
+        )
+        assert [r['id'] for r in runs] == ['run_0'] * 3
+        assert thread.batches == [['hello']]
+        assert thread.runs[0]['metadata'] == {IDEMPOTENCY_KEY_METADATA: 'key'}
+        assert admission.stats()['deduplicated'] == 2
+
+    asyncio.run(main())
+
+
+def test_retry_after_the_run_started_gets_the_same_run():
+    async def main():
+        thread = FakeThread()
+        admission = make_admission(thread)
+        run = await admission.submit('thread', 'hello', idempotency_key='key')
+        # The run is still active, but the retry isn't a new message
+        assert await admission.submit('thread', 'hello', idempotency_key='key') == run
+        assert thread.batches == [['hello']]
+
+    asyncio.run(main())
+
+
+def test_retry_handled_by_another_container():
+    async def main():
+        thread = FakeThread()
+        await thread.start_run('thread', ['hello'], {IDEMPOTENCY_KEY_METADATA: 'key'})
+        admission = make_admission(thread)
+        run = await admission.submit('thread', 'hello', idempotency_key='key')
+        assert run['id'] == 'run_0'
+        assert thread.batches == [['hello']]
+
+    asyncio.run(main())
+
+
+def test_messages_wait_for_the_active_run_and_are_coalesced():
+    async def main():
+        thread = FakeThread()
+        admission = make_admission(thread)
+        first = await admission.submit('thread', 'one')
+
+        waiting = [
+            asyncio.create_task(admission.submit('thread', message))
+            for message in ['two', 'three']
+        ]
+        await asyncio.sleep(0.05)
+        assert not any(t.done() for t in waiting)
+
+        thread.finish()
+        runs = await asyncio.gather(*waiting)
+        assert first['id'] == 'run_0'
+        assert [r['id'] for r in runs] == ['run_1', 'run_1']
+        assert thread.batches == [['one'], ['two', 'three']]
+
+    asyncio.run(main())
+
+
+def test_wait_timeout():
+    async def main():
+        thread = FakeThread()
+        admission = make_admission(thread, wait_timeout=0.05)
+        await admission.submit('thread', 'one')
+        with pytest.raises(RunActiveError) as e:
+            await admission.submit('thread', 'two')
+        assert e.value.run_id == 'run_0'
+        assert thread.batches == [['one']]
+        # A retry after the timeout is a new attempt
+        thread.finish()
+        assert (await admission.submit('thread', 'two'))['id'] == 'run_1'
+
+    asyncio.run(main())
+
+
+def test_own_start_run_is_admitted_alone_and_in_order():
+    async def main():
+        thread = FakeThread()
+        streamed: list[list[str]] = []
+
+        async def start_stream(thread_id: str, messages: list[str], metadata: dict) -> dict:
+            streamed.append(messages)
+            return await thread.start_run(thread_id, messages, metadata)
+
+        admission = make_admission(thread)
+        await admission.submit('thread', 'zero')
+        tasks = [
+            asyncio.create_task(admission.submit('thread', 'one')),
+            asyncio.create_task(admission.submit('thread', 'two', start_run=start_stream)),
+            asyncio.create_task(admission.submit('thread', 'three')),
+        ]
+        for started in range(2, 5):
+            thread.finish()
+            while len(thread.runs) < started:
+                await asyncio.sleep(0.01)
+        runs = await asyncio.gather(*tasks)
+        assert [r['id'] for r in runs] == ['run_1', 'run_2', 'run_3']
+        assert thread.batches == [['zero'], ['one'], ['two'], ['three']]
+        assert streamed == [['two']]
+
+    asyncio.run(main())
+
+
+def test_start_run_error_fails_the_batch():
+    async def main():
+        async def start_run(thread_id: str, messages: list[str], metadata: dict) -> dict:
+            raise ValueError('OpenAI is down')
+
+        async def get_latest_run(thread_id: str):
+            return None
+
+        admission = RunAdmission(start_run=start_run, get_latest_run=get_latest_run)
+        with pytest.raises(ValueError):
+            await admission.submit('thread', 'hello', idempotency_key='key')
+        assert admission.stats()['pending_threads'] == 0
+
+    asyncio.run(main())
+
+
+def test_retries_in_two_containers_start_a_single_run():
+    async def main():
+        thread = FakeThread()
+        # Both containers find no active run, and start one at the same time
+        containers = [make_admission(thread), make_admission(thread)]
+        runs = await asyncio.gather(
+            *[admission.submit('thread', 'hello', idempotency_key='key') for admission in containers],
+        )
+        assert [r['id'] for r in runs] == ['run_0', 'run_0']
+        assert thread.batches == [['hello']]
+        assert sum(admission.stats()['deduplicated'] for admission in containers) == 1
+
+    asyncio.run(main())
+
+
+def test_messages_in_two_containers_wait_for_each_others_runs():
+    async def main():
+        thread = FakeThread()
+        containers = [make_admission(thread, wait_timeout=5), make_admission(thread, wait_timeout=5)]
+        await containers[0].submit('thread', 'one')
+        tasks = [
+            asyncio.create_task(admission.submit('thread', message))
+            for admission, message in zip(containers, ['two', 'three'])
+        ]
+        await asyncio.sleep(0.05)
+        # Once `one` is done, both containers try to start a run, only one
+        # of them succeeds, and the other waits for that run, rather than
+        # failing
+        thread.finish()
+        while len(thread.runs) < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        assert len(thread.runs) == 2
+        assert sum(t.done() for t in tasks) == 1
+        thread.finish()
+        runs = await asyncio.gather(*tasks)
+        assert sorted(r['id'] for r in runs) == ['run_1', 'run_2']
+        assert sorted(thread.batches[1:]) == [['three'], ['two']]
+
+    asyncio.run(main())
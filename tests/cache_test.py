@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import time
+
+import pytest
+from cache import ResponseCache
+from cache import TTLCache
+
+
+class Fetch:
+    """A lookup returning `values` in turn, each after `delay` seconds"""
+
+    def __init__(self, *values, delay: float = 0):
+        self.values = list(values)
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        value = self.values.pop(0)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+def test_ttl_cache_expiry_and_lru():
+    cache = TTLCache(maxsize=2, ttl=0.05)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    # `b` is the least recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    time.sleep(0.06)
+    assert cache.get('a') is None
+    cache.set('d', 4, ttl=1)
+    cache.delete('d')
+    assert cache.get('d') is None
+
+
+def test_fresh_result_is_not_fetched_again():
+    cache = ResponseCache(ttl=1)
+    fetch = Fetch('v1')
+    assert cache.get_or_fetch('key', fetch) == 'v1'
+    assert cache.get_or_fetch('key', fetch) == 'v1'
+    assert fetch.calls == 1
+
+
+def test_stale_result_is_refreshed_within_the_request():
+    cache = ResponseCache(ttl=0.05, stale_ttl=10, revalidate_timeout=1)
+    cache.get_or_fetch('key', Fetch('v1'))
+    time.sleep(0.06)
+    assert cache.get_or_fetch('key', Fetch('v2')) == 'v2'
+    assert cache.stats()['revalidations'] == 1
+
+
+def test_stale_result_is_returned_if_the_refresh_times_out():
+    cache = ResponseCache(ttl=0.05, stale_ttl=10, revalidate_timeout=0.05)
+    cache.get_or_fetch('key', Fetch('v1'))
+    time.sleep(0.06)
+
+    fetch = Fetch('v2', delay=0.2)
+    start = time.monotonic()
+    assert cache.get_or_fetch('key', fetch) == 'v1'
+    assert time.monotonic() - start < 0.15
+    # Other requests don't start another refresh while one is running
+    assert cache.get_or_fetch('key', fetch) == 'v1'
+    assert fetch.calls == 1
+
+    # The refresh completes in the background
+    time.sleep(0.25)
+    assert cache.get_or_fetch('key', fetch) == 'v2'
+
+
+def test_stale_result_is_returned_if_the_refresh_fails():
+    cache = ResponseCache(ttl=0.05, stale_ttl=10, revalidate_timeout=1)
+    cache.get_or_fetch('key', Fetch('v1'))
+    time.sleep(0.06)
+    assert cache.get_or_fetch('key', Fetch(ValueError('API down'))) == 'v1'
+    # The error isn't cached: the next request refreshes again
+    assert cache.get_or_fetch('key', Fetch('v2')) == 'v2'
+
+
+def test_stale_result_expires():
+    cache = ResponseCache(ttl=0.02, stale_ttl=0.03)
+    cache.get_or_fetch('key', Fetch('v1'))
+    time.sleep(0.06)
+    fetch = Fetch('v2', delay=0.1)
+    # Past `stale_ttl`, the lookup is a miss, waited for however long it takes
+    assert cache.get_or_fetch('key', fetch) == 'v2'
+
+
+def test_negative_results_expire():
+    cache = ResponseCache(ttl=10, negative_ttl=0.05)
+    fetch = Fetch(None, 'v1')
+    assert cache.get_or_fetch('key', fetch) is None
+    assert cache.get_or_fetch('key', fetch) is None
+    assert fetch.calls == 1
+    assert cache.stats()['negative_hits'] == 1
+    time.sleep(0.06)
+    assert cache.get_or_fetch('key', fetch) == 'v1'
+    assert fetch.calls == 2
+
+
+def test_errors_are_not_cached():
+    cache = ResponseCache()
+    with pytest.raises(ValueError):
+        cache.get_or_fetch('key', Fetch(ValueError('API down')))
+    assert cache.get_or_fetch('key', Fetch('v1')) == 'v1'
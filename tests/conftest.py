@@ -0,0 +1,22 @@
+from __future__ import annotations
+
+import os
+import sys
+
+# The Lambda and the utils scripts import their modules by name, from
+# their own directory
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path[:0] = [os.path.join(SRC, 'lambda'), os.path.join(SRC, 'utils')]
+
+# Settings read on import by the modules under test. The tests send no
+# requests to OpenAI or AWS
+for name, value in {
+    'OPENAI_API_KEY': 'test',
+    'OPENAI_EMBEDDING_MODEL': 'text-embedding-3-small',
+    'OPENAI_ASSISTANT_NAME': 'test',
+    'LANCEDB_DATA_PATH': 'app_data/lancedb',
+    'BUCKET_NAME': 'test',
+    'STAGE': 'test',
+    'OWNER': 'test',
+}.items():
+    os.environ.setdefault(name, value)
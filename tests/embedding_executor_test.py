@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+
+import httpx
+import pytest
+from embedding_executor import AdaptiveConcurrency
+from embedding_executor import Checkpoint
+from embedding_executor import EmbeddingExecutor
+from embedding_executor import RateLimiter
+from openai import APIConnectionError
+from openai import APITimeoutError
+from openai import InternalServerError
+from openai import RateLimitError
+
+REQUEST = httpx.Request('POST', 'https://api.openai.com/v1/embeddings')
+
+
+def status_error(cls, status: int, headers: dict | None = None):
+    return cls('error', response=httpx.Response(status, request=REQUEST, headers=headers), body=None)
+
+
+def test_rate_limiter_waits_for_the_token_budget():
+    limiter = RateLimiter(requests_per_minute=60_000, tokens_per_minute=6000)
+    start = time.monotonic()
+    # The bucket starts full
+    limiter.acquire(6000)
+    assert time.monotonic() - start < 0.05
+    # 100 tokens per second
+    limiter.acquire(20)
+    assert 0.15 < time.monotonic() - start < 0.4
+
+
+def test_rate_limiter_waits_for_the_request_budget():
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=1_000_000)
+    limiter.available['requests'] = 0
+    start = time.monotonic()
+    # 10 requests per second
+    limiter.acquire(1)
+    assert 0.05 < time.monotonic() - start < 0.3
+
+
+def test_rate_limiter_lets_oversized_requests_through():
+    limiter = RateLimiter(requests_per_minute=60_000, tokens_per_minute=100)
+    start = time.monotonic()
+    limiter.acquire(1000)
+    assert time.monotonic() - start < 0.05
+
+
+def test_concurrency_is_halved_on_overload_and_grows_on_success():
+    concurrency = AdaptiveConcurrency(max_concurrency=8, min_concurrency=2)
+    for expected in [4, 2, 2]:
+        concurrency.acquire()
+        concurrency.release(overloaded=True)
+        assert concurrency.limit == expected
+    concurrency.acquire()
+    concurrency.release(succeeded=True)
+    assert concurrency.limit == 3
+    # Neither a success nor an overload (eg: a request error)
+    concurrency.acquire()
+    concurrency.release()
+    assert concurrency.limit == 3
+    for _ in range(10):
+        concurrency.acquire()
+        concurrency.release(succeeded=True)
+    assert concurrency.limit == 8
+
+
+def test_concurrency_limit_blocks_until_released():
+    concurrency = AdaptiveConcurrency(max_concurrency=1)
+    concurrency.acquire()
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (concurrency.acquire(), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.05)
+    concurrency.release(succeeded=True)
+    assert acquired.wait(1)
+    thread.join()
+
+
+def make_executor() -> EmbeddingExecutor:
+    return EmbeddingExecutor(max_concurrency=8, max_retries=3, base_delay=0.001, max_delay=0.01)
+
+
+def failing(*errors):
+    """A job failing with each of `errors` in turn, then succeeding"""
+    remaining = list(errors)
+
+    def fn(item):
+        if remaining:
+            raise remaining.pop(0)
+        return item
+
+    return fn
+
+
+def test_run_halves_concurrency_on_429_only():
+    executor = make_executor()
+    errors = [
+        APITimeoutError(request=REQUEST),
+        APIConnectionError(request=REQUEST),
+        status_error(InternalServerError, 500),
+    ]
+    assert executor.run(failing(*errors), 'item', 0) == 'item'
+    assert executor.concurrency.limit == 8
+
+    assert executor.run(failing(status_error(RateLimitError, 429)), 'item', 0) == 'item'
+    # Halved, then increased by the success
+    assert executor.concurrency.limit == 5
+    assert executor.concurrency.in_flight == 0
+
+
+def test_run_gives_up_after_max_retries():
+    executor = make_executor()
+    with pytest.raises(APITimeoutError):
+        executor.run(failing(*[APITimeoutError(request=REQUEST)] * 4), 'item', 0)
+    with pytest.raises(ValueError):
+        executor.run(failing(ValueError('not retried')), 'item', 0)
+    assert executor.concurrency.in_flight == 0
+
+
+def test_backoff_honours_retry_after_within_bounds():
+    executor = EmbeddingExecutor(base_delay=1, max_delay=10)
+    assert executor._backoff(0, status_error(RateLimitError, 429, {'retry-after': '3'})) == 3
+    assert executor._backoff(0, status_error(RateLimitError, 429, {'retry-after': '3600'})) == 10
+    assert executor._backoff(0, status_error(RateLimitError, 429, {'retry-after': '-5'})) == 0
+    for retry_after in ['nan', 'inf', 'soon']:
+        error = status_error(RateLimitError, 429, {'retry-after': retry_after})
+        assert 0 <= executor._backoff(2, error) <= 4
+
+
+def test_map_keeps_input_order():
+    executor = make_executor()
+
+    def fn(item: int):
+        # Later items complete first
+        time.sleep((20 - item) / 1000)
+        return item * 2
+
+    assert list(executor.map(fn, range(20))) == [i * 2 for i in range(20)]
+
+
+def test_checkpoint(tmp_path):
+    source = tmp_path / 'source.json'
+    source.write_text('[]')
+    path = str(tmp_path / 'output.checkpoint')
+
+    checkpoint = Checkpoint(path, sources=[str(source)])
+    assert checkpoint.load() is None
+    checkpoint.save(records_done=10, output_offset=1234)
+    state = Checkpoint(path, sources=[str(source)]).load()
+    assert state is not None
+    assert (state['records_done'], state['output_offset']) == (10, 1234)
+
+    # Invalid once the source changes
+    source.write_text('[{}]')
+    assert Checkpoint(path, sources=[str(source)]).load() is None
+
+    checkpoint.clear()
+    assert not os.path.exists(path)
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import json
+import os
+from types import SimpleNamespace
+
+import embeddings
+import pytest
+from embeddings import generate_embeddings
+from embeddings import split_into_batches
+
+SOURCES = {
+    'wb_ag_projects.json': [{'id': f'P{i}', 'description': f'project number {i}'} for i in range(7)],
+    'wb_datasets.json': {'data': [{'id': f'D{i}', 'name': f'dataset {"x" * i}'} for i in range(5)]},
+}
+
+
+class FakeEmbeddings:
+    """Embeds token lists as [length, sum], failing the `fail_on` call"""
+
+    def __init__(self, fail_on: int = 0):
+        self.fail_on = fail_on
+        self.inputs: list[list[int]] = []
+        self.num_calls = 0
+
+    def create(self, input: list[list[int]], **params):
+        self.num_calls += 1
+        if self.num_calls == self.fail_on:
+            raise RuntimeError('Interrupted')
+        self.inputs.extend(input)
+        return SimpleNamespace(
+            data=[
+                SimpleNamespace(index=i, embedding=[float(len(tokens)), float(sum(tokens))])
+                for i, tokens in enumerate(input)
+            ],
+        )
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Source files are read from ../data
+    (tmp_path / 'data').mkdir()
+    for name, records in SOURCES.items():
+        (tmp_path / 'data' / name).write_text(json.dumps(records))
+    (tmp_path / 'utils').mkdir()
+    monkeypatch.chdir(tmp_path / 'utils')
+
+    monkeypatch.setattr(embeddings, 'SOURCE_FILES', list(SOURCES))
+    monkeypatch.setattr(embeddings, 'get_tokens_batch', lambda texts: [[len(w) for w in t.split()] for t in texts])
+    # Batches of 2 records, embedded one at a time, without caching
+    monkeypatch.setattr(embeddings, 'split_into_batches', lambda data: split_into_batches(data, max_items=2))
+    monkeypatch.setattr(embeddings.settings, 'EMBEDDING_MAX_CONCURRENCY', 1)
+    monkeypatch.setattr(embeddings.settings, 'EMBEDDING_CACHE_PATH', '')
+    return tmp_path / 'utils'
+
+
+def run(monkeypatch, fake: FakeEmbeddings, **kwargs):
+    monkeypatch.setattr(embeddings, 'client', SimpleNamespace(embeddings=fake))
+    generate_embeddings('records.jsonl', **kwargs)
+
+
+def read_output() -> list[dict]:
+    with open('records.jsonl') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_generate_embeddings(workdir, monkeypatch):
+    run(monkeypatch, FakeEmbeddings())
+    records = read_output()
+    assert [r['id'] for r in records] == [f'P{i}' for i in range(7)] + [f'D{i}' for i in range(5)]
+    assert records[0] == {
+        'embedding': [3.0, 14.0],
+        'id': 'P0',
+        'description': 'project number 0',
+        'type': 'project',
+        'text_to_embed': 'project number 0',
+    }
+    assert records[-1]['type'] == 'dataset'
+    assert not os.path.exists('records.jsonl.checkpoint')
+
+
+def test_interrupted_run_resumes_from_the_checkpoint(workdir, monkeypatch):
+    run(monkeypatch, FakeEmbeddings())
+    expected = read_output()
+    os.remove('records.jsonl')
+
+    # The third batch fails: the first two (4 records) are checkpointed
+    with pytest.raises(RuntimeError):
+        run(monkeypatch, FakeEmbeddings(fail_on=3))
+    with open('records.jsonl.checkpoint') as f:
+        assert json.load(f)['records_done'] == 4
+    # A record only partly written when the run was interrupted
+    with open('records.jsonl', 'ab') as f:
+        f.write(b'{"embedding": [1.0, ')
+
+    fake = FakeEmbeddings()
+    run(monkeypatch, fake)
+    assert read_output() == expected
+    # Only the records after the checkpoint are embedded again
+    assert len(fake.inputs) == 8
+    assert not os.path.exists('records.jsonl.checkpoint')
+
+
+def test_changed_sources_start_over(workdir, monkeypatch):
+    with pytest.raises(RuntimeError):
+        run(monkeypatch, FakeEmbeddings(fail_on=3))
+    (workdir.parent / 'data' / 'wb_datasets.json').write_text(json.dumps({'data': [{'id': 'D9', 'name': 'new'}]}))
+
+    fake = FakeEmbeddings()
+    run(monkeypatch, fake)
+    assert [r['id'] for r in read_output()] == [f'P{i}' for i in range(7)] + ['D9']
+    assert len(fake.inputs) == 8
+
+
+def test_resume_disabled_starts_over(workdir, monkeypatch):
+    with pytest.raises(RuntimeError):
+        run(monkeypatch, FakeEmbeddings(fail_on=3))
+    fake = FakeEmbeddings()
+    run(monkeypatch, fake, resume=False)
+    assert len(read_output()) == 12
+    assert len(fake.inputs) == 12
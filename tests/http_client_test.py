@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import time
+
+import pytest
+import requests
+from http_client import CircuitBreaker
+from http_client import CircuitOpenError
+from http_client import HttpClient
+
+
+def open_breaker(reset_timeout: float = 0.05) -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout)
+    for _ in range(2):
+        breaker.before_request()
+        breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    # The success in between reset the count
+    breaker.before_request()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_breaker_half_open_lets_a_single_trial_through():
+    breaker = open_breaker()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    time.sleep(0.06)
+    breaker.before_request()
+    # Other requests are refused while the trial is in flight
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_breaker_closes_when_the_trial_succeeds():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    breaker.before_request()
+    breaker.record_success()
+    breaker.before_request()
+    breaker.before_request()
+
+
+def test_breaker_stays_open_when_the_trial_fails():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    breaker.before_request()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    # Until the next trial
+    time.sleep(0.06)
+    breaker.before_request()
+
+
+class FakeSession:
+    """Responds to each request with the next of `statuses`"""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.requests: list[tuple[str, str, dict]] = []
+
+    def request(self, method: str, url: str, **kwargs):
+        self.requests.append((method, url, kwargs))
+        status = self.statuses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        response = requests.Response()
+        response.status_code = status
+        return response
+
+
+def test_client_has_a_breaker_per_host():
+    client = HttpClient(failure_threshold=2, reset_timeout=10)
+    client.session = FakeSession(500, requests.ConnectionError(), 200)  # type: ignore
+    client.get('https://down.example.com/a')
+    with pytest.raises(requests.ConnectionError):
+        client.get('https://down.example.com/b')
+    with pytest.raises(CircuitOpenError):
+        client.get('https://down.example.com/c')
+    assert client.get('https://up.example.com/a').status_code == 200
+    # The request refused by the breaker wasn't sent
+    assert len(client.session.requests) == 3  # type: ignore
+
+
+def test_client_4xx_is_not_a_failure():
+    client = HttpClient(failure_threshold=1, reset_timeout=10)
+    client.session = FakeSession(404, 404)  # type: ignore
+    client.get('https://example.com/missing')
+    assert client.get('https://example.com/missing').status_code == 404
+    # Default timeouts are set on every request
+    assert client.session.requests[0][2]['timeout'] == client.timeout  # type: ignore
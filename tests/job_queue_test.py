@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import time
+
+import pytest
+from job_queue import get_job_queue
+from job_queue import Job
+from job_queue import MemoryJobQueue
+from job_queue import SQLiteJobQueue
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def queue(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryJobQueue(max_attempts=2)
+    return SQLiteJobQueue(str(tmp_path / 'jobs.sqlite'), visibility_timeout=60, max_attempts=2)
+
+
+def test_job_json_round_trip():
+    job = Job('thread', 'run', enqueued_at=123.0)
+    copy = Job.from_json(job.to_json(), id='id', receipt='receipt', attempts=2)
+    assert (copy.thread_id, copy.run_id, copy.enqueued_at) == ('thread', 'run', 123.0)
+    assert (copy.id, copy.receipt, copy.attempts) == ('id', 'receipt', 2)
+
+
+def test_get_batch_in_order(queue):
+    for i in range(5):
+        queue.put(Job('thread', f'run_{i}', enqueued_at=time.time() + i * 1e-3))
+    assert queue.depth() == 5
+
+    batch = queue.get_batch(3, wait_time=0)
+    assert [j.run_id for j in batch] == ['run_0', 'run_1', 'run_2']
+    assert all(j.attempts == 1 for j in batch)
+    assert queue.depth() == 2
+    assert [j.run_id for j in queue.get_batch(10, wait_time=0)] == ['run_3', 'run_4']
+
+
+def test_get_batch_waits_for_a_job(queue):
+    started = time.monotonic()
+    assert queue.get_batch(1, wait_time=0.2) == []
+    assert time.monotonic() - started >= 0.15
+
+
+def test_ack_removes_job(queue):
+    queue.put(Job('thread', 'run'))
+    [job] = queue.get_batch(1, wait_time=0)
+    queue.ack(job)
+    assert queue.depth() == 0
+    assert queue.get_batch(1, wait_time=0) == []
+
+
+def test_nack_retries_then_dead_letters(queue):
+    queue.put(Job('thread', 'run'))
+    [job] = queue.get_batch(1, wait_time=0)
+    queue.nack(job)
+
+    [retry] = queue.get_batch(1, wait_time=0)
+    assert retry.run_id == 'run'
+    assert retry.attempts == 2
+    queue.nack(retry)
+
+    # max_attempts reached
+    assert queue.depth() == 0
+    assert queue.get_batch(1, wait_time=0) == []
+    if isinstance(queue, MemoryJobQueue):
+        assert [j.run_id for j in queue.dead_letters] == ['run']
+
+
+def test_sqlite_unacknowledged_job_is_redelivered(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / 'jobs.sqlite'), visibility_timeout=0.1)
+    queue.put(Job('thread', 'run'))
+    [job] = queue.get_batch(1, wait_time=0)
+    assert queue.get_batch(1, wait_time=0) == []
+    time.sleep(0.15)
+    [redelivered] = queue.get_batch(1, wait_time=0)
+    assert redelivered.id == job.id
+    assert redelivered.attempts == 2
+
+
+def test_sqlite_jobs_survive_reopening(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite')
+    SQLiteJobQueue(path).put(Job('thread', 'run'))
+    [job] = SQLiteJobQueue(path).get_batch(1, wait_time=0)
+    assert job.run_id == 'run'
+
+
+def test_get_job_queue(tmp_path, monkeypatch):
+    monkeypatch.setenv('THREAD_RUN_QUEUE_PATH', str(tmp_path / 'jobs.sqlite'))
+    assert isinstance(get_job_queue('memory'), MemoryJobQueue)
+    assert isinstance(get_job_queue('sqlite'), SQLiteJobQueue)
+    with pytest.raises(ValueError):
+        get_job_queue('kafka')
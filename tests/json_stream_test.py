@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import io
+import json
+
+import pytest
+from json_stream import iter_json_items
+from json_stream import JSONStreamReader
+
+
+class Unseekable(io.StringIO):
+    def seekable(self):
+        return False
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 1 << 16])
+@pytest.mark.parametrize(
+    'items',
+    [
+        [1.5e10, -0.25, 0, 12345678901234567890, 1e-7, -3E+2],
+        ['plain', 'split "quoted" \\ text', 'unicode é中 😀', '\\u escapes A'],
+        [True, False, None, [], {}, [[1, 2], {'a': [3.5]}]],
+        [{'id': 'P1', 'value': 2.5e3, 'text': 'a\nb\tc'}, {'id': 'P2', 'value': -1}],
+    ],
+)
+def test_iter_array_chunk_boundaries(items, chunk_size):
+    document = json.dumps(items, ensure_ascii=False)
+    reader = JSONStreamReader(io.StringIO(document), chunk_size=chunk_size)
+    assert list(reader.iter_array()) == items
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4])
+def test_iter_array_raw_escapes(chunk_size):
+    # Escape sequences kept as written (ensure_ascii), so chunks can end
+    # inside `\uXXXX` and after a lone backslash
+    items = ['é😀', 'back\\slash', 'quote"s', 'tab\tnew\nline']
+    document = json.dumps(items, ensure_ascii=True)
+    reader = JSONStreamReader(io.StringIO(document), chunk_size=chunk_size)
+    assert list(reader.iter_array()) == items
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3])
+def test_decode_number_at_end_of_file(chunk_size):
+    reader = JSONStreamReader(io.StringIO('  1.5e10'), chunk_size=chunk_size)
+    assert reader.decode() == 1.5e10
+
+
+def test_iter_array_invalid_separator():
+    reader = JSONStreamReader(io.StringIO('[1 2]'), chunk_size=1)
+    with pytest.raises(ValueError):
+        list(reader.iter_array())
+
+
+@pytest.mark.parametrize('chunk_size', [1, 1 << 16])
+def test_iter_json_items_top_level_array(chunk_size):
+    document = json.dumps([{'id': 1}, {'id': 2}])
+    assert list(iter_json_items(io.StringIO(document), chunk_size=chunk_size)) == [{'id': 1}, {'id': 2}]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 1 << 16])
+def test_iter_json_items_data_only(chunk_size):
+    document = json.dumps(
+        {'meta': {'total': 2}, 'data': [{'id': 1}, {'id': 2}], 'links': {'next': None}},
+    )
+    assert list(iter_json_items(io.StringIO(document), chunk_size=chunk_size)) == [{'id': 1}, {'id': 2}]
+
+
+def test_iter_json_items_without_data():
+    # Files mapping ids to records
+    document = json.dumps({'P1': {'id': 'P1'}, 'P2': {'id': 'P2'}})
+    assert list(iter_json_items(io.StringIO(document), chunk_size=2)) == [{'id': 'P1'}, {'id': 'P2'}]
+    assert list(iter_json_items(Unseekable(document))) == []
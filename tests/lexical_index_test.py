@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import pytest
+from lexical_index import LexicalIndex
+from lexical_index import reciprocal_rank_fusion
+from lexical_index import tokenize
+
+RECORDS = [
+    {
+        'id': 'P123456',
+        'type': 'project',
+        'title': 'Rice irrigation in Vietnam',
+        'text_to_embed': 'Irrigation of rice paddies',
+    },
+    {
+        'id': 'P654321',
+        'type': 'project',
+        'title': 'Dairy farming',
+        'text_to_embed': 'Milk yields of dairy cows in Kenya',
+    },
+    {'id': 'DS-0001', 'type': 'dataset', 'title': 'Rice prices', 'text_to_embed': 'Monthly rice prices by country'},
+    {'id': 'DS-0002', 'type': 'dataset', 'title': 'Rainfall', 'text_to_embed': 'Rainfall and irrigation needs'},
+]
+
+
+@pytest.fixture
+def index():
+    return LexicalIndex.build(RECORDS)
+
+
+def test_tokenize():
+    assert tokenize('The Price of RICE, in 2020!') == ['price', 'rice', '2020']
+
+
+def test_search_ranks_by_bm25(index):
+    results = index.search('rice irrigation')
+    ids = [_id for _id, _ in results]
+    # The only record matching both terms comes first
+    assert ids[0] == 'P123456'
+    assert set(ids) == {'P123456', 'DS-0001', 'DS-0002'}
+    scores = [score for _, score in results]
+    assert scores == sorted(scores, reverse=True)
+    assert all(score > 0 for score in scores)
+
+
+def test_search_num_results_and_datatype(index):
+    assert len(index.search('rice irrigation', num_results=1)) == 1
+    assert [_id for _id, _ in index.search('rice', datatype='dataset')] == ['DS-0001']
+    assert index.search('unknown words') == []
+
+
+def test_rare_terms_score_higher(index):
+    # `milk` appears in one record, `rice` in two
+    [(_, milk)] = index.search('milk')
+    rice = dict(index.search('rice'))['DS-0001']
+    assert milk > rice
+
+
+def test_lookup_ids(index):
+    assert index.lookup_ids('p123456') == ['P123456']
+    assert index.lookup_ids('P123456, DS-0001 P123456') == ['P123456', 'DS-0001']
+    assert index.lookup_ids('P123456 DS-0001', datatype='dataset') == ['DS-0001']
+    assert index.lookup_ids('P123456 rice') == []
+    assert index.lookup_ids('  ') == []
+
+
+def test_save_and_load(index, tmp_path):
+    path = str(tmp_path / 'lexical_index.npz')
+    index.save(path)
+    loaded = LexicalIndex.load(path)
+    assert len(loaded) == len(index)
+    assert loaded.search('rice irrigation') == index.search('rice irrigation')
+    assert loaded.lookup_ids('ds-0002') == ['DS-0002']
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([['a', 'b', 'c'], ['c', 'a', 'd']], k=60)
+    assert [_id for _id, _ in fused] == ['a', 'c', 'b', 'd']
+    scores = dict(fused)
+    assert scores['a'] == pytest.approx(1 / 61 + 1 / 62)
+    assert scores['d'] == pytest.approx(1 / 63)
+
+
+def test_reciprocal_rank_fusion_ties_and_empty():
+    assert reciprocal_rank_fusion([]) == []
+    assert reciprocal_rank_fusion([[], ['a']]) == [('a', pytest.approx(1 / 61))]
+    # Ids at the same rank of different rankings tie, in order of appearance
+    assert [_id for _id, _ in reciprocal_rank_fusion([['a'], ['b']])] == ['a', 'b']
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import os
+
+import numpy as np
+import pyarrow as pa
+import pytest
+from local_search import LocalSearchIndex
+from local_search import write_index
+
+NUM_ROWS = 500
+DIMENSIONS = 64
+
+
+def write_test_index(directory: str, vectors: np.ndarray, dtype: str, rescore_dtype: str | None = None):
+    metadata = pa.table({
+        'id': [f'P{i}' for i in range(len(vectors))],
+        'type': ['project' if i % 2 else 'dataset' for i in range(len(vectors))],
+        'title': [f'Title {i}' for i in range(len(vectors))],
+    })
+    files = write_index(directory, vectors, metadata, dtype, rescore_dtype)
+    assert sorted(files) == sorted(os.listdir(directory))
+    assert files[-1] == 'index.json'
+
+
+@pytest.fixture
+def vectors():
+    vectors = np.random.default_rng(0).standard_normal((NUM_ROWS, DIMENSIONS)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def query(vectors):
+    # Close to row 42, so that the best matches are well separated
+    query = vectors[42] + 0.05 * np.random.default_rng(1).standard_normal(DIMENSIONS).astype(np.float32)
+    return (query / np.linalg.norm(query)).tolist()
+
+
+def exact_top(vectors: np.ndarray, query: list[float], num_results: int) -> list[str]:
+    return [f'P{i}' for i in np.argsort(-(vectors @ np.asarray(query, dtype=np.float32)))[:num_results]]
+
+
+def test_search_float32(tmp_path, vectors, query):
+    write_test_index(str(tmp_path), vectors, 'float32')
+    index = LocalSearchIndex(str(tmp_path))
+    results = index.search(query, 5)
+    assert [r['id'] for r in results] == exact_top(vectors, query, 5)
+    assert results[0]['id'] == 'P42'
+    distances = [r['_distance'] for r in results]
+    assert distances == sorted(distances)
+
+
+@pytest.mark.parametrize('dtype', ['int8', 'binary'])
+def test_search_rescores_quantized_vectors(tmp_path, vectors, query, dtype):
+    write_test_index(str(tmp_path), vectors, dtype, rescore_dtype='float32')
+    index = LocalSearchIndex(str(tmp_path), rescore_factor=20)
+    results = index.search(query, 5)
+    assert [r['id'] for r in results] == exact_top(vectors, query, 5)
+    # Rescored distances are exact
+    exact = 1 - vectors[[int(r['id'][1:]) for r in results]] @ np.asarray(query, dtype=np.float32)
+    np.testing.assert_allclose([r['_distance'] for r in results], exact, atol=1e-5)
+
+
+def test_search_without_rescore_vectors(tmp_path, vectors, query):
+    write_test_index(str(tmp_path), vectors, 'int8')
+    index = LocalSearchIndex(str(tmp_path))
+    assert index.rescore_vectors is None
+    results = index.search(query, 5)
+    assert len(results) == 5
+    assert results[0]['id'] == 'P42'
+
+
+def test_search_datatype_and_columns(tmp_path, vectors, query):
+    write_test_index(str(tmp_path), vectors, 'int8', rescore_dtype='float16')
+    index = LocalSearchIndex(str(tmp_path))
+    results = index.search(query, 10, datatype='dataset', columns=['id', 'missing'])
+    assert len(results) == 10
+    assert all(int(r['id'][1:]) % 2 == 0 for r in results)
+    assert all(set(r) == {'id', '_distance'} for r in results)
+    assert index.search(query, 5, datatype='unknown') == []
+
+
+def test_get_keeps_order(tmp_path, vectors):
+    write_test_index(str(tmp_path), vectors, 'float32')
+    index = LocalSearchIndex(str(tmp_path))
+    assert [r['id'] for r in index.get(['P7', 'missing', 'P3'], columns=['id'])] == ['P7', 'P3']
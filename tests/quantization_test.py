@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import numpy as np
+import pytest
+from quantization import CHUNK_SIZE
+from quantization import quantize
+from quantization import score
+
+
+def normalized(rows: int, dimensions: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((rows, dimensions)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def vectors():
+    return normalized(200, 64)
+
+
+@pytest.fixture
+def query():
+    return normalized(1, 64, seed=1)[0]
+
+
+def test_quantize_shapes_and_types(vectors):
+    for dtype, expected_dtype, columns in [
+        ('float32', np.float32, 64),
+        ('float16', np.float16, 64),
+        ('int8', np.int8, 64),
+        ('binary', np.uint8, 8),
+    ]:
+        quantized, scales = quantize(vectors, dtype)
+        assert quantized.dtype == expected_dtype
+        assert quantized.shape == (200, columns)
+        assert (scales is not None) == (dtype == 'int8')
+
+
+def test_quantize_int8_uses_full_range(vectors):
+    quantized, scales = quantize(vectors, 'int8')
+    assert (np.abs(quantized).max(axis=1) == 127).all()
+    assert scales.dtype == np.float32
+    np.testing.assert_allclose(quantized * scales[:, None], vectors, atol=scales.max())
+
+
+def test_quantize_int8_zero_vector():
+    quantized, scales = quantize(np.zeros((1, 4), dtype=np.float32), 'int8')
+    assert (quantized == 0).all()
+    assert scales.tolist() == [1]
+
+
+def test_quantize_unknown_dtype(vectors):
+    with pytest.raises(ValueError):
+        quantize(vectors, 'int4')
+
+
+@pytest.mark.parametrize(
+    'dtype,tolerance',
+    [('float32', 1e-6), ('float16', 1e-3), ('int8', 0.02)],
+)
+def test_score_approximates_cosine_similarity(vectors, query, dtype, tolerance):
+    quantized, scales = quantize(vectors, dtype)
+    scores = score(quantized, dtype, query, scales)
+    assert scores.dtype == np.float32
+    np.testing.assert_allclose(scores, vectors @ query, atol=tolerance)
+
+
+def test_score_binary_is_hamming_similarity(vectors, query):
+    quantized, _ = quantize(vectors, 'binary')
+    scores = score(quantized, 'binary', query, dimensions=64)
+    agreements = ((vectors > 0) == (query > 0)).sum(axis=1)
+    np.testing.assert_allclose(scores, 2 * agreements / 64 - 1)
+    # Identical signs score 1
+    assert score(quantized[:1], 'binary', vectors[0], dimensions=64)[0] == 1
+
+
+def test_score_spans_chunks(query):
+    vectors = normalized(CHUNK_SIZE + 10, 64)
+    quantized, scales = quantize(vectors, 'int8')
+    scores = score(quantized, 'int8', query, scales)
+    assert scores.shape == (CHUNK_SIZE + 10,)
+    np.testing.assert_allclose(scores[-10:], vectors[-10:] @ query, atol=0.02)
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import json
+import time
+from types import SimpleNamespace
+
+import orjson
+import pytest
+import thread_runner
+from thread_runner import execute_tool_calls
+
+
+def tool_call(call_id: str, name: str, **arguments):
+    return SimpleNamespace(id=call_id, function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+
+
+@pytest.fixture(autouse=True)
+def functions(monkeypatch):
+    def sleep(seconds: float):
+        time.sleep(seconds)
+        return {'slept': seconds}
+
+    def fail():
+        raise ValueError('API down')
+
+    def whoami(thread_id: str):
+        return {'thread_id': thread_id}
+
+    monkeypatch.setitem(thread_runner.function_mapping, 'sleep', sleep)
+    monkeypatch.setitem(thread_runner.function_mapping, 'fail', fail)
+    monkeypatch.setitem(thread_runner.function_mapping, 'whoami', whoami)
+    monkeypatch.setattr(thread_runner, 'THREAD_FUNCTIONS', {'whoami'})
+    monkeypatch.setattr(thread_runner, 'TOOL_CALL_TIMEOUT', 0.3)
+
+
+def outputs(tool_outputs: list[dict]) -> dict:
+    return {o['tool_call_id']: orjson.loads(o['output']) for o in tool_outputs}
+
+
+def test_calls_run_concurrently_in_order(monkeypatch):
+    monkeypatch.setattr(thread_runner, 'TOOL_CALL_MAX_WORKERS', 4)
+    start = time.monotonic()
+    tool_outputs = execute_tool_calls(
+        'thread',
+        [tool_call(f'call_{i}', 'sleep', seconds=0.1) for i in range(4)],
+    )
+    assert time.monotonic() - start < 0.3
+    assert [o['tool_call_id'] for o in tool_outputs] == [f'call_{i}' for i in range(4)]
+    assert outputs(tool_outputs)['call_0'] == {'slept': 0.1}
+
+
+def test_timeout_starts_when_the_call_starts(monkeypatch):
+    # A single worker: the calls run one after the other, and together take
+    # longer than the timeout, which each of them is well within
+    monkeypatch.setattr(thread_runner, 'TOOL_CALL_MAX_WORKERS', 1)
+    failed: set[str] = set()
+    tool_outputs = execute_tool_calls(
+        'thread',
+        [tool_call(f'call_{i}', 'sleep', seconds=0.15) for i in range(3)],
+        failed,
+    )
+    assert failed == set()
+    assert all(o == {'slept': 0.15} for o in outputs(tool_outputs).values())
+
+
+def test_slow_and_failed_calls_return_errors(monkeypatch):
+    monkeypatch.setattr(thread_runner, 'TOOL_CALL_MAX_WORKERS', 4)
+    failed: set[str] = set()
+    start = time.monotonic()
+    tool_outputs = outputs(
+        execute_tool_calls(
+            'thread',
+            [
+                tool_call('slow', 'sleep', seconds=1),
+                tool_call('fail', 'fail'),
+                tool_call('fast', 'sleep', seconds=0),
+            ],
+            failed,
+        ),
+    )
+    # The slow call isn't waited for beyond its timeout
+    assert time.monotonic() - start < 0.6
+    assert failed == {'slow', 'fail'}
+    assert tool_outputs['slow'] == {'error': 'Timed out after 0.3 seconds'}
+    assert tool_outputs['fail'] == {'error': 'API down'}
+    assert tool_outputs['fast'] == {'slept': 0}
+
+
+def test_thread_functions_get_the_thread_id():
+    tool_outputs = outputs(execute_tool_calls('thread_abc', [tool_call('call', 'whoami')]))
+    assert tool_outputs['call'] == {'thread_id': 'thread_abc'}
+
+
+def test_unknown_function():
+    with pytest.raises(Exception, match='unknown'):
+        execute_tool_calls('thread', [tool_call('call', 'missing')])
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+from job_queue import Job
+from job_queue import MemoryJobQueue
+from worker import run_worker
+from worker import WorkerStats
+
+
+async def run_until(queue, process, done, concurrency=4, timeout=5.0):
+    worker = asyncio.create_task(
+        run_worker(queue, process, concurrency=concurrency, poll_wait=0.05, stats_interval=60),
+    )
+    deadline = time.monotonic() + timeout
+    while not done() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    worker.cancel()
+    try:
+        await worker
+    except asyncio.CancelledError:
+        pass
+
+
+def test_processes_all_jobs():
+    queue = MemoryJobQueue()
+    for i in range(10):
+        queue.put(Job('thread', f'run_{i}'))
+    processed = []
+    lock = threading.Lock()
+
+    def process(thread_id: str, run_id: str):
+        with lock:
+            processed.append(run_id)
+
+    asyncio.run(run_until(queue, process, lambda: len(processed) == 10))
+    assert sorted(processed) == sorted(f'run_{i}' for i in range(10))
+    assert queue.depth() == 0
+
+
+def test_concurrency_limit():
+    queue = MemoryJobQueue()
+    for i in range(8):
+        queue.put(Job('thread', f'run_{i}'))
+    state = {'running': 0, 'max_running': 0, 'done': 0}
+    lock = threading.Lock()
+
+    def process(thread_id: str, run_id: str):
+        with lock:
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+        time.sleep(0.05)
+        with lock:
+            state['running'] -= 1
+            state['done'] += 1
+
+    asyncio.run(run_until(queue, process, lambda: state['done'] == 8, concurrency=3))
+    assert state['done'] == 8
+    assert 1 < state['max_running'] <= 3
+
+
+def test_failed_jobs_are_retried_then_dead_lettered():
+    queue = MemoryJobQueue(max_attempts=3)
+    queue.put(Job('thread', 'flaky'))
+    queue.put(Job('thread', 'broken'))
+    attempts = {'flaky': 0, 'broken': 0}
+
+    def process(thread_id: str, run_id: str):
+        attempts[run_id] += 1
+        if run_id == 'broken' or attempts[run_id] == 1:
+            raise RuntimeError('OpenAI is down')
+
+    asyncio.run(
+        run_until(queue, process, lambda: attempts['flaky'] == 2 and len(queue.dead_letters) == 1),
+    )
+    assert attempts == {'flaky': 2, 'broken': 3}
+    assert [j.run_id for j in queue.dead_letters] == ['broken']
+
+
+def test_stats_report(capsys):
+    stats = WorkerStats()
+    stats.queue_latencies = [0.1, 0.2, 0.3]
+    stats.run_durations = [1.0]
+    stats.report(depth=4)
+    output = capsys.readouterr().out
+    assert 'queue depth=4' in output
+    assert 'queue latency p50=0.20s' in output
+    assert stats.queue_latencies == [] and stats.run_durations == []